@@ -0,0 +1,183 @@
+#! /usr/bin/python -tt
+import itertools
+import os
+import re
+import tempfile
+import threading
+import time
+
+from lib.core import autopsy_globals
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+class CommandOutput(str):
+    """ Output of a command, as returned by execute.
+
+    When the output was bigger than the retention limit, the string itself holds only the first
+    'max_bytes' of it and the whole output is in 'path'. load() reads all of it back, stream()
+    and lines() give it out piece by piece without holding it all in memory.
+
+        output = node.execute("journalctl -b")
+        if output.spilled:
+            for line in output.lines():
+                ...
+    """
+
+    def __new__(cls, value, size=None, path=None):
+        output = str.__new__(cls, value)
+        output.size = size if size is not None else len(value)
+        output.path = path
+
+        return output
+
+    @property
+    def spilled(self):
+        return self.path is not None
+
+    def load(self):
+        """
+        :return: Whole output as a plain string, stripped the same way execute strips it
+        """
+        if not self.spilled:
+            return str(self)
+
+        with open(self.path, "rb") as fh:
+            return fh.read().strip()
+
+    def stream(self, chunk_size=1024 * 1024):
+        """
+        :return: Generator of chunks of the whole output, as it was received
+        """
+        if not self.spilled:
+            yield str(self)
+            return
+
+        with open(self.path, "rb") as fh:
+            while True:
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def lines(self):
+        """
+        :return: Generator of the lines of the whole output, without the line endings
+        """
+        if not self.spilled:
+            for line in str(self).splitlines():
+                yield line
+            return
+
+        with open(self.path, "rb") as fh:
+            for line in fh:
+                yield line.rstrip("\r\n")
+
+
+class OutputCollector:
+    """ Collects the output of one command, keeping at most 'max_bytes' of it in memory. Everything
+    goes to the spill file once the output grows beyond that.
+    """
+
+    def __init__(self, retention, name):
+        self.retention = retention
+        self.name = name
+        self.chunks = []
+        self.size = 0
+        self.path = None
+        self.fh = None
+
+    def write(self, data):
+        if not data:
+            return
+
+        self.size += len(data)
+
+        if self.fh:
+            self.fh.write(data)
+            return
+
+        self.chunks.append(data)
+
+        if self.size > self.retention.max_bytes:
+            self.path = self.retention.spill_path(self.name)
+            self.fh = open(self.path, "wb")
+
+            for chunk in self.chunks:
+                self.fh.write(chunk)
+
+            # Only the head stays in memory from now on
+            head = "".join(self.chunks)[:self.retention.max_bytes]
+            self.chunks = [head]
+
+    def getvalue(self):
+        """
+        :return: CommandOutput, stripped. Spill file gets closed, nothing is to be written after this
+        """
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+            autopsy_logger.debug("Output of {0} bytes spilled to {1}".format(self.size, self.path))
+
+            # Head is cut at the limit, so only its start can be stripped
+            return CommandOutput("".join(self.chunks).lstrip(), size=self.size, path=self.path)
+
+        return CommandOutput("".join(self.chunks).strip(), size=self.size)
+
+
+class OutputRetention:
+    """ How much of a command's output is kept in memory. Outputs bigger than 'max_bytes' are
+    written to a file per command (and stream) under 'spill_dir', which by default is the
+    'outputs' directory in the archive of the run.
+    """
+    DEFAULT_MAX_BYTES = 1024 * 1024
+    SPILL_DIR = "outputs"
+
+    _sequence = itertools.count(1)
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, spill_dir=None):
+        """
+        :param max_bytes: Bytes of stdout (and of stderr) of a command to be held in memory
+        :param spill_dir: Directory for the spill files. Archive of the run if None, temp dir if there is
+                          no archive (e.g., when the libs are used outside autopsy.py)
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.lock = threading.Lock()
+
+    def get_spill_dir(self):
+        if self.spill_dir:
+            return self.spill_dir
+
+        if autopsy_globals.autopsy_logfile:
+            return os.path.join(autopsy_globals.autopsy_logfile, self.SPILL_DIR)
+
+        return os.path.join(tempfile.gettempdir(), "autopsy-" + self.SPILL_DIR)
+
+    def spill_path(self, name):
+        """
+        :param name: Something to recognise the command by, e.g., host and stream
+        :return: Path of a new spill file
+        """
+        directory = self.get_spill_dir()
+
+        with self.lock:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        return os.path.join(directory, "{0}_{1}_{2}.out".format(time.strftime("%Y%m%d-%H%M%S"),
+                                                                next(self._sequence),
+                                                                re.sub(r"[^\w.-]", "_", name)))
+
+    def collector(self, name):
+        return OutputCollector(self, name)
+
+    def collect(self, name, data):
+        """
+        :return: CommandOutput of the data already read in to memory
+        """
+        collector = self.collector(name)
+        collector.write(data)
+
+        return collector.getvalue()
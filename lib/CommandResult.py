@@ -0,0 +1,21 @@
+from collections import namedtuple
+
+__author__ = 'joshisk'
+
+
+class CommandResult(namedtuple("CommandResult", ["command", "output", "stderr", "exit_status", "duration",
+                                                   "timings"])):
+    """ Result of a command executed on a node.
+
+    output and stderr are stripped, duration is in seconds (None if it couldn't be measured)
+    and exit_status is -1 if the command didn't finish (e.g., connection broke in between).
+    timings is the dict of seconds spent in each phase (see CommandTiming), None if not measured.
+    """
+    __slots__ = ()
+
+    @property
+    def succeeded(self):
+        return self.exit_status == 0
+
+    def __str__(self):
+        return self.output
@@ -0,0 +1,270 @@
+#! /usr/bin/python -tt
+import bisect
+import heapq
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from lib.core import autopsy_globals
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+_LIB_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class CommandTiming:
+    """ Time taken by one command (or SFTP operation) on a node, split in to phases.
+
+        timing = CommandTiming(host, command)
+        with timing.phase("connect"):
+            ...
+        timing.add("prompt_wait", seconds)
+        timing.finish(exit_status)
+
+    Phases of execute: session_wait (for a free session slot), connect, channel_open, exec,
+    prompt_wait (sudo password and interactive inputs) and read, or session when it ran in the
+    persistent shell session. SFTP operations have session_wait, connect, sftp_open and operation.
+    """
+
+    def __init__(self, host, command, kind="exec"):
+        self.host = host
+        self.command = command
+        self.kind = kind
+        self.phases = {}
+        self.exit_status = None
+        self.start = time.time()
+        self.total = None
+        # Test running at the time and the RemoteNode method (or test function) which issued the command
+        self.test = getattr(autopsy_globals.current_test, "name", None)
+        self.caller = find_caller()
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def finish(self, exit_status=None):
+        """ Records the timing, only the first call counts """
+        if self.total is not None:
+            return
+
+        if exit_status is not None:
+            self.exit_status = exit_status
+        self.total = time.time() - self.start
+        get_recorder().record(self)
+
+    def to_json(self):
+        return {"host": self.host,
+                "command": self.command,
+                "kind": self.kind,
+                "test": self.test,
+                "caller": self.caller,
+                "exit_status": self.exit_status,
+                "started": self.start,
+                "total": round(self.total, 6),
+                "phases": dict((phase, round(seconds, 6)) for phase, seconds in self.phases.items())}
+
+
+class _Phase:
+    def __init__(self, timing, name):
+        self.timing = timing
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.timing.add(self.name, time.time() - self.start)
+
+
+def find_caller():
+    """
+    :return: Name of the outermost RemoteNode method (Class.method, for subclasses too) the command was issued
+             from, e.g., RemoteNode.reboot rather than the RemoteNode.execute called by it. Name of the first
+             function outside the framework libs if it wasn't issued from a RemoteNode method.
+    """
+    frame = sys._getframe(2)
+    method = None
+
+    while frame:
+        code = frame.f_code
+        instance = frame.f_locals.get("self")
+        name = code.co_name
+
+        # Wrapper of the RemoteNode decorators, the method is yet to be called from it
+        if name == "new_func":
+            func = frame.f_locals.get("func")
+            name = getattr(func, "__name__", None)
+
+        if instance is not None and name \
+                and any(klass.__name__ == "RemoteNode" for klass in type(instance).__mro__):
+            method = type(instance).__name__ + "." + name
+        elif not os.path.abspath(code.co_filename).startswith(_LIB_DIR):
+            return method if method else code.co_name
+
+        frame = frame.f_back
+
+    return method
+
+
+class Histogram:
+    """ Counts of durations in buckets of fixed bounds (seconds) """
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """
+        :return: Upper bound of the bucket the percentile falls in (max seen, for the last bucket)
+        """
+        if not self.count:
+            return 0.0
+
+        target = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+
+        return self.max
+
+    def to_json(self):
+        return {"count": self.count,
+                "sum": round(self.sum, 6),
+                "avg": round(self.sum / self.count, 6) if self.count else 0.0,
+                "max": round(self.max, 6),
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "buckets": dict(("<=" + str(bound), count) for bound, count in zip(self.BOUNDS, self.counts)
+                                if count),
+                "overflow": self.counts[-1]}
+
+
+class TimingRecorder:
+    """ Aggregates the timings of all the commands of the run: histograms of every phase (overall and per
+    host/caller/test) and the most expensive commands. Individual timings beyond the top ones are not kept,
+    so memory doesn't grow with the length of the run.
+    """
+    TOP = 50
+    REPORT_FILE = "ssh_timings.json"
+
+    def __init__(self, top=TOP):
+        self.top = top
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.by_host = {}
+            self.by_caller = {}
+            self.by_test = {}
+            self.slowest = []
+            self._sequence = itertools.count()
+
+    @staticmethod
+    def _add(table, key, timing):
+        histograms = table.setdefault(key, {})
+        histograms.setdefault("total", Histogram()).add(timing.total)
+
+        for phase, seconds in timing.phases.items():
+            histograms.setdefault(phase, Histogram()).add(seconds)
+
+    def record(self, timing):
+        with self.lock:
+            self._add(self.histograms, timing.kind, timing)
+            self._add(self.by_host, timing.host, timing)
+            self._add(self.by_caller, str(timing.caller), timing)
+            self._add(self.by_test, str(timing.test), timing)
+
+            entry = (timing.total, next(self._sequence), timing)
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, entry)
+            elif timing.total > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def get_slowest(self):
+        with self.lock:
+            return [timing for _, _, timing in sorted(self.slowest, reverse=True)]
+
+    @staticmethod
+    def _table_json(table):
+        return dict((key, dict((phase, histogram.to_json()) for phase, histogram in histograms.items()))
+                    for key, histograms in table.items())
+
+    def to_json(self):
+        slowest = self.get_slowest()
+
+        with self.lock:
+            return {"phases": self._table_json(self.histograms),
+                    "hosts": self._table_json(self.by_host),
+                    "callers": self._table_json(self.by_caller),
+                    "tests": self._table_json(self.by_test),
+                    "slowest": [timing.to_json() for timing in slowest]}
+
+    def log_slowest(self):
+        slowest = self.get_slowest()
+        if not slowest:
+            return
+
+        phases = ("session_wait", "connect", "session", "channel_open", "sftp_open", "exec", "prompt_wait",
+                  "read", "operation")
+        shown = [phase for phase in phases if any(phase in timing.phases for timing in slowest)]
+
+        autopsy_logger.info("Top {0} most expensive SSH commands (seconds):".format(len(slowest)))
+        autopsy_logger.info("{0:>8} ".format("Total") + " ".join("{0:>12}".format(phase) for phase in shown) +
+                            "  {0:<12} {1:<30} {2:<24} {3}".format("Host", "Caller", "Test", "Command"))
+
+        for timing in slowest:
+            autopsy_logger.info("{0:>8.3f} ".format(timing.total) +
+                                " ".join("{0:>12.3f}".format(timing.phases[phase]) if phase in timing.phases
+                                         else "{0:>12}".format("-") for phase in shown) +
+                                "  {0:<12} {1:<30} {2:<24} {3}".format(timing.host, timing.caller, timing.test,
+                                                                      timing.command[:100]))
+
+    def write_report(self, directory):
+        """
+        Writes the JSON dump in to the directory (archive of the run) and logs the top commands table
+        :return: Path of the JSON file
+        """
+        path = os.path.join(directory, self.REPORT_FILE)
+
+        try:
+            with open(path, "w") as fh:
+                json.dump(self.to_json(), fh, indent=2)
+        except IOError as e:
+            autopsy_logger.error("Couldn't write SSH timings: " + str(e))
+            return None
+
+        self.log_slowest()
+        return path
+
+
+_recorder = TimingRecorder()
+
+
+def get_recorder():
+    """
+    :return: TimingRecorder of the process
+    """
+    return _recorder
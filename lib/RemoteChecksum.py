@@ -0,0 +1,154 @@
+#! /usr/bin/python -tt
+import hashlib
+import pipes
+import re
+
+from lib.core.autopsy_globals import autopsy_logger
+
+try:
+    import xxhash
+except ImportError:
+    # Optional, only needed to hash with xxhash on this side
+    xxhash = None
+
+__author__ = 'joshisk'
+
+
+# Algorithm to the command hashing with it on the node, all of them print "<digest>  <path>" lines
+ALGORITHMS = {"md5": "md5sum",
+              "sha1": "sha1sum",
+              "sha256": "sha256sum",
+              "xxhash": "xxh64sum"}
+
+_DIGEST_LENGTHS = {"md5": 32, "sha1": 40, "sha256": 64, "xxhash": 16}
+
+
+def new_hash(algorithm):
+    """
+    :return: hashlib like object of the algorithm, to hash the data on this side
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError("Unknown hash algorithm '{0}', can be one of {1}".format(algorithm, sorted(ALGORITHMS)))
+
+    if algorithm == "xxhash":
+        if xxhash is None:
+            raise ValueError("xxhash module is not installed, use 'pip install xxhash'")
+        return xxhash.xxh64()
+
+    return hashlib.new(algorithm)
+
+
+def hash_file(path, algorithm="md5"):
+    """
+    :return: Hex digest of the local file
+    """
+    digest = new_hash(algorithm)
+
+    with open(path, "rb") as fh:
+        for data in iter(lambda: fh.read(1024 * 1024), ""):
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+class RemoteChecksum:
+    """ Hashes files on the node, many of them in a single command with several hashing
+    processes at once (xargs -P), rather than a command for every file.
+
+        checksums = RemoteChecksum(node.ssh_client, algorithm="sha256").checksum_many(paths)
+
+    xxhash needs xxh64sum on the node (and the xxhash module here, to compare with local files).
+    """
+    # Hashing processes running at once on the node
+    PARALLEL = 4
+    # Files given to one hashing process at most, smaller groups spread the work better across them
+    FILES_PER_PROCESS = 100
+    # Characters of (quoted) paths in one command
+    MAX_COMMAND = 64 * 1024
+    TIMEOUT = 3600
+
+    def __init__(self, handle, algorithm="md5", parallel=PARALLEL, timeout=TIMEOUT):
+        """
+        :param handle: SSHHandle of the node
+        :param algorithm: md5, sha1, sha256 or xxhash
+        :param parallel: Hashing processes running at once on the node
+        :param timeout: Seconds a command (of up to MAX_COMMAND characters of paths) can take
+        """
+        if algorithm not in ALGORITHMS:
+            raise ValueError("Unknown hash algorithm '{0}', can be one of {1}".format(algorithm, sorted(ALGORITHMS)))
+
+        self.handle = handle
+        self.algorithm = algorithm
+        self.parallel = max(1, parallel)
+        self.timeout = timeout
+        self.line_re = re.compile(r"^\\?([0-9a-f]{%d})  (.*)$" % _DIGEST_LENGTHS[algorithm])
+
+    def checksum(self, path):
+        """
+        :return: Hex digest of the remote file, None if it couldn't be hashed
+        """
+        return self.checksum_many([path])[path]
+
+    def checksum_many(self, paths):
+        """
+        :param paths: Remote paths of the files
+        :return: Dict of path to hex digest, None for the ones which couldn't be hashed (missing, not readable)
+        """
+        checksums = dict((path, None) for path in paths)
+
+        for batch in self._batches(sorted(checksums)):
+            checksums.update(self._checksum_batch(batch))
+
+        return checksums
+
+    def _batches(self, paths):
+        batch = []
+        length = 0
+
+        for path in paths:
+            if batch and length + len(path) > self.MAX_COMMAND:
+                yield batch
+                batch = []
+                length = 0
+
+            batch.append(path)
+            length += len(path) + 3
+
+        if batch:
+            yield batch
+
+    def _checksum_batch(self, paths):
+        command = ALGORITHMS[self.algorithm]
+        per_process = max(1, min(self.FILES_PER_PROCESS, -(-len(paths) // self.parallel)))
+
+        # Line buffered (stdbuf), so that lines of the processes writing at once aren't mixed up
+        result = self.handle.execute_result(
+            "command -v {0} >/dev/null || exit 127; command -v stdbuf >/dev/null && L='stdbuf -oL'; "
+            "printf '%s\\0' {1} | xargs -0 -n {2} -P {3} $L {0} -- 2>/dev/null"
+            .format(command, " ".join(pipes.quote(path) for path in paths), per_process, self.parallel),
+            timeout=self.timeout, quiet=True)
+
+        if result.exit_status == 127:
+            raise IOError("{0} is not there on the node, can't hash with {1}".format(command, self.algorithm))
+
+        checksums = {}
+        requested = set(paths)
+
+        for line in result.output.lines():
+            match = self.line_re.match(line)
+            if not match:
+                continue
+
+            path = match.group(2)
+            # Names with a backslash or new line are escaped, and the line starts with a backslash
+            if line.startswith("\\"):
+                path = path.replace("\\\\", "\0").replace("\\n", "\n").replace("\0", "\\")
+
+            if path in requested:
+                checksums[path] = match.group(1)
+
+        missing = len(requested) - len(checksums)
+        if missing:
+            autopsy_logger.debug("{0} of {1} files couldn't be hashed".format(missing, len(paths)))
+
+        return checksums
@@ -1,17 +1,27 @@
 #! /usr/bin/python -tt
+import fnmatch
 import os
+import pipes
+import posixpath
 import random
 import re
 import socket
 import stat
 import time
 
-from expiringdict import ExpiringDict
 from paramiko.ssh_exception import SSHException
 
-from lib.SSHHandle import SSHHandle
+from lib.CommandOutput import OutputRetention
+from lib.RemoteChecksum import RemoteChecksum
+from lib.SSHAsync import get_engine
+from lib.SFTPSync import SFTPSync, SyncManifest
+from lib.SFTPTransfer import SFTPTransfer, stat_many, walk_local
+from lib.SSHHandle import SSHHandle, SFTPClientPool
+from lib.TarTransfer import TarTransfer
 from lib.commons import Utilities
-from lib.commons.Utilities import waitOnProcCondition, synchronized_block
+from lib.commons.ExpiringLRUCache import ExpiringLRUCache
+from lib.commons.RetryPolicy import RetryPolicy
+from lib.commons.Utilities import waitOnProcCondition
 from lib.commons.tc_netem import generate_tc_cmd
 from lib.core.autopsy_globals import autopsy_logger
 
@@ -43,7 +53,8 @@ def with_sftp_connection(func):
     """
 
     def new_func(self, *args, **kwds):
-        with self.ssh_client.get_sftp_connection() as sftp:
+        # First argument is the path in all of them, rest may be the whole content of a file
+        with self.ssh_client.get_sftp_connection(label=func.__name__ + (" " + str(args[0]) if args else "")) as sftp:
             return func(self, sftp, *args, **kwds)
 
     return new_func
@@ -53,10 +64,15 @@ class RemoteNode(object):
     """ Linux Node.
     Not tested with any other operating system and I am sure it won't work.
     """
+    STAT_CACHE_SIZE = 1024
+    STAT_CACHE_TTL = 60
 
     def __init__(self, hostname, ipAddress,
                  username='ubuntu', password=None, pkeyFile=None, alias=None,
-                 ssh_port=SSHHandle.SSH_PORT):
+                 ssh_port=SSHHandle.SSH_PORT, persistent_session=False, privileged_session=False, pool_size=1,
+                 ssh_tuning=None, output_max_bytes=OutputRetention.DEFAULT_MAX_BYTES,
+                 sftp_pool_size=SFTPClientPool.DEFAULT_SIZE, stat_cache_size=STAT_CACHE_SIZE,
+                 stat_cache_ttl=STAT_CACHE_TTL):
 
         self.hostname = hostname
         self.ipAddress = ipAddress
@@ -64,11 +80,10 @@ class RemoteNode(object):
         self.password = None
         self.pkeyFile = None
 
-        # To Identify a file in the node is a directory or cache we call isDirectory API.
-        # But as this operation is required everytime we create a job as create job api requires this flag
-        #   we can have a cached entry instead of getting it from SSH always. And for parallel jobs it fails
-        #   as SSH Server may not allow that many parallel connections. And using locks make them not parallel
-        self.is_dir_file_cache = ExpiringDict(max_len=30, max_age_seconds=1 * 60)
+        # Attributes of the remote paths, so that isDirectory (required every time a job is created) and stat
+        #   don't have to go to the node every time. Every stat done refreshes it and the helpers changing
+        #   files on the node invalidate it, changes made by anything else show up only after the TTL
+        self.stat_cache = ExpiringLRUCache(max_len=stat_cache_size, max_age_seconds=stat_cache_ttl)
 
         # Making sure username is atleast 'ubuntu' as for the cloud machines it is mandatory
         #   to have username else it will not connect
@@ -94,7 +109,14 @@ class RemoteNode(object):
             self.pkeyFile = pkeyFile
 
         self.ssh_client = SSHHandle(host=self.ipAddress, user=self.username, password=self.password,
-                                    pkey_file=self.pkeyFile, hostname=self.hostname, port=ssh_port)
+                                    pkey_file=self.pkeyFile, hostname=self.hostname, port=ssh_port,
+                                    persistent_session=persistent_session,
+                                    privileged_session=privileged_session, pool_size=pool_size,
+                                    tuning=ssh_tuning, output_retention=OutputRetention(max_bytes=output_max_bytes),
+                                    sftp_pool_size=sftp_pool_size)
+
+        # What was synced to the node by the earlier runs, see sync()
+        self.sync_manifest = SyncManifest("{0}@{1}_{2}".format(self.username, self.ipAddress, ssh_port))
 
     def __str__(self):
         return "Hostname: " + self.hostname + \
@@ -109,6 +131,42 @@ class RemoteNode(object):
         if self.ssh_client:
             self.ssh_client.disconnect()
 
+    def get_liveness_stats(self):
+        return self.ssh_client.get_liveness_stats()
+
+    def get_pool_stats(self):
+        return self.ssh_client.get_pool_stats()
+
+    def get_sftp_pool_stats(self):
+        return self.ssh_client.get_sftp_pool_stats()
+
+    def get_circuit_stats(self):
+        return self.ssh_client.breaker.stats()
+
+    def measure_ssh_throughput(self, tunings=None, size_mb=16, compressible=False):
+        """
+        Measures the effect of the SSH tuning of this node on throughput of command output and SFTP,
+        and logs a table of it
+
+        :param tunings: List of (name, SSHTuning) to compare. By default, paramiko defaults, each setting of
+                        the node's 'ssh_tuning' on its own, and all of them together
+        :param size_mb: MBs to be moved each way per tuning
+        :param compressible: Zeros instead of random data, to see what compression does for text like outputs
+        :return: List of dicts, see SSHHandle.measure_throughput
+        """
+        results = self.ssh_client.measure_throughput(tunings, size=size_mb * 1024 * 1024, compressible=compressible)
+
+        autopsy_logger.info("SSH throughput of {0} ({1} MB, {2} data), MB/s:".format(
+            self.alias, size_mb, "compressible" if compressible else "random"))
+        autopsy_logger.info("{0:<16} {1:>8} {2:>8} {3:>8} {4:>9}  {5}".format("Name", "exec", "sftp_get", "sftp_put",
+                                                                            "connect", "Settings"))
+        for result in results:
+            autopsy_logger.info("{0:<16} {1:>8.2f} {2:>8.2f} {3:>8.2f} {4:>8.2f}s  {5}".format(
+                result["name"], result["exec"], result["sftp_get"], result["sftp_put"], result["connect"],
+                result["tuning"]))
+
+        return results
+
     def execute_async(self, commands=None, timeout=SSHHandle.EXEC_TIMEOUT):
         """
         This API allows to open a shell to the server and execute all the 'commands' to be run in background
@@ -140,76 +198,244 @@ class RemoteNode(object):
 
         self.ssh_client.disconnect()
 
+    def execute(self, command, input=None, timeout=SSHHandle.EXEC_TIMEOUT, quiet=False, sudo=False,
+                prompt_timeout=SSHHandle.PROMPT_TIMEOUT):
+        """
+        Same as execute_result, but gives out only the output. Exit status is left in exit_status_last_command,
+        which is not reliable when the node is used from more than one thread.
+        """
+        try:
+            result = self.execute_result(command, input=input, timeout=timeout, quiet=quiet, sudo=sudo,
+                                         prompt_timeout=prompt_timeout)
+        except socket.timeout:
+            self.exit_status_last_command = -1
+            raise
+
+        self.exit_status_last_command = result.exit_status
+
+        # Already stripped, and a spilled output is to be given out as is to keep its path
+        return result.output
+
     @on_active_connection
-    def execute(self, command, input=None, timeout=SSHHandle.EXEC_TIMEOUT, quiet=False, sudo=False):
+    def execute_result(self, command, input=None, timeout=SSHHandle.EXEC_TIMEOUT, quiet=False, sudo=False,
+                       prompt_timeout=SSHHandle.PROMPT_TIMEOUT):
+        """
+        Executes the command. Safe to be called from many threads on the same node at once.
 
+            result = node.execute_result("ls /tmp")
+            if result.succeeded:
+                print result.output
+
+        :param command: Command to execute. Commands starting with 'sudo ' are executed with sudo
+        :param input: List of inputs to the interactive prompts of the command, in the order they show up
+        :param timeout:
+        :param quiet:
+        :param sudo:
+        :param prompt_timeout: Seconds to wait for each prompt to show up before sending the input anyway
+        :return: CommandResult (output, stderr, exit_status, duration, timings)
+        """
         if input is None:
             input = []
 
         try:
-            output = self.ssh_client.execute(command, inputValues=input, timeout=timeout,
-                                             quiet=quiet, sudo=sudo)
-            self.exit_status_last_command = self.ssh_client.exit_status_last_command
-
-            return output.strip()
+            return self.ssh_client.execute_result(command, inputValues=input, timeout=timeout,
+                                                  quiet=quiet, sudo=sudo, prompt_timeout=prompt_timeout)
         except socket.timeout as e:
             autopsy_logger.exception("Timed out executing the command: " + command)
-            self.exit_status_last_command = -1
             raise e
 
+    @on_active_connection
+    def execute_batch(self, commands, stop_on_failure=False, timeout=SSHHandle.EXEC_TIMEOUT, quiet=False,
+                      sudo=False):
+        """
+        Executes all the commands in one go, instead of paying a round trip per command
+
+        :param commands: List of commands. Commands starting with 'sudo ' are executed with sudo
+        :param stop_on_failure: Don't execute the rest of the commands once a command fails
+        :param timeout:
+        :param quiet:
+        :param sudo: To execute all the commands with sudo
+        :return: List of CommandResult (output, stderr, exit_status, duration) for each command executed
+        """
+        results = self.ssh_client.execute_batch(commands, stop_on_failure=stop_on_failure, timeout=timeout,
+                                                quiet=quiet, sudo=sudo)
+        if results:
+            self.exit_status_last_command = results[-1].exit_status
+
+        return results
+
+    def run(self, command, sudo=False, timeout=SSHHandle.EXEC_TIMEOUT):
+        """
+        Executes the command without blocking the caller. Output is read along with that of all the other
+        commands in flight by a single thread, so hundreds of nodes can be driven at once.
+
+            futures = [node.run("uptime") for node in testbed.host]
+            results = gather(futures)
+
+        :param command: Command to execute. Commands starting with 'sudo ' are executed with sudo
+        :param sudo: To execute the command with sudo
+        :param timeout: Seconds without any output after which the command is given up
+        :return: CommandFuture, result of which is the CommandResult of the command
+        """
+        return get_engine().submit(self.ssh_client, command, sudo=sudo, timeout=timeout)
+
+    @on_active_connection
+    def execute_iter(self, command, timeout=SSHHandle.EXEC_TIMEOUT, quiet=False, sudo=False):
+        """
+        Executes the command and yields its output lines as they arrive, so that huge outputs
+        are never held in memory. stderr is merged in to the output.
+
+            with node.execute_iter("sudo cat /var/log/syslog") as stream:
+                for line in stream:
+                    if "panic" in line:
+                        break
+
+        :param command: Command to execute. Command starting with 'sudo ' is executed with sudo
+        :param timeout: Timeout if there is no output from the command for this long
+        :param quiet:
+        :param sudo:
+        :return: CommandStream, iterable over lines. Its chunks() gives raw chunks and its exit_status
+                 is set once the command finishes
+        """
+        return self.ssh_client.execute_iter(command, timeout=timeout, quiet=quiet, sudo=sudo)
+
+    def stat(self, path, fresh=False):
+        """
+        :param path: Remote path
+        :param fresh: To skip the cached entry and get the data fresh
+        :return: SFTPAttributes of the path, IOError is raised if it is not there
+        """
+        if not fresh:
+            attributes = self.stat_cache.get(path)
+            if attributes is not None:
+                return attributes
+
+        return self._stat(path)
+
     @with_sftp_connection
-    def isFileExists(self, sftp, f):
+    def _stat(self, sftp, path):
+        try:
+            attributes = sftp.stat(path)
+        except IOError:
+            self.stat_cache.pop(path)
+            raise
+
+        self.stat_cache.set(path, attributes)
+        return attributes
+
+    def invalidate_stat_cache(self, *paths):
+        """
+        Drops the cached attributes of the paths (glob patterns too), of everything under them and of their
+        parent directories. Everything if no path is given.
+        To be called after changing files on the node by other means than the helpers of this class
+        """
+        if not paths:
+            self.stat_cache.clear()
+            return
+
+        for path in paths:
+            path = path.rstrip("/") or "/"
+            parent = posixpath.dirname(path)
+
+            self.stat_cache.remove_if(lambda key: key == parent or fnmatch.fnmatch(key, path) or
+                                      fnmatch.fnmatch(key, path + "/*"))
+
+    def get_stat_cache_stats(self):
+        """
+        :return: Entries in the stat cache, and the counts of hits, misses, evictions, expirations and invalidations
+        """
+        return self.stat_cache.stats()
+
+    def isFileExists(self, f):
         try:
-            sftp.stat(f)
+            self.stat(f, fresh=True)
             return True
         except IOError:
             return False
 
-    @with_sftp_connection
-    def isDirectory(self, sftp, f, fresh=False):
+    def isDirectory(self, f, fresh=False):
         """
         :param f: File/Directory to ascertain
-        :param fresh: To invalidate any cached entry and get the data fresh
+        :param fresh: To skip any cached entry and get the data fresh
         :return:
         """
-        with synchronized_block(self):
-            if not fresh:
-                if f in self.is_dir_file_cache:
-                    return self.is_dir_file_cache[f]
-
         try:
-            s = sftp.stat(f)
-            value = stat.S_ISDIR(s.st_mode)
-            self.is_dir_file_cache[f] = value
-            return value
+            return stat.S_ISDIR(self.stat(f, fresh=fresh).st_mode)
         except IOError:
             return False
 
-    @with_sftp_connection
-    def get_file_size(self, sftp, filename):
+    def get_file_size(self, filename):
         """ Get File size in bytes
         :param filename:
         :return:
         """
-        info = sftp.stat(filename)
-        return info.st_size
+        return self.stat(filename, fresh=True).st_size
 
-    @with_sftp_connection
-    def get_file_m_time(self, sftp, filename):
+    def get_file_m_time(self, filename):
         """ Get modify time of file, if present in the filesystem
         :param filename:
         :return:
         """
-        info = sftp.stat(filename)
-        return info.st_mtime
+        return self.stat(filename, fresh=True).st_mtime
+
+    @on_active_connection
+    def stat_many(self, paths, lstat=False, fresh=True):
+        """
+        Stats all the paths over one SFTP channel, with many requests in flight at once
+
+            attributes = node.stat_many(files)
+            missing = [f for f in files if attributes[f] is None]
+
+        :param paths: List of remote paths
+        :param lstat: Attributes of the symbolic links themselves, rather than of what they point to
+        :param fresh: False to take the cached attributes of the paths which have them
+        :return: Dict of path to SFTPAttributes, None for the paths which are not there (or can't be stat'ed)
+        """
+        attributes = {}
+
+        if not fresh and not lstat:
+            for path in paths:
+                cached = self.stat_cache.get(path)
+                if cached is not None:
+                    attributes[path] = cached
+
+        remaining = [path for path in paths if path not in attributes]
+        if not remaining:
+            return attributes
+
+        with self.ssh_client.get_sftp_connection(label="stat_many {0} paths".format(len(remaining))) as sftp:
+            fetched = stat_many(sftp, remaining, lstat=lstat)
+
+        if not lstat:
+            for path, value in fetched.items():
+                if value is None:
+                    self.stat_cache.pop(path)
+                else:
+                    self.stat_cache.set(path, value)
+
+        attributes.update(fetched)
+        return attributes
 
     @with_sftp_connection
-    def getFilesInDir(self, sftp, dir, pattern=None):
+    def getFilesInDir(self, sftp, dir, pattern=None, attributes=False):
         """  Get all files in the given directory. Files with matching pattern if not 'None'
         :param dir:
         :param pattern: Pattern is just a substring as of now
+        :param attributes: To get the SFTPAttributes (name in 'filename') of the files, read along with the names
         :return: List of files present matching with the given pattern
         """
+        if attributes:
+            output = sftp.listdir_attr(dir + "/")
+            if pattern is not None:
+                output = [item for item in output if pattern in item.filename]
+
+            # Links are listed with their own attributes, cache has the ones of what they point to
+            for item in output:
+                if not stat.S_ISLNK(item.st_mode):
+                    self.stat_cache.set(posixpath.join(dir, item.filename), item)
+
+            return output
+
         output = sftp.listdir(dir + "/")
         if pattern is not None:
             output = [item for item in output if pattern in item]
@@ -243,6 +469,7 @@ class RemoteNode(object):
         finally:
             if sftpFile:
                 sftpFile.close()
+            self.invalidate_stat_cache(filePath)
 
         return False
 
@@ -259,59 +486,211 @@ class RemoteNode(object):
         finally:
             if sftpFile:
                 sftpFile.close()
+            self.invalidate_stat_cache(filePath)
 
         return False
 
+    def uploadFile(self, localFile, remoteFile, channels=1, resume=False, verify=SFTPTransfer.VERIFY_SIZE):
+        """
+        :return: True if uploaded, False if the arguments are not right. IOError is raised if the upload failed
+        """
+        return self.upload_file_result(localFile, remoteFile, channels=channels, resume=resume,
+                                       verify=verify) is not None
+
     @on_active_connection
-    def uploadFile(self, localFile, remoteFile):
+    def upload_file_result(self, localFile, remoteFile, channels=1, resume=False, verify=SFTPTransfer.VERIFY_SIZE):
+        """
+        Uploads the file with many chunks in flight at once (see SFTPTransfer)
+
+        :param localFile:
+        :param remoteFile: Name of the local file in the home directory if None
+        :param channels: SFTP channels the file is split across, for big files on links with high latency
+        :param resume: Continue from the partial remote file left by an earlier upload
+        :param verify: SFTPTransfer.VERIFY_SIZE, or a hash: SFTPTransfer.VERIFY_MD5, VERIFY_SHA1, VERIFY_SHA256
+                       or VERIFY_XXHASH (computed while uploading, compared with the hash on the node)
+        :return: TransferResult (throughput and checksum included), None if the arguments are not right
+        """
         if not localFile:
             autopsy_logger.error("LocalFile can't be empty/None")
-            return False
+            return None
 
         if not os.path.basename(localFile):
-            autopsy_logger.error("Directory upload is not supported.")
-            return False
+            autopsy_logger.error("Directory upload is not supported, use uploadDir.")
+            return None
 
         if not remoteFile:
             remoteFile = os.path.basename(localFile)
 
-        with self.ssh_client.get_sftp_connection() as sftp:
-            try:
-                sftp.put(localFile, remoteFile)
-                return True
-            except IOError as e:
-                autopsy_logger.exception("Couldn't upload file: Local - {0}, Remote - {1}".format(localFile, remoteFile))
-                raise e
+        try:
+            return SFTPTransfer(self.ssh_client, channels=channels, verify=verify).upload(localFile, remoteFile,
+                                                                                        resume=resume)
+        except IOError as e:
+            autopsy_logger.exception("Couldn't upload file: Local - {0}, Remote - {1}".format(localFile, remoteFile))
+            raise e
+        finally:
+            self.invalidate_stat_cache(remoteFile)
+
+    def downloadFile(self, remoteFile, localFile, channels=1, resume=False, verify=SFTPTransfer.VERIFY_SIZE):
+        """
+        :return: True if downloaded
+        """
+        return self.download_file_result(remoteFile, localFile, channels=channels, resume=resume,
+                                         verify=verify) is not None
 
     @on_active_connection
-    def downloadFile(self, remoteFile, localFile):
+    def download_file_result(self, remoteFile, localFile, channels=1, resume=False, verify=SFTPTransfer.VERIFY_SIZE):
+        """
+        Downloads the file with many chunks in flight at once (see SFTPTransfer)
+
+        :param remoteFile:
+        :param localFile: Name of the remote file in the current directory if None
+        :param channels: SFTP channels the file is split across, for big files on links with high latency
+        :param resume: Continue from the partial local file left by an earlier download
+        :param verify: SFTPTransfer.VERIFY_SIZE, or a hash: SFTPTransfer.VERIFY_MD5, VERIFY_SHA1, VERIFY_SHA256
+                       or VERIFY_XXHASH (computed while downloading, compared with the hash on the node)
+        :return: TransferResult (throughput and checksum included), None if it couldn't be downloaded
+        """
         if not remoteFile:
             autopsy_logger.error("RemoteFile can't be empty/None.")
-            return False
+            return None
 
         if not os.path.basename(remoteFile):
-            autopsy_logger.error("Directory download is not supported.")
-            return False
+            autopsy_logger.error("Directory download is not supported, use downloadDir.")
+            return None
 
         if not localFile:
             localFile = os.path.basename(remoteFile)
 
-        with self.ssh_client.get_sftp_connection() as sftp:
-            try:
-                sftp.get(remoteFile, localFile)
-                return True
-            except IOError as e:
-                autopsy_logger.exception("Couldn't Download file: Local - {0}, "
-                                       "Remote - {1}".format(localFile, remoteFile))
+        try:
+            return SFTPTransfer(self.ssh_client, channels=channels, verify=verify).download(remoteFile, localFile,
+                                                                                          resume=resume)
+        except IOError as e:
+            autopsy_logger.exception("Couldn't Download file: Local - {0}, "
+                                     "Remote - {1}".format(localFile, remoteFile))
+
+    @on_active_connection
+    def uploadDir(self, localDir, remoteDir, include=None, exclude=None, workers=SFTPTransfer.WORKERS,
+                  preserve=True, verify=SFTPTransfer.VERIFY_SIZE, tar=None, compress=False):
+        """
+        Uploads the directory tree, many files at once over pooled SFTP channels, or as one tar stream
+        when there are many small files (see TarTransfer)
+
+            node.uploadDir("build", "/opt/app", exclude=["*.pyc", ".git"])
+
+        :param localDir:
+        :param remoteDir: Created, along with its parents, if it is not there
+        :param include: Glob pattern(s), only the files matching one of them are uploaded
+        :param exclude: Glob pattern(s) of the files and directories to be left out
+        :param workers: Files uploaded at once
+        :param preserve: Keep the permissions and modification times
+        :param verify: SFTPTransfer.VERIFY_SIZE or a hash (VERIFY_MD5, ...), for every file (SFTP only)
+        :param tar: True to stream it as tar, False to use SFTP, None to pick by the number and size of files
+        :param compress: To gzip the tar stream
+        :return: DirTransferResult (files, bytes, throughput and the files that failed), None if the
+                 local directory is not there
+        """
+        if not localDir or not os.path.isdir(localDir):
+            autopsy_logger.error("Not a directory: {0}".format(localDir))
+            return None
+
+        if tar is None:
+            _, files = walk_local(localDir, include, exclude)
+            tar = TarTransfer.is_better_for(len(files), sum(attributes.st_size for _, attributes in files))
+
+        transfer = TarTransfer(self.ssh_client, compress=compress) if tar else SFTPTransfer(self.ssh_client,
+                                                                                           verify=verify)
+
+        try:
+            return transfer.upload_dir(localDir, remoteDir, include=include, exclude=exclude, workers=workers,
+                                       preserve=preserve)
+        finally:
+            self.invalidate_stat_cache(remoteDir)
+
+    @on_active_connection
+    def downloadDir(self, remoteDir, localDir, include=None, exclude=None, workers=SFTPTransfer.WORKERS,
+                    preserve=True, verify=SFTPTransfer.VERIFY_SIZE, tar=None, compress=False):
+        """
+        Downloads the directory tree, many files at once over pooled SFTP channels, or as one tar stream
+        when there are many small files (see TarTransfer)
+
+        :param remoteDir:
+        :param localDir: Created, along with its parents, if it is not there
+        :param include: Glob pattern(s), only the files matching one of them are downloaded
+        :param exclude: Glob pattern(s) of the files and directories to be left out
+        :param workers: Files downloaded at once
+        :param preserve: Keep the permissions and modification times
+        :param verify: SFTPTransfer.VERIFY_SIZE or a hash (VERIFY_MD5, ...), for every file (SFTP only)
+        :param tar: True to stream it as tar, False to use SFTP, None to pick by the number and size of files
+        :param compress: To gzip the tar stream
+        :return: DirTransferResult (files, bytes, throughput and the files that failed), None if the
+                 remote directory couldn't be read
+        """
+        if tar is None:
+            # Count and size of all the files under it, in one command rather than walking it over SFTP
+            result = self.execute_result("find {0} -type f -printf '%s\\n' | awk '{{n++; s+=$1}} END {{print n+0, s+0}}'"
+                                         .format(pipes.quote(remoteDir)), quiet=True)
+            counts = result.output.split()
+            tar = len(counts) == 2 and TarTransfer.is_better_for(int(counts[0]), int(counts[1]))
+
+        transfer = TarTransfer(self.ssh_client, compress=compress) if tar else SFTPTransfer(self.ssh_client,
+                                                                                           verify=verify)
+
+        try:
+            return transfer.download_dir(remoteDir, localDir, include=include, exclude=exclude, workers=workers,
+                                         preserve=preserve)
+        except IOError as e:
+            autopsy_logger.exception("Couldn't download directory: Local - {0}, Remote - {1}".format(localDir,
+                                                                                                   remoteDir))
+
+    @on_active_connection
+    def sync(self, local, remote, include=None, exclude=None, checksum=False, delta=False,
+             workers=SFTPTransfer.WORKERS):
+        """
+        Uploads only what has changed since the last sync to the node (see SFTPSync)
+
+            node.sync("build/bin", "/opt/app/bin", exclude="*.debug")
+
+        :param local: File or directory
+        :param remote: Remote file or directory
+        :param include: Glob pattern(s), only the files matching one of them are synced
+        :param exclude: Glob pattern(s) of the files and directories to be left out
+        :param checksum: Compare the files by md5 rather than by modification time
+        :param delta: Send only the changed blocks of big files, needs python on the node
+        :param workers: Files uploaded at once
+        :return: SyncResult (files transferred and the bytes saved against a full upload), None if the local
+                 file is not there
+        """
+        if not local or not os.path.exists(local):
+            autopsy_logger.error("No such file or directory: {0}".format(local))
+            return None
+
+        try:
+            return SFTPSync(self.ssh_client, self.sync_manifest, checksum=checksum, delta=delta).sync(
+                local, remote, include=include, exclude=exclude, workers=workers)
+        finally:
+            self.invalidate_stat_cache(remote)
 
-    def get_file_checksum(self, filename):
+    def get_file_checksum(self, filename, algorithm="md5"):
         """
-        Get md5 check sum of the file
+        Get check sum of the file
         :param filename:
+        :param algorithm: md5, sha1, sha256 or xxhash (needs xxh64sum on the node)
+        :return: Hex digest, None if the file couldn't be hashed
+        """
+        return RemoteChecksum(self.ssh_client, algorithm).checksum(filename)
+
+    def get_file_checksums(self, filenames, algorithm="md5", parallel=RemoteChecksum.PARALLEL):
         """
-        # Escape for any special characters
-        filename = "\'" + filename + "\'"
-        return self.execute("md5sum " + filename + "  | awk '{print $1}'", timeout=3600, quiet=True)
+        Check sums of many files, hashed by one command on the node with 'parallel' processes at once
+
+            checksums = node.get_file_checksums(["/var/log/a.log", "/var/log/b.log"], algorithm="sha256")
+
+        :param filenames: List of paths
+        :param algorithm: md5, sha1, sha256 or xxhash (needs xxh64sum on the node)
+        :param parallel: Hashing processes running at once on the node
+        :return: Dict of path to hex digest, None for the files which couldn't be hashed
+        """
+        return RemoteChecksum(self.ssh_client, algorithm, parallel=parallel).checksum_many(filenames)
 
     def get_pid(self, procSubString, ignore=None):
         if ignore is None:
@@ -343,15 +722,15 @@ class RemoteNode(object):
         if not dirPath:
             dirPath = "~"
 
-        if createNonExistingParents:
-            self.execute("mkdir -p {0}/{1}".format(dirPath, dirName))
-        else:
-            self.execute("mkdir {0}/{1}".format(dirPath, dirName))
-
-        if self.ssh_client.exit_status_last_command == 0:
-            return True
+        try:
+            if createNonExistingParents:
+                result = self.execute_result("mkdir -p {0}/{1}".format(dirPath, dirName))
+            else:
+                result = self.execute_result("mkdir {0}/{1}".format(dirPath, dirName))
 
-        return False
+            return result.succeeded
+        finally:
+            self.invalidate_stat_cache("{0}/{1}".format(dirPath, dirName))
 
     def createFile(self, filePath, fileName, size=0, randomData=True, umask="777", append=False):
         """
@@ -374,61 +753,62 @@ class RemoteNode(object):
         if not filePath:
             filePath = "~"
 
-        if size == 0:
-            self.execute("touch {0}/{1}".format(filePath, fileName))
-            return self.ssh_client.exit_status_last_command == 0
-
-        if randomData:
-            inFile = "/dev/urandom"
-        else:
-            if self.getFileSystemType(filePath + "/") == 'ext4':
-                self.execute("fallocate -l {0} {1}".format(size, filePath + "/" + fileName), sudo=True)
-
-                if self.ssh_client.exit_status_last_command != 0:
-                    autopsy_logger.error("Error creating file {0}".format(filePath + "/" + fileName))
-                    return False
+        try:
+            if size == 0:
+                return self.execute_result("touch {0}/{1}".format(filePath, fileName)).succeeded
 
-                self.execute("chmod {0} {1}".format(umask, filePath + "/" + fileName),
-                             sudo=True, quiet=True)
-                return True
+            if randomData:
+                inFile = "/dev/urandom"
             else:
-                inFile = "/dev/zero"
-
-        remainder = Utilities.convertToBytes(size)
-        value = 2
-        bsValues = ["1M", "1K", "1"]
-
-        isFirst = not append
-
-        while remainder > 0 and value >= 0:
-            quotient = remainder // (pow(1024, value))
-            remainder %= (pow(1024, value))
-
-            if quotient > 0:
-                if isFirst:
-                    self.execute("dd if={0} bs={3} count={2} > {1}".format(inFile,
-                                                                           filePath + "/" + fileName,
-                                                                           quotient,
-                                                                           bsValues[len(bsValues) - value - 1]),
-                                 sudo=True, quiet=True, timeout=3600)
-                    if self.ssh_client.exit_status_last_command != 0:
-                        autopsy_logger.error(
-                            "Error doing dd command for file {0}: Exiting...".format(filePath + "/" + fileName))
+                if self.getFileSystemType(filePath + "/") == 'ext4':
+                    result = self.execute_result("fallocate -l {0} {1}".format(size, filePath + "/" + fileName),
+                                                 sudo=True)
+
+                    if not result.succeeded:
+                        autopsy_logger.error("Error creating file {0}".format(filePath + "/" + fileName))
                         return False
-                    isFirst = False
+
+                    self.execute("chmod {0} {1}".format(umask, filePath + "/" + fileName),
+                                 sudo=True, quiet=True)
+                    return True
                 else:
-                    self.execute("dd if={0} bs={3} count={2} >> {1}".format(inFile,
-                                                                            filePath + "/" + fileName,
-                                                                            quotient,
-                                                                            bsValues[len(bsValues) - value - 1]),
-                                 sudo=True, quiet=True, timeout=3600)
-                    if self.ssh_client.exit_status_last_command != 0:
-                        autopsy_logger.error(
-                            "Error doing dd command for file {0}: Exiting...".format(filePath + "/" + fileName))
-                        return False
-            value -= 1
+                    inFile = "/dev/zero"
+
+            remainder = Utilities.convertToBytes(size)
+            value = 2
+            bsValues = ["1M", "1K", "1"]
+
+            isFirst = not append
+
+            while remainder > 0 and value >= 0:
+                quotient = remainder // (pow(1024, value))
+                remainder %= (pow(1024, value))
+
+                if quotient > 0:
+                    if isFirst:
+                        result = self.execute_result("dd if={0} bs={3} count={2} > {1}"
+                                                     .format(inFile, filePath + "/" + fileName, quotient,
+                                                             bsValues[len(bsValues) - value - 1]),
+                                                     sudo=True, quiet=True, timeout=3600)
+                        if not result.succeeded:
+                            autopsy_logger.error(
+                                "Error doing dd command for file {0}: Exiting...".format(filePath + "/" + fileName))
+                            return False
+                        isFirst = False
+                    else:
+                        result = self.execute_result("dd if={0} bs={3} count={2} >> {1}"
+                                                     .format(inFile, filePath + "/" + fileName, quotient,
+                                                             bsValues[len(bsValues) - value - 1]),
+                                                     sudo=True, quiet=True, timeout=3600)
+                        if not result.succeeded:
+                            autopsy_logger.error(
+                                "Error doing dd command for file {0}: Exiting...".format(filePath + "/" + fileName))
+                            return False
+                value -= 1
 
-        return True
+            return True
+        finally:
+            self.invalidate_stat_cache(filePath + "/" + fileName)
 
     def removeFile(self, file):
         """
@@ -439,13 +819,11 @@ class RemoteNode(object):
 
         try:
             # Don't escape for special characters as wildcard chars will be ignored
-            self.execute("sudo rm -rf " + file)
-            if self.ssh_client.exit_status_last_command != 0:
-                return False
-
-            return True
+            return self.execute_result("sudo rm -rf " + file).succeeded
         except IOError as e:
             autopsy_logger.exception("Couldn't delete file: " + e.message)
+        finally:
+            self.invalidate_stat_cache(*file.split())
 
         return False
 
@@ -462,14 +840,11 @@ class RemoteNode(object):
             newName = "Random" + random.randint(1111, 9999)
 
         try:
-            self.execute("sudo mv " + oldName + " " + newName)
-
-            if self.ssh_client.exit_status_last_command != 0:
-                return False
-
-            return True
+            return self.execute_result("sudo mv " + oldName + " " + newName).succeeded
         except IOError as e:
             autopsy_logger.exception("Couldn't rename this file: " + e.message)
+        finally:
+            self.invalidate_stat_cache(oldName, newName)
 
         return False
 
@@ -509,10 +884,10 @@ class RemoteNode(object):
             return False
 
         autopsy_logger.debug(self.hostname + ":" + "Stopping service: " + serviceName)
-        output = self.execute("sudo service {0} stop".format(serviceName), quiet=True)
+        result = self.execute_result("sudo service {0} stop".format(serviceName), quiet=True)
 
-        if self.ssh_client.exit_status_last_command != 0:
-            if "Unknown instance" not in output and "Job has already been stopped" not in output:
+        if not result.succeeded:
+            if "Unknown instance" not in result.output and "Job has already been stopped" not in result.output:
                 autopsy_logger.error("Error stopping the service")
                 return False
 
@@ -528,9 +903,9 @@ class RemoteNode(object):
             return False
 
         autopsy_logger.debug(self.hostname + ":" + "Starting service: " + serviceName)
-        output = self.execute("sudo service {0} start".format(serviceName), quiet=True)
-        if self.ssh_client.exit_status_last_command != 0:
-            if "already running" not in output:
+        result = self.execute_result("sudo service {0} start".format(serviceName), quiet=True)
+        if not result.succeeded:
+            if "already running" not in result.output:
                 autopsy_logger.error("Error starting the service \'{0}\'".format(serviceName))
                 return False
 
@@ -540,9 +915,9 @@ class RemoteNode(object):
         if not serviceName:
             return False
         autopsy_logger.debug(self.hostname + ":" + "Restarting service: " + serviceName)
-        output = self.execute("sudo service {0} restart".format(serviceName), quiet=True)
-        if self.ssh_client.exit_status_last_command != 0:
-            if "already running" not in output:
+        result = self.execute_result("sudo service {0} restart".format(serviceName), quiet=True)
+        if not result.succeeded:
+            if "already running" not in result.output:
                 autopsy_logger.error("Error restarting the service")
                 return False
 
@@ -573,9 +948,9 @@ class RemoteNode(object):
             autopsy_logger.warning("No processes found with string: '" + procSubString + "', just ignoring")
             return False
 
-        self.execute("sudo kill -{0} {1} ".format(signal, str(' '.join(proc_id))))
+        result = self.execute_result("sudo kill -{0} {1} ".format(signal, str(' '.join(proc_id))))
 
-        if self.ssh_client.exit_status_last_command != 0:
+        if not result.succeeded:
             autopsy_logger.error("Error killing the process")
             return False
 
@@ -585,9 +960,7 @@ class RemoteNode(object):
 
         autopsy_logger.info("Rebooting the device: " + self.hostname)
 
-        self.execute("sudo /sbin/reboot", quiet=True, timeout=timeout)
-
-        if self.ssh_client.exit_status_last_command != 0:
+        if not self.execute_result("sudo /sbin/reboot", quiet=True, timeout=timeout).succeeded:
             return False
 
         # To check if the reboot sequence has been initiated
@@ -602,16 +975,17 @@ class RemoteNode(object):
                 time.sleep(10)
                 break
 
-        # Reducing 10 seconds as we already slept for 10 secs in above loop
-        waittime = time.time() + timeout - 10
+        # Polling quickly at first and backing off, as some devices come back in seconds and some in minutes.
+        #   Reducing 10 seconds as we already slept for 10 secs in above loop
+        for attempt in RetryPolicy(attempts=None, base_delay=2, max_delay=15, deadline=timeout - 10).attempts():
+            # Node being down is expected here, so it shouldn't trip the circuit breaker for it
+            self.ssh_client.breaker.reset()
 
-        while waittime >= time.time():
             try:
                 self.connect(retries=1)
                 return True
             except (socket.error, SSHException) as e:
                 autopsy_logger.debug("Device didn't comeup, retry..")
-                time.sleep(10)
 
         return False
 
@@ -649,24 +1023,14 @@ class RemoteNode(object):
             autopsy_logger.error("Interface can't be None/Empty")
             return False
 
-        self.execute("sudo ifconfig {0} down".format(interface), quiet=True)
-
-        if self.ssh_client.exit_status_last_command != 0:
-            return False
-        else:
-            return True
+        return self.execute_result("sudo ifconfig {0} down".format(interface), quiet=True).succeeded
 
     def interface_up(self, interface):
         if not interface:
             autopsy_logger.error("Interface can't be None/Empty")
             return False
 
-        self.execute("sudo ifconfig {0} up".format(interface), quiet=True)
-
-        if self.ssh_client.exit_status_last_command != 0:
-            return False
-        else:
-            return True
+        return self.execute_result("sudo ifconfig {0} up".format(interface), quiet=True).succeeded
 
     def flap_interface(self, interface, downtime=10,
                        repeat=1, repeat_gap=20):
@@ -723,14 +1087,15 @@ class RemoteNode(object):
 
         autopsy_logger.info("Setting (up/down) speed on interface : ({0}/{1}), {2}".format(upSpeed, downSpeed, interface))
         # self.execute("sudo wondershaper {0} {1} {2}".format(interface, downSpeed, upSpeed))
-        self.execute("sudo tc qdisc del dev {2} root;"
-                     "sudo tc qdisc add dev {2} root handle 1: htb default 99;"
-                     "sudo tc class add dev {2} classid 1:99 htb rate {0}{1} ceil {0}{1} burst 1000k;"
-                     "sudo tc class add dev {2} classid 1:1 htb rate 10mbit ceil 10mbit burst 1000k;"
-                     "sudo tc filter add dev {2} protocol ip parent 1:0 prio 0 u32 match ip sport 22 0xffff flowid 1:1"
-                     .format(upSpeed, unit, interface), quiet=True)
-
-        if self.ssh_client.exit_status_last_command != 0:
+        result = self.execute_result("sudo tc qdisc del dev {2} root;"
+                                     "sudo tc qdisc add dev {2} root handle 1: htb default 99;"
+                                     "sudo tc class add dev {2} classid 1:99 htb rate {0}{1} ceil {0}{1} burst 1000k;"
+                                     "sudo tc class add dev {2} classid 1:1 htb rate 10mbit ceil 10mbit burst 1000k;"
+                                     "sudo tc filter add dev {2} protocol ip parent 1:0 prio 0 u32 "
+                                     "match ip sport 22 0xffff flowid 1:1"
+                                     .format(upSpeed, unit, interface), quiet=True)
+
+        if not result.succeeded:
             autopsy_logger.error("Error setting bw limits, exiting...")
             return False
 
@@ -742,9 +1107,9 @@ class RemoteNode(object):
             return False
 
         autopsy_logger.info("Clear BW params on interface " + interface)
-        self.execute("sudo tc qdisc del dev {0} root".format(interface), quiet=True)
+        result = self.execute_result("sudo tc qdisc del dev {0} root".format(interface), quiet=True)
 
-        if self.ssh_client.exit_status_last_command != 0:
+        if not result.succeeded:
             autopsy_logger.error("Error clearing bw limits, exiting...")
             return False
 
@@ -784,39 +1149,43 @@ class RemoteNode(object):
         """ Node should have iptables to use this
         :return:
         """
-        self.clear_ip_tables()
+        self.connect()
 
         local_ip = self.ssh_client.handle.get_transport().sock.getsockname()[0]
 
-        self.ssh_client.execute("iptables --insert INPUT  --source {0}/32 --jump ACCEPT".format(local_ip),
-                                sudo=True)
-        if self.ssh_client.exit_status_last_command != 0:
-            autopsy_logger.error("Couldn't simulate nw down, probably 'iptables' cmd not present in this node")
-            return False
-
-        self.ssh_client.execute("iptables --append INPUT  --protocol tcp --dport 22 --jump ACCEPT", sudo=True)
-        self.ssh_client.execute("iptables --append INPUT  --protocol tcp --sport 1515 --jump ACCEPT", sudo=True)
-
-        self.ssh_client.execute("iptables --insert OUTPUT --destination {0}/32 --jump ACCEPT".format(local_ip),
-                                sudo=True)
-        self.ssh_client.execute("iptables --append OUTPUT --protocol tcp --sport 22 --jump ACCEPT", sudo=True)
-        self.ssh_client.execute("iptables --append OUTPUT --protocol tcp --dport 1515 --jump ACCEPT", sudo=True)
+        commands = ["iptables --flush",
+                    "iptables --insert INPUT  --source {0}/32 --jump ACCEPT".format(local_ip),
+                    "iptables --append INPUT  --protocol tcp --dport 22 --jump ACCEPT",
+                    "iptables --append INPUT  --protocol tcp --sport 1515 --jump ACCEPT",
+                    "iptables --insert OUTPUT --destination {0}/32 --jump ACCEPT".format(local_ip),
+                    "iptables --append OUTPUT --protocol tcp --sport 22 --jump ACCEPT",
+                    "iptables --append OUTPUT --protocol tcp --dport 1515 --jump ACCEPT"]
 
         if interface:
             int_ip = self.getIpAddress(interface)
 
-            self.ssh_client.execute("iptables --append INPUT  --destination {0}/32 --jump DROP".format(int_ip),
-                                    sudo=True)
-            self.ssh_client.execute("iptables --append OUTPUT --source {0}/32 --jump DROP".format(int_ip), sudo=True)
+            commands += ["iptables --append INPUT  --destination {0}/32 --jump DROP".format(int_ip),
+                         "iptables --append OUTPUT --source {0}/32 --jump DROP".format(int_ip)]
         else:
-            self.ssh_client.execute("iptables --append INPUT  --jump DROP", sudo=True)
-            self.ssh_client.execute("iptables --append OUTPUT --jump DROP", sudo=True)
+            commands += ["iptables --append INPUT  --jump DROP",
+                         "iptables --append OUTPUT --jump DROP"]
+
+        # Stopping at the first failure, so that we never end up dropping the traffic
+        #   without the ACCEPT rules for our own connection in place
+        results = self.execute_batch(commands, stop_on_failure=True, sudo=True)
+
+        if not results or not results[0].succeeded:
+            autopsy_logger.error("Couldn't simulate nw down, probably 'iptables' cmd not present in this node")
+            return False
+
+        if len(results) != len(commands) or not results[-1].succeeded:
+            autopsy_logger.error("Couldn't simulate nw down, failed at: " + results[-1].command)
+            return False
 
         return True
 
     def clear_ip_tables(self):
-        self.ssh_client.execute("iptables --flush", sudo=True)
-        if self.ssh_client.exit_status_last_command != 0:
+        if not self.ssh_client.execute_result("iptables --flush", sudo=True).succeeded:
             autopsy_logger.error("Couldn't clear iptable entries, probably 'iptables' cmd not present in this node")
             return False
 
@@ -840,9 +1209,10 @@ class RemoteNode(object):
                               reorder_percent=reorder_percent, reorder_correlation=reorder_correlation,
                               reorder_gap=reorder_gap)
 
-        out = self.execute(cmd, sudo=True)
+        result = self.execute_result(cmd, sudo=True)
+        out = result.output
 
-        if self.ssh_client.exit_status_last_command != 0:
+        if not result.succeeded:
             if "File exists" in out and operation.lower() == "add":
                 operation = "change"
                 cmd = generate_tc_cmd(interface, operation,
@@ -854,8 +1224,7 @@ class RemoteNode(object):
                                       delay_distribution=delay_distribution,
                                       reorder_percent=reorder_percent, reorder_correlation=reorder_correlation,
                                       reorder_gap=reorder_gap)
-                out = self.execute(cmd, sudo=True)
-                if self.ssh_client.exit_status_last_command != 0:
+                if not self.execute_result(cmd, sudo=True).succeeded:
                     autopsy_logger.error("Error applying qos parameters on {0}".format(self.hostname))
             elif "No such file" in out and operation.lower() == "change":
                 operation = "add"
@@ -868,8 +1237,7 @@ class RemoteNode(object):
                                       delay_distribution=delay_distribution,
                                       reorder_percent=reorder_percent, reorder_correlation=reorder_correlation,
                                       reorder_gap=reorder_gap)
-                out = self.execute(cmd, sudo=True)
-                if self.ssh_client.exit_status_last_command != 0:
+                if not self.execute_result(cmd, sudo=True).succeeded:
                     autopsy_logger.error("Error applying qos parameters on {0}".format(self.hostname))
             elif "Invalid argument" in out and operation.lower() == "del":
                 pass
@@ -897,8 +1265,9 @@ class RemoteNode(object):
                                   duplicate_percent="1%")
 
     def getFileSystemType(self, f):
-        device = self.execute("df -k {0} | grep -v Filesystem".format(f)).rsplit(' ')[0]
-        fileSystemType = self.execute("mount | grep {0}".format(device), sudo=True).rsplit(' ')[4]
+        # Device is looked up on the node itself, to get the mount entry in a single round trip
+        fileSystemType = self.execute("mount | grep \"$(df -k {0} | grep -v Filesystem | cut -d' ' -f1)\""
+                                      .format(f), sudo=True).rsplit(' ')[4]
 
         return fileSystemType
 
@@ -922,22 +1291,19 @@ class RemoteNode(object):
 
         autopsy_logger.info("Creating linear device...")
 
-        self.execute("umount {0}".format(fileLocation))
-
-        self.execute("dmsetup create img 0 {0} linear {1} 0".format(diskSize, mountPoint))
+        results = self.execute_batch(["umount {0}".format(fileLocation),
+                                      "dmsetup create img 0 {0} linear {1} 0".format(diskSize, mountPoint),
+                                      "dmsetup table img",
+                                      "sudo mount /dev/mapper/img {0} && cd {0}".format(fileLocation),
+                                      "hdparm {0}".format(f),
+                                      "sudo umount {0}".format(fileLocation)])
 
-        self.execute("dmsetup table img")
-
-        self.execute("mount /dev/mapper/img {0} && cd {0}".format(fileLocation), sudo=True)
-
-        fileDetails = self.execute("hdparm {0}".format(f))
+        fileDetails = results[4].output if len(results) > 4 else ""
 
         columns = fileDetails.split(' ')
 
         autopsy_logger.info("Introducing errors in last 64K of the file")
 
-        self.execute("umount {0}".format(fileLocation), sudo=True)
-
         beginErrorAt = columns[1].split('\n')[-1]
         beginErrorRange = columns[3].split('\n')[-1]
         endErrorStart = int(columns[2].split('\n')[-1]) + 1
@@ -947,12 +1313,10 @@ class RemoteNode(object):
               "{0} {2} error\n{3} {4} linear /dev/sdb1 {3}" \
               " | dmsetup load img".format(beginErrorAt, mountPoint, beginErrorRange, endErrorStart, endErrorRange)
 
-        self.execute(cmd, sudo=True)
-
-        self.execute("dmsetup resume img", sudo=True)
-        self.execute("dmsetup load img", sudo=True)
-
-        self.execute("mount /dev/mapper/img {0}".format(fileLocation))
+        self.execute_batch(["sudo " + cmd,
+                            "sudo dmsetup resume img",
+                            "sudo dmsetup load img",
+                            "mount /dev/mapper/img {0}".format(fileLocation)])
 
     def get_rx_tx_bytes(self, iface):
         """
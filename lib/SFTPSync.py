@@ -0,0 +1,506 @@
+#! /usr/bin/python -tt
+import hashlib
+import json
+import math
+import mmap
+import os
+import pipes
+import posixpath
+import re
+import stat
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+from lib.RemoteChecksum import RemoteChecksum, hash_file
+from lib.SFTPTransfer import SFTPTransfer, TransferResult, stat_many
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+class SyncResult(namedtuple("SyncResult", ["source", "destination", "files", "transferred_files", "delta_files",
+                                           "size", "transferred", "seconds", "failed"])):
+    """ Result of a sync.
+
+    size is what a full upload of all the files would have moved, transferred is what was moved
+    (whole changed files, and only the deltas of the ones sent as deltas). failed is the dict of
+    remote path to the error of the files which couldn't be synced.
+    """
+    __slots__ = ()
+
+    @property
+    def succeeded(self):
+        return not self.failed
+
+    @property
+    def saved(self):
+        return self.size - self.transferred
+
+    def __str__(self):
+        return "{0} -> {1}: {2} files, {3} transferred ({4} as delta), {5:.2f} of {6:.2f} MB sent, " \
+               "{7:.2f} MB ({8:.0f}%) saved, in {9:.2f}s{10}"\
+            .format(self.source, self.destination, self.files, self.transferred_files, self.delta_files,
+                    self.transferred / (1024.0 * 1024), self.size / (1024.0 * 1024), self.saved / (1024.0 * 1024),
+                    100.0 * self.saved / self.size if self.size else 100.0, self.seconds,
+                    ", {0} failed".format(len(self.failed)) if self.failed else "")
+
+
+class SyncManifest:
+    """ What was last synced to a node: size, modification time and (when hashed) md5 of every remote file.
+
+    Kept as JSON in a file per node under 'directory', so that the next runs have it too. An entry is
+    trusted only while the remote file still has the size and modification time it was left with.
+    """
+    DIRECTORY = os.path.join(os.path.expanduser("~"), ".autopsy", "sync")
+
+    def __init__(self, name, directory=None):
+        """
+        :param name: Something unique to the node, e.g., user@host_port
+        :param directory: Where the manifests are kept, DIRECTORY if None
+        """
+        self.path = os.path.join(directory if directory else SyncManifest.DIRECTORY,
+                                 re.sub(r"[^\w.@-]", "_", name) + ".json")
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def _load(self):
+        if self.entries is not None:
+            return
+
+        self.entries = {}
+
+        if not os.path.isfile(self.path):
+            return
+
+        try:
+            with open(self.path) as fh:
+                self.entries = json.load(fh)
+        except (IOError, ValueError) as e:
+            autopsy_logger.warning("Ignoring the sync manifest {0}: {1}".format(self.path, str(e)))
+
+    def get(self, remote_file, remote_attributes=None):
+        """
+        :param remote_attributes: SFTPAttributes of the remote file now, the entry is not given out if the
+                                  file has changed since it was synced
+        :return: Dict of size, mtime and md5 (None if it wasn't hashed), None if there's no (valid) entry
+        """
+        with self.lock:
+            self._load()
+            entry = self.entries.get(remote_file)
+
+        if entry and remote_attributes is not None and \
+                (entry["size"], entry["mtime"]) != (remote_attributes.st_size, remote_attributes.st_mtime):
+            return None
+
+        return entry
+
+    def set(self, remote_file, size, mtime, md5=None):
+        with self.lock:
+            self._load()
+            self.entries[remote_file] = {"size": size, "mtime": mtime, "md5": md5}
+
+    def save(self):
+        with self.lock:
+            if self.entries is None:
+                return
+
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            # Written aside and renamed, so that a run dying in between doesn't leave half a manifest
+            temp_file = "{0}.{1}.tmp".format(self.path, os.getpid())
+            with open(temp_file, "w") as fh:
+                json.dump(self.entries, fh)
+            os.rename(temp_file, self.path)
+
+
+def _python_command(script, *args):
+    """
+    :return: Shell command running the script with the python of the node (exit status 127 if there's none)
+    """
+    return "PY=$(command -v python3 || command -v python) || exit 127; \"$PY\" -c {0} {1}"\
+        .format(pipes.quote(script), " ".join(pipes.quote(str(arg)) for arg in args))
+
+
+# Weak (adler32) and strong (md5) checksum of every block of the file, a line each
+_SIGNATURE_SCRIPT = """
+import hashlib, sys, zlib
+block = int(sys.argv[2])
+with open(sys.argv[1], "rb") as f:
+    while True:
+        data = f.read(block)
+        if not data:
+            break
+        sys.stdout.write("%d %s\\n" % (zlib.adler32(data) & 0xffffffff, hashlib.md5(data).hexdigest()))
+"""
+
+# Builds the new file from the blocks of the old one and the literal data in the delta, prints its md5
+_PATCH_SCRIPT = """
+import hashlib, os, struct, sys
+target, delta, block = sys.argv[1], sys.argv[2], int(sys.argv[3])
+temp = target + ".autopsy-sync"
+md5 = hashlib.md5()
+with open(target, "rb") as basis:
+    with open(delta, "rb") as d:
+        with open(temp, "wb") as out:
+            while True:
+                kind = d.read(1)
+                if not kind:
+                    break
+                if kind == b"C":
+                    start, count = struct.unpack(">II", d.read(8))
+                    basis.seek(start * block)
+                    left = count * block
+                    while left > 0:
+                        data = basis.read(min(left, 1048576))
+                        if not data:
+                            break
+                        md5.update(data)
+                        out.write(data)
+                        left -= len(data)
+                else:
+                    length = struct.unpack(">I", d.read(4))[0]
+                    data = d.read(length)
+                    md5.update(data)
+                    out.write(data)
+os.rename(temp, target)
+os.remove(delta)
+sys.stdout.write(md5.hexdigest() + "\\n")
+"""
+
+
+class _DeltaWriter:
+    """ Writes the delta: runs of blocks to be copied from the old file and the literal data in between """
+    LITERAL_CHUNK = 1024 * 1024
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.copy = None
+        self.literal = 0
+
+    def add_copy(self, index):
+        if self.copy and self.copy[0] + self.copy[1] == index:
+            self.copy[1] += 1
+            return
+
+        self._flush_copy()
+        self.copy = [index, 1]
+
+    def add_literal(self, data, start, end):
+        if start >= end:
+            return
+
+        self._flush_copy()
+        self.literal += end - start
+
+        for offset in range(start, end, _DeltaWriter.LITERAL_CHUNK):
+            chunk = data[offset:min(end, offset + _DeltaWriter.LITERAL_CHUNK)]
+            self.fh.write("L" + struct.pack(">I", len(chunk)))
+            self.fh.write(chunk)
+
+    def _flush_copy(self):
+        if self.copy:
+            self.fh.write("C" + struct.pack(">II", self.copy[0], self.copy[1]))
+            self.copy = None
+
+    def close(self):
+        self._flush_copy()
+
+
+def _encode_delta(local_file, signatures, block, fh, max_literal, max_gap):
+    """
+    Finds the blocks of the old (remote) file in the new one at any offset, with the rolling checksum of rsync
+
+    :param signatures: Dict of weak checksum to dict of md5 to the index of the block in the old file
+    :param fh: File the delta is written to
+    :param max_literal: Bytes of literal data beyond which it is not worth it
+    :param max_gap: Bytes without any match beyond which it is given up on, every byte of it is a round of
+                    the rolling checksum in python
+    :return: Bytes of literal data, None if it went beyond max_literal or max_gap
+    """
+    size = os.path.getsize(local_file)
+    writer = _DeltaWriter(fh)
+
+    with open(local_file, "rb") as local:
+        data = mmap.mmap(local.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        # Start of the bytes which are not copied, they go as literal when the next match is found
+        literal_start = 0
+        offset = 0
+        a = b = None
+
+        while offset + block <= size:
+            if a is None:
+                weak = zlib.adler32(data[offset:offset + block]) & 0xffffffff
+                a, b = weak & 0xffff, weak >> 16
+
+            strong = signatures.get((b << 16) | a)
+            index = strong.get(hashlib.md5(data[offset:offset + block]).hexdigest()) if strong else None
+
+            if index is not None:
+                writer.add_literal(data, literal_start, offset)
+                writer.add_copy(index)
+                offset += block
+                literal_start = offset
+                a = None
+                continue
+
+            if offset - literal_start > max_gap or writer.literal + offset - literal_start > max_literal:
+                return None
+
+            # Window moves a byte ahead, checksum of the new window from that of the old one
+            if offset + block < size:
+                out_byte, in_byte = ord(data[offset]), ord(data[offset + block])
+                a = (a - out_byte + in_byte) % 65521
+                b = (b - block * out_byte - 1 + a) % 65521
+            offset += 1
+
+        writer.add_literal(data, literal_start, size)
+        writer.close()
+    finally:
+        data.close()
+
+    return writer.literal
+
+
+class SFTPSync(SFTPTransfer):
+    """ Uploads only the files which have changed since the last sync to the node.
+
+    A file is taken as unchanged if the remote one has the same size and modification time as the
+    local one (modification times are carried over by every sync). With checksum=True, files of the same
+    size are compared by md5 instead, the md5 of the remote file comes from the manifest while the file
+    is as it was synced, else is computed on the node.
+
+    With delta=True, a changed file is sent as the difference from the remote file when both are big enough:
+    blocks of the remote file are found in the local one with the rolling checksum of rsync, and only the data
+    in between goes over the wire. That needs python on the node, it falls back to a full upload otherwise,
+    and when the files differ too much (half of the file, or a MB without any block of the remote file).
+    """
+    DELTA_MIN_SIZE = 1024 * 1024
+    # Fraction of the file as literal data beyond which the delta is given up on
+    DELTA_MAX_LITERAL = 0.5
+    DELTA_MAX_GAP = 1024 * 1024
+
+    def __init__(self, handle, manifest, checksum=False, delta=False, **kwargs):
+        """
+        :param handle: SSHHandle of the node
+        :param manifest: SyncManifest of the node
+        :param checksum: Compare the files of the same size by md5, instead of by modification time
+        :param delta: Send the changed files as deltas
+        :param kwargs: Arguments of SFTPTransfer
+        """
+        SFTPTransfer.__init__(self, handle, **kwargs)
+        self.manifest = manifest
+        self.checksum = checksum
+        self.delta = delta
+
+    def sync(self, local, remote, include=None, exclude=None, workers=SFTPTransfer.WORKERS):
+        """
+        :param local: File or directory
+        :param remote: Remote file or directory, directories missing on the remote side are created
+        :param include: Glob patterns, only the files matching one of them are synced
+        :param exclude: Glob patterns of the files and directories to be left out
+        :return: SyncResult
+        """
+        start = time.time()
+
+        if os.path.isdir(local):
+            directories, files = self._walk_local(local, include, exclude)
+
+            with self.handle.get_sftp_connection(label="mkdir " + remote) as sftp:
+                for relative, _ in directories:
+                    self._remote_makedirs(sftp, posixpath.join(remote, relative) if relative else remote)
+        else:
+            files = [("", os.stat(local))]
+
+        entries = [(posixpath.join(remote, path) if path else remote,
+                    os.path.join(local, *path.split("/")) if path else local, attributes)
+                   for path, attributes in files]
+        remote_attributes = self._remote_attributes([remote_file for remote_file, _, _ in entries])
+
+        changed, local_md5s = self._find_changed(entries, remote_attributes)
+        delta_files = []
+
+        def transfer(entry):
+            remote_file, local_file, attributes = entry
+            existing = remote_attributes.get(remote_file)
+            result = None
+
+            if self.delta and existing is not None and stat.S_ISREG(existing.st_mode) \
+                    and min(attributes.st_size, existing.st_size) >= SFTPSync.DELTA_MIN_SIZE:
+                result = self._upload_delta(local_file, remote_file, attributes.st_size, existing.st_size)
+                if result:
+                    delta_files.append(remote_file)
+
+            if result is None:
+                result = self.upload(local_file, remote_file, quiet=True)
+
+            with self.handle.get_sftp_connection(label="setstat " + remote_file) as sftp:
+                sftp.chmod(remote_file, stat.S_IMODE(attributes.st_mode))
+                sftp.utime(remote_file, (attributes.st_atime, int(attributes.st_mtime)))
+
+            md5 = local_md5s.get(remote_file) or \
+                (result.checksum if result.verified == SFTPTransfer.VERIFY_MD5 else None) or \
+                (hash_file(local_file) if self.checksum else None)
+            self.manifest.set(remote_file, attributes.st_size, int(attributes.st_mtime), md5)
+
+            return result
+
+        results, failed = self._run_files(changed, transfer, workers)
+
+        try:
+            self.manifest.save()
+        except (IOError, OSError) as e:
+            autopsy_logger.warning("Couldn't save the sync manifest {0}: {1}".format(self.manifest.path, str(e)))
+
+        result = SyncResult(local, remote, len(entries), len(results), len(delta_files),
+                            sum(attributes.st_size for _, _, attributes in entries),
+                            sum(result.transferred for result in results), time.time() - start, failed)
+        (autopsy_logger.error if failed else autopsy_logger.info)(str(result))
+
+        return result
+
+    def _find_changed(self, entries, remote_attributes):
+        """
+        :return: List of the entries to be transferred, dict of remote path to md5 of the local files hashed
+        """
+        changed = []
+        to_hash = []
+
+        for entry in entries:
+            remote_file, local_file, attributes = entry
+            existing = remote_attributes.get(remote_file)
+
+            if existing is None or existing.st_size != attributes.st_size:
+                changed.append(entry)
+            elif self.checksum:
+                to_hash.append(entry)
+            elif existing.st_mtime != int(attributes.st_mtime):
+                changed.append(entry)
+
+        if not to_hash:
+            return changed, {}
+
+        local_md5s = dict((remote_file, hash_file(local_file)) for remote_file, local_file, _ in to_hash)
+        remote_md5s = {}
+        unknown = []
+
+        for remote_file, _, _ in to_hash:
+            entry = self.manifest.get(remote_file, remote_attributes[remote_file])
+
+            if entry and entry.get("md5"):
+                remote_md5s[remote_file] = entry["md5"]
+            else:
+                unknown.append(remote_file)
+
+        remote_md5s.update(self._remote_md5s(unknown))
+
+        touched = []
+        for entry in to_hash:
+            remote_file, local_file, attributes = entry
+
+            if remote_md5s.get(remote_file) != local_md5s[remote_file]:
+                changed.append(entry)
+            elif remote_attributes[remote_file].st_mtime != int(attributes.st_mtime):
+                touched.append(entry)
+            else:
+                self.manifest.set(remote_file, attributes.st_size, int(attributes.st_mtime), local_md5s[remote_file])
+
+        # Same content, only the modification time is to be carried over
+        if touched:
+            with self.handle.get_sftp_connection(label="utime {0} files".format(len(touched))) as sftp:
+                for remote_file, local_file, attributes in touched:
+                    sftp.utime(remote_file, (attributes.st_atime, int(attributes.st_mtime)))
+                    self.manifest.set(remote_file, attributes.st_size, int(attributes.st_mtime),
+                                      local_md5s[remote_file])
+
+        return changed, local_md5s
+
+    def _remote_attributes(self, remote_files):
+        """
+        :return: Dict of remote path to SFTPAttributes of the ones which are there
+        """
+        with self.handle.get_sftp_connection(label="stat {0} files".format(len(remote_files))) as sftp:
+            attributes = stat_many(sftp, remote_files)
+
+        return dict((path, value) for path, value in attributes.items() if value is not None)
+
+    def _remote_md5s(self, remote_files):
+        """
+        :return: Dict of remote path to md5, of the ones that could be hashed
+        """
+        md5s = RemoteChecksum(self.handle).checksum_many(remote_files)
+
+        # Files that couldn't be read are left out, they are transferred
+        return dict((path, md5) for path, md5 in md5s.items() if md5)
+
+    @staticmethod
+    def _block_size(size):
+        """ Square root of the size as in rsync, in KBs between 2KB and 128KB """
+        return max(2048, min(128 * 1024, int(math.sqrt(size)) // 1024 * 1024))
+
+    def _upload_delta(self, local_file, remote_file, size, remote_size):
+        """
+        :return: TransferResult, None if it couldn't be sent as delta
+        """
+        start = time.time()
+        block = self._block_size(remote_size)
+
+        result = self.handle.execute_result(_python_command(_SIGNATURE_SCRIPT, remote_file, block),
+                                            timeout=3600, quiet=True)
+        if not result.succeeded:
+            autopsy_logger.debug("No block checksums of {0} (exit status {1}), uploading it whole"
+                                 .format(remote_file, result.exit_status))
+            return None
+
+        # Short last block can't be matched, the window is always a whole block
+        blocks = remote_size // block
+        signatures = {}
+        for index, line in enumerate(result.output.lines()):
+            if index >= blocks:
+                break
+            weak, strong = line.split()
+            signatures.setdefault(int(weak), {}).setdefault(strong, index)
+
+        fd, delta_file = tempfile.mkstemp(prefix="autopsy-delta-")
+        remote_delta = remote_file + ".autopsy-delta"
+
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                literal = _encode_delta(local_file, signatures, block, fh, size * SFTPSync.DELTA_MAX_LITERAL,
+                                        SFTPSync.DELTA_MAX_GAP)
+
+            if literal is None:
+                autopsy_logger.debug("{0} differs too much from {1}, uploading it whole".format(local_file,
+                                                                                              remote_file))
+                return None
+
+            delta_size = os.path.getsize(delta_file)
+            self.upload(delta_file, remote_delta, quiet=True)
+
+            result = self.handle.execute_result(_python_command(_PATCH_SCRIPT, remote_file, remote_delta, block),
+                                                timeout=3600, quiet=True)
+            md5 = hash_file(local_file)
+
+            if not result.succeeded or result.output.strip() != md5:
+                autopsy_logger.warning("Delta of {0} didn't apply (exit status {1}, md5 {2}, expected {3}), "
+                                       "uploading it whole".format(remote_file, result.exit_status,
+                                                                   result.output.strip(), md5))
+                self.handle.execute_result("rm -f -- {0} {1}".format(pipes.quote(remote_delta),
+                                                                     pipes.quote(remote_file + ".autopsy-sync")),
+                                           quiet=True)
+                return None
+        finally:
+            os.remove(delta_file)
+
+        autopsy_logger.debug("{0} sent as delta of {1} bytes ({2} literal) instead of {3}"
+                             .format(remote_file, delta_size, literal, size))
+
+        return TransferResult(local_file, remote_file, size, delta_size, 0, time.time() - start, 1,
+                              SFTPTransfer.VERIFY_MD5, md5)
@@ -0,0 +1,810 @@
+#! /usr/bin/python -tt
+import fnmatch
+import os
+import posixpath
+import socket
+import stat
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from paramiko.sftp import CMD_ATTRS, CMD_DATA, CMD_LSTAT, CMD_READ, CMD_STAT, CMD_STATUS, CMD_WRITE
+from paramiko.sftp_attr import SFTPAttributes
+from paramiko.ssh_exception import SSHException
+
+from lib.RemoteChecksum import ALGORITHMS, RemoteChecksum, new_hash
+from lib.commons.RetryPolicy import RetryPolicy
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+class TransferResult(namedtuple("TransferResult", ["source", "destination", "size", "transferred", "resumed_from",
+                                                     "seconds", "channels", "verified", "checksum"])):
+    """ Result of a file transferred over SFTP.
+
+    size is of the whole file, transferred is the bytes moved by this transfer (less than size when
+    it was resumed from 'resumed_from'). verified is the check the destination passed ('size' or the
+    hash algorithm), checksum is the hex digest of the file when it was verified by a hash.
+    """
+    __slots__ = ()
+
+    @property
+    def mbps(self):
+        return (self.transferred / (1024.0 * 1024)) / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return "{0} -> {1}: {2:.2f} MB in {3:.2f}s ({4:.2f} MB/s, {5} channel(s){6})"\
+            .format(self.source, self.destination, self.transferred / (1024.0 * 1024), self.seconds, self.mbps,
+                    self.channels, ", resumed from {0}".format(self.resumed_from) if self.resumed_from else "")
+
+
+class DirTransferResult(namedtuple("DirTransferResult", ["source", "destination", "files", "directories", "size",
+                                                           "seconds", "failed"])):
+    """ Result of a directory tree transferred over SFTP.
+
+    files and size are of the files transferred, failed is the dict of relative path to the error
+    of the files which couldn't be transferred.
+    """
+    __slots__ = ()
+
+    @property
+    def succeeded(self):
+        return not self.failed
+
+    @property
+    def mbps(self):
+        return (self.size / (1024.0 * 1024)) / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return "{0} -> {1}: {2} files in {3} directories, {4:.2f} MB in {5:.2f}s ({6:.2f} MB/s){7}"\
+            .format(self.source, self.destination, self.files, self.directories, self.size / (1024.0 * 1024),
+                    self.seconds, self.mbps, ", {0} failed".format(len(self.failed)) if self.failed else "")
+
+
+def _join(directory, path):
+    if not path:
+        return directory
+
+    return directory.rstrip("/") + "/" + path if directory else path
+
+
+def _matches(path, patterns):
+    """
+    :param path: Path relative to the top of the tree, '/' separated
+    :return: True if a glob pattern matches the path or just the name in it
+    """
+    return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(posixpath.basename(path), pattern)
+               for pattern in patterns)
+
+
+def walk_local(local_dir, include=None, exclude=None):
+    """
+    :param include: Glob patterns, only the files matching one of them are selected. All of them if None
+    :param exclude: Glob patterns of the files and directories to be left out
+    :return: List of (relative path, os.stat) of the directories, the top one as '', and the same of
+             the files selected by the patterns
+    """
+    include, exclude = SFTPTransfer._patterns(include), SFTPTransfer._patterns(exclude)
+    directories = []
+    files = []
+
+    for root, dirs, names in os.walk(local_dir):
+        relative = os.path.relpath(root, local_dir)
+        relative = "" if relative == os.curdir else relative.replace(os.sep, "/")
+        directories.append((relative, os.stat(root)))
+
+        dirs[:] = sorted(name for name in dirs if not _matches(_join(relative, name), exclude))
+
+        for name in sorted(names):
+            path = _join(relative, name)
+            if os.path.isfile(os.path.join(root, name)) and SFTPTransfer._is_selected(path, include, exclude):
+                files.append((path, os.stat(os.path.join(root, name))))
+
+    return directories, files
+
+
+class _Responses:
+    """ Responses of the pipelined requests, paramiko hands them to this by the request number """
+
+    def __init__(self):
+        self.responses = []
+
+    def _async_response(self, t, msg, num):
+        self.responses.append((num, t, msg))
+
+    def pop_all(self):
+        responses = self.responses
+        self.responses = []
+        return responses
+
+
+STAT_IN_FLIGHT = 256
+
+
+def stat_many(sftp, paths, lstat=False, max_in_flight=STAT_IN_FLIGHT):
+    """
+    Stats all the paths with up to 'max_in_flight' requests waiting on the SFTP client at once, instead of
+    a round trip for each of them
+
+    :param sftp: SFTPClient, not to be used by anyone else meanwhile
+    :param paths: Remote paths
+    :param lstat: Attributes of the symbolic links themselves, rather than of what they point to
+    :return: Dict of path to SFTPAttributes, None for the paths which are not there (or can't be stat'ed)
+    """
+    responses = _Responses()
+    in_flight = {}
+    attributes = {}
+    pending = list(reversed(sorted(set(paths))))
+
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                path = pending.pop()
+                in_flight[sftp._async_request(responses, CMD_LSTAT if lstat else CMD_STAT,
+                                              sftp._adjust_cwd(path))] = path
+
+            sftp._read_response()
+
+            for num, t, msg in responses.pop_all():
+                path = in_flight.pop(num)
+
+                if t == CMD_ATTRS:
+                    attributes[path] = SFTPAttributes._from_msg(msg)
+                    continue
+
+                attributes[path] = None
+                try:
+                    sftp._convert_status(msg)
+                except (IOError, EOFError):
+                    pass
+    except:
+        # Responses of the requests still in flight would come to the next user of the client
+        sftp.close()
+        raise
+
+    return attributes
+
+
+class _Segment:
+    """ Byte range of the file moved over one SFTP channel. 'done' is how far it is complete without
+    any gap, chunks completed beyond that are held in 'completed' till the gap is filled.
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.done = start
+        self.completed = {}
+        self.error = None
+        self.stream_hash = None
+
+    def complete(self, offset, length):
+        self.completed[offset] = offset + length
+
+        while self.done in self.completed:
+            self.done = self.completed.pop(self.done)
+
+    def is_complete(self):
+        return self.done >= self.end
+
+
+class _StreamHash:
+    """ Hash of the local file, computed from the chunks as they are moved rather than by reading the
+    file again afterwards. Chunks come out of order (many in flight, several channels), those a little
+    ahead are held till the gap is filled, the rest is read back from the file at the end.
+    """
+    # Bytes of chunks held ahead of the hashed part
+    MAX_AHEAD = 8 * 1024 * 1024
+
+    def __init__(self, algorithm, local_file):
+        self.algorithm = algorithm
+        self.local_file = local_file
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.digest = new_hash(self.algorithm)
+            self.position = 0
+            self.pending = {}
+
+    def update(self, offset, data):
+        with self.lock:
+            if offset < self.position or offset >= self.position + self.MAX_AHEAD:
+                return
+
+            self.pending[offset] = data
+
+            while self.position in self.pending:
+                data = self.pending.pop(self.position)
+                self.digest.update(data)
+                self.position += len(data)
+
+    def rewind(self, offset):
+        """ Data after offset is to be moved again, e.g., after the destination was cut down to it """
+        if self.position > offset:
+            self.reset()
+
+    def catch_up(self, offset):
+        """ Hashes the file up to offset, reading the part which wasn't hashed on the way """
+        with self.lock:
+            if self.position >= offset:
+                return
+
+            self.pending = {}
+
+            with open(self.local_file, "rb") as fh:
+                fh.seek(self.position)
+
+                while self.position < offset:
+                    data = fh.read(min(1024 * 1024, offset - self.position))
+                    if not data:
+                        break
+                    self.digest.update(data)
+                    self.position += len(data)
+
+    def hexdigest(self, size):
+        """
+        :return: Hex digest of the first 'size' bytes
+        """
+        self.catch_up(size)
+
+        with self.lock:
+            return self.digest.hexdigest()
+
+
+class SFTPTransfer:
+    """ Moves files over SFTP with several chunks requested at once instead of one by one,
+    which is what decides the throughput on links with a high round trip time.
+
+    A file can also be split in to ranges moved over separate SFTP channels in parallel.
+    A transfer that breaks with a connection error is retried from the bytes already
+    in place, and with resume=True a partial destination left by an earlier call is
+    continued too. Destination is verified by its size, and by a hash (md5, sha1, sha256
+    or xxhash) if asked for. The local file is hashed while it is being moved, so that
+    verifying it costs only the hashing on the node.
+
+        transfer = SFTPTransfer(node.ssh_client, channels=4)
+        result = transfer.upload("image.qcow2", "/var/tmp/image.qcow2", resume=True)
+        autopsy_logger.info(str(result))
+    """
+    CHUNK_SIZE = 32768
+    MAX_IN_FLIGHT = 64
+    # Bytes at the end of a partial destination compared with the source before resuming it
+    RESUME_CHECK = 65536
+    # Files of a directory transferred at once, each takes a session of the connection
+    WORKERS = 4
+    RETRY_POLICY = RetryPolicy(attempts=5, base_delay=1, max_delay=15)
+
+    VERIFY_SIZE = "size"
+    VERIFY_MD5 = "md5"
+    VERIFY_SHA1 = "sha1"
+    VERIFY_SHA256 = "sha256"
+    VERIFY_XXHASH = "xxhash"
+
+    # Transfer errors after which it is worth trying again
+    RETRY_ON = (SSHException, socket.error, EOFError)
+
+    def __init__(self, handle, chunk_size=CHUNK_SIZE, max_in_flight=MAX_IN_FLIGHT, channels=1,
+                 retry_policy=RETRY_POLICY, verify=VERIFY_SIZE):
+        """
+        :param handle: SSHHandle of the node
+        :param chunk_size: Bytes asked for (or sent) in one SFTP request
+        :param max_in_flight: Requests waiting for their response at any time, on each channel
+        :param channels: SFTP channels the file is split across
+        :param retry_policy: RetryPolicy for the transfer broken by connection errors
+        :param verify: VERIFY_SIZE, or the hash algorithm: VERIFY_MD5, VERIFY_SHA1, VERIFY_SHA256 or VERIFY_XXHASH
+        """
+        if verify != SFTPTransfer.VERIFY_SIZE and verify not in ALGORITHMS:
+            raise ValueError("verify can be '{0}' or one of {1}".format(SFTPTransfer.VERIFY_SIZE, sorted(ALGORITHMS)))
+
+        if verify != SFTPTransfer.VERIFY_SIZE:
+            # Fails early if it can't be hashed on this side
+            new_hash(verify)
+
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.channels = max(1, channels)
+        self.retry_policy = retry_policy
+        self.verify = verify
+
+    def upload(self, local_file, remote_file, resume=False, quiet=False):
+        """
+        :param resume: Continue from the size of the remote file, if it is not bigger than the local one
+                       and its last bytes match the local file
+        :param quiet: Log the result at debug level
+        :return: TransferResult
+        """
+        size = os.path.getsize(local_file)
+
+        def get_done():
+            with self.handle.get_sftp_connection(label="stat " + remote_file) as sftp:
+                try:
+                    return sftp.stat(remote_file).st_size
+                except IOError:
+                    return None
+
+        def prepare(offset):
+            with self.handle.get_sftp_connection(label="open " + remote_file) as sftp:
+                if offset:
+                    sftp.truncate(remote_file, offset)
+                else:
+                    sftp.open(remote_file, "wb").close()
+
+        return self._transfer(local_file, remote_file, size, resume, get_done, prepare, self._upload_segment, quiet)
+
+    def download(self, remote_file, local_file, resume=False, quiet=False):
+        """
+        :param resume: Continue from the size of the local file, if it is not bigger than the remote one
+                       and its last bytes match the remote file
+        :param quiet: Log the result at debug level
+        :return: TransferResult
+        """
+        with self.handle.get_sftp_connection(label="stat " + remote_file) as sftp:
+            size = sftp.stat(remote_file).st_size
+
+        def get_done():
+            return os.path.getsize(local_file) if os.path.isfile(local_file) else None
+
+        def prepare(offset):
+            with open(local_file, "r+b" if offset else "wb") as fh:
+                fh.truncate(offset)
+
+        return self._transfer(remote_file, local_file, size, resume, get_done, prepare, self._download_segment,
+                              quiet)
+
+    def upload_dir(self, local_dir, remote_dir, include=None, exclude=None, workers=WORKERS, preserve=True):
+        """
+        Uploads the directory tree, 'workers' files at a time. Directories missing on the remote side are created.
+
+        :param include: Glob patterns, only the files matching one of them are uploaded. All of them if None
+        :param exclude: Glob patterns of the files and directories to be left out
+        :param preserve: Keep the permissions and modification times of the files and directories
+        :return: DirTransferResult
+        """
+        start = time.time()
+        directories, files = self._walk_local(local_dir, include, exclude)
+
+        with self.handle.get_sftp_connection(label="mkdir " + remote_dir) as sftp:
+            for relative, _ in directories:
+                self._remote_makedirs(sftp, _join(remote_dir, relative))
+
+        def upload(entry):
+            path, attributes = entry
+            remote_file = _join(remote_dir, path)
+            result = self.upload(os.path.join(local_dir, *path.split("/")), remote_file, quiet=True)
+
+            if preserve:
+                with self.handle.get_sftp_connection(label="setstat " + remote_file) as sftp:
+                    sftp.chmod(remote_file, stat.S_IMODE(attributes.st_mode))
+                    sftp.utime(remote_file, (attributes.st_atime, attributes.st_mtime))
+
+            return result
+
+        results, failed = self._run_files(files, upload, workers)
+
+        # Directories at the end, their times change with every file written in to them
+        if preserve:
+            with self.handle.get_sftp_connection(label="setstat " + remote_dir) as sftp:
+                for relative, attributes in reversed(directories):
+                    sftp.chmod(_join(remote_dir, relative), stat.S_IMODE(attributes.st_mode))
+                    sftp.utime(_join(remote_dir, relative), (attributes.st_atime, attributes.st_mtime))
+
+        return self._dir_result(local_dir, remote_dir, len(directories), results, failed, start)
+
+    def download_dir(self, remote_dir, local_dir, include=None, exclude=None, workers=WORKERS, preserve=True):
+        """
+        Downloads the directory tree, 'workers' files at a time. Symbolic links to files are downloaded as
+        files, links to directories are left out.
+
+        :param include: Glob patterns, only the files matching one of them are downloaded. All of them if None
+        :param exclude: Glob patterns of the files and directories to be left out
+        :param preserve: Keep the permissions and modification times of the files and directories
+        :return: DirTransferResult
+        """
+        include, exclude = self._patterns(include), self._patterns(exclude)
+        start = time.time()
+        directories = []
+        files = []
+
+        with self.handle.get_sftp_connection(label="walk " + remote_dir) as sftp:
+            pending = [("", sftp.stat(remote_dir))]
+
+            while pending:
+                relative, attributes = pending.pop()
+                directories.append((relative, attributes))
+
+                for entry in sorted(sftp.listdir_attr(_join(remote_dir, relative)), key=lambda e: e.filename):
+                    path = _join(relative, entry.filename)
+
+                    if stat.S_ISLNK(entry.st_mode):
+                        try:
+                            entry = sftp.stat(_join(remote_dir, path))
+                        except IOError:
+                            continue
+
+                        # Could be a loop
+                        if stat.S_ISDIR(entry.st_mode):
+                            continue
+
+                    if stat.S_ISDIR(entry.st_mode):
+                        if not _matches(path, exclude):
+                            pending.append((path, entry))
+                    elif stat.S_ISREG(entry.st_mode) and self._is_selected(path, include, exclude):
+                        files.append((path, entry))
+
+        for relative, _ in directories:
+            directory = os.path.join(local_dir, *relative.split("/")) if relative else local_dir
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        def download(entry):
+            path, attributes = entry
+            local_file = os.path.join(local_dir, *path.split("/"))
+            result = self.download(_join(remote_dir, path), local_file, quiet=True)
+
+            if preserve:
+                os.chmod(local_file, stat.S_IMODE(attributes.st_mode))
+                os.utime(local_file, (attributes.st_atime, attributes.st_mtime))
+
+            return result
+
+        results, failed = self._run_files(files, download, workers)
+
+        if preserve:
+            for relative, attributes in reversed(directories):
+                directory = os.path.join(local_dir, *relative.split("/")) if relative else local_dir
+                os.chmod(directory, stat.S_IMODE(attributes.st_mode))
+                os.utime(directory, (attributes.st_atime, attributes.st_mtime))
+
+        return self._dir_result(remote_dir, local_dir, len(directories), results, failed, start)
+
+    def _walk_local(self, local_dir, include, exclude):
+        return walk_local(local_dir, include, exclude)
+
+    @staticmethod
+    def _patterns(patterns):
+        if patterns is None:
+            return []
+
+        return patterns if type(patterns) is list else [patterns]
+
+    @staticmethod
+    def _is_selected(path, include, exclude):
+        return (not include or _matches(path, include)) and not _matches(path, exclude)
+
+    @staticmethod
+    def _remote_makedirs(sftp, directory):
+        """ Creates the remote directory and its parents, those which are not there already """
+        parts = directory.split("/")
+
+        for i in range(1, len(parts) + 1):
+            path = "/".join(parts[:i])
+            if not path or path in (".", "~"):
+                continue
+
+            try:
+                if stat.S_ISDIR(sftp.stat(path).st_mode):
+                    continue
+            except IOError:
+                pass
+
+            sftp.mkdir(path)
+
+    @staticmethod
+    def _run_files(files, transfer, workers):
+        """
+        :param files: List of (relative path, attributes)
+        :param transfer: Function transferring one of them, returning its TransferResult
+        :return: List of TransferResult, dict of relative path to error of the files which failed
+        """
+        results = []
+        failed = {}
+
+        def run(entry):
+            try:
+                results.append(transfer(entry))
+            except SFTPTransfer.RETRY_ON + (IOError, OSError) as e:
+                autopsy_logger.error("Couldn't transfer {0}: {1}".format(entry[0], str(e)))
+                failed[entry[0]] = e
+
+        if len(files) <= 1 or workers <= 1:
+            map(run, files)
+        else:
+            pool = ThreadPool(min(len(files), workers))
+            try:
+                pool.map(run, files)
+            finally:
+                pool.close()
+
+        return results, failed
+
+    @staticmethod
+    def _dir_result(source, destination, directories, results, failed, start):
+        result = DirTransferResult(source, destination, len(results), directories,
+                                   sum(result.transferred for result in results), time.time() - start, failed)
+        (autopsy_logger.error if failed else autopsy_logger.info)(str(result))
+
+        return result
+
+    def _transfer(self, source, destination, size, resume, get_done, prepare, move_segment, quiet):
+        """
+        :param get_done: Function giving the size of the destination, None if it doesn't exist
+        :param prepare: Function creating the destination, or cutting it down to the given size
+        :param move_segment: Function moving a _Segment from source to destination
+        """
+        upload = move_segment == self._upload_segment
+
+        done = get_done() if resume else None
+        if done is None or done > size:
+            done = 0
+
+        if done and not self._partial_matches(source if upload else destination,
+                                              destination if upload else source, done):
+            autopsy_logger.warning("Partial {0} doesn't match {1}, transferring it from the start"
+                                   .format(destination, source))
+            done = 0
+
+        resumed_from = done
+        prepare(done)
+        start = time.time()
+
+        stream_hash = None
+        if self.verify != SFTPTransfer.VERIFY_SIZE:
+            stream_hash = _StreamHash(self.verify, source if upload else destination)
+
+        for attempt in self.retry_policy.attempts():
+            segments = self._split(done, size)
+
+            if stream_hash:
+                # Part already in place (resumed, or moved before the connection broke) is read back
+                stream_hash.catch_up(done)
+
+            for segment in segments:
+                segment.stream_hash = stream_hash
+
+            try:
+                self._run(segments, source, destination, move_segment)
+                break
+            except SFTPTransfer.RETRY_ON as e:
+                done = self._get_done(segments)
+                autopsy_logger.warning("Transfer of {0} broke at {1} of {2} bytes (attempt {3}): {4}"
+                                       .format(source, done, size, attempt, str(e)))
+
+                # Destination is left with only the bytes known to be there, so that it can be resumed
+                # even if this was the last attempt
+                try:
+                    prepare(done)
+                except SFTPTransfer.RETRY_ON + (IOError,):
+                    done = 0
+
+                if stream_hash:
+                    stream_hash.rewind(done)
+        else:
+            raise IOError("Couldn't transfer {0} to {1}, gave up after {2} of {3} bytes"
+                          .format(source, destination, done, size))
+
+        seconds = time.time() - start
+
+        checksum = self._verify(source, destination, size, upload, stream_hash)
+        if checksum is False:
+            if resumed_from:
+                autopsy_logger.warning("{0} doesn't match {1} after resuming from {2}, transferring it again"
+                                       .format(destination, source, resumed_from))
+                return self._transfer(source, destination, size, False, get_done, prepare, move_segment, quiet)
+
+            raise IOError("{0} doesn't match {1} after the transfer ({2} check)"
+                          .format(destination, source, self.verify))
+
+        result = TransferResult(source, destination, size, size - resumed_from, resumed_from, seconds,
+                                len(self._split(resumed_from, size)), self.verify, checksum)
+        (autopsy_logger.debug if quiet else autopsy_logger.info)(str(result))
+
+        return result
+
+    def _partial_matches(self, local_file, remote_file, done):
+        """
+        :param done: Size of the partial destination
+        :return: True if the last RESUME_CHECK bytes before 'done' are the same in both the files
+        """
+        length = min(self.RESUME_CHECK, done)
+
+        try:
+            with open(local_file, "rb") as fh:
+                fh.seek(done - length)
+                local_data = fh.read(length)
+
+            with self.handle.get_sftp_connection(label="check " + remote_file) as sftp:
+                with sftp.open(remote_file, "rb") as remote:
+                    remote.seek(done - length)
+                    remote_data = remote.read(length)
+        except IOError as e:
+            autopsy_logger.debug("Couldn't compare the partial {0}: {1}".format(remote_file, str(e)))
+            return False
+
+        return local_data == remote_data
+
+    def _split(self, offset, size):
+        remaining = size - offset
+        if remaining <= 0:
+            return []
+
+        # Not worth a channel for less than a window of chunks
+        channels = max(1, min(self.channels, remaining // (self.chunk_size * self.max_in_flight)))
+        step = -(-remaining // channels)
+
+        return [_Segment(start, min(start + step, size)) for start in range(offset, size, step)]
+
+    @staticmethod
+    def _get_done(segments):
+        """
+        :return: Bytes from the start of the file known to be in the destination
+        """
+        for segment in segments:
+            if not segment.is_complete():
+                return segment.done
+
+        return segments[-1].end if segments else 0
+
+    def _run(self, segments, source, destination, move_segment):
+        if len(segments) == 1:
+            move_segment(segments[0], source, destination)
+            return
+
+        def run(segment):
+            try:
+                move_segment(segment, source, destination)
+            except Exception as e:
+                segment.error = e
+
+        threads = [threading.Thread(target=run, args=(segment,)) for segment in segments]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        errors = [segment.error for segment in segments if segment.error]
+        if errors:
+            # Connection errors are raised only if there's nothing else, they are the ones retried
+            raise ([e for e in errors if not isinstance(e, SFTPTransfer.RETRY_ON)] or errors)[0]
+
+    def _pipeline(self, sftp, segment, request, on_response):
+        """
+        Keeps up to 'max_in_flight' requests waiting on the SFTP client, till the segment is complete.
+
+        :param request: Function sending the request of (offset, length) with the given _Responses,
+                        returns the request number
+        :param on_response: Function handling the response (type, message) of (offset, length), returns the
+                            bytes it has completed
+        """
+        responses = _Responses()
+        in_flight = {}
+        # Ranges which are to be asked for again, after short reads
+        again = []
+        offset = segment.done
+
+        try:
+            while offset < segment.end or again or in_flight:
+                while len(in_flight) < self.max_in_flight and (again or offset < segment.end):
+                    if again:
+                        chunk = again.pop()
+                    else:
+                        chunk = (offset, min(self.chunk_size, segment.end - offset))
+                        offset += chunk[1]
+
+                    in_flight[request(responses, chunk)] = chunk
+
+                sftp._read_response()
+
+                for num, t, msg in responses.pop_all():
+                    chunk_offset, length = in_flight.pop(num)
+                    completed = on_response(t, msg, chunk_offset, length)
+
+                    if completed:
+                        segment.complete(chunk_offset, completed)
+                    if completed < length:
+                        again.append((chunk_offset + completed, length - completed))
+        except:
+            # Responses of the requests still in flight would come to the next user of the client
+            sftp.close()
+            raise
+
+    @staticmethod
+    def _check_status(sftp, t, msg):
+        if t != CMD_STATUS:
+            raise SSHException("Unexpected SFTP response type: {0}".format(t))
+
+        # Raises IOError (EOFError on end of file) for anything but OK
+        sftp._convert_status(msg)
+
+    def _download_segment(self, segment, remote_file, local_file):
+        with self.handle.get_sftp_connection(label="get {0} {1}-{2}".format(remote_file, segment.start,
+                                                                            segment.end)) as sftp:
+            remote = sftp.open(remote_file, "rb")
+
+            with open(local_file, "r+b") as fh:
+                def request(responses, chunk):
+                    return sftp._async_request(responses, CMD_READ, remote.handle, long(chunk[0]), int(chunk[1]))
+
+                def on_response(t, msg, offset, length):
+                    if t != CMD_DATA:
+                        try:
+                            self._check_status(sftp, t, msg)
+                        except EOFError:
+                            pass
+                        # Not retried, it would only end at the same place again
+                        raise IOError("{0} ended at {1}, it's changed while being read".format(remote_file, offset))
+
+                    data = msg.get_string()
+                    fh.seek(offset)
+                    fh.write(data)
+
+                    if segment.stream_hash:
+                        segment.stream_hash.update(offset, data)
+
+                    return len(data)
+
+                self._pipeline(sftp, segment, request, on_response)
+
+            remote.close()
+
+    def _upload_segment(self, segment, local_file, remote_file):
+        with self.handle.get_sftp_connection(label="put {0} {1}-{2}".format(remote_file, segment.start,
+                                                                            segment.end)) as sftp:
+            remote = sftp.open(remote_file, "r+b")
+
+            with open(local_file, "rb") as fh:
+                def request(responses, chunk):
+                    fh.seek(chunk[0])
+                    data = fh.read(chunk[1])
+                    if len(data) != chunk[1]:
+                        raise IOError("{0} ended at {1}, it's changed while being read".format(local_file,
+                                                                                             chunk[0] + len(data)))
+
+                    if segment.stream_hash:
+                        segment.stream_hash.update(chunk[0], data)
+
+                    return sftp._async_request(responses, CMD_WRITE, remote.handle, long(chunk[0]), data)
+
+                def on_response(t, msg, offset, length):
+                    self._check_status(sftp, t, msg)
+                    return length
+
+                self._pipeline(sftp, segment, request, on_response)
+
+            remote.close()
+
+    def _verify(self, source, destination, size, upload, stream_hash=None):
+        """
+        :param stream_hash: _StreamHash of the local file, when it is to be verified by a hash
+        :return: False if the destination doesn't match, else its hex digest (None if it wasn't hashed)
+        """
+        if upload:
+            local_file, remote_file = source, destination
+        else:
+            local_file, remote_file = destination, source
+
+        with self.handle.get_sftp_connection(label="stat " + remote_file) as sftp:
+            remote_size = sftp.stat(remote_file).st_size
+
+        if remote_size != size or os.path.getsize(local_file) != size:
+            autopsy_logger.error("Size of {0} is {1}, of {2} is {3}, expected {4}"
+                                 .format(local_file, os.path.getsize(local_file), remote_file, remote_size, size))
+            return False
+
+        if not stream_hash:
+            return None
+
+        local_checksum = stream_hash.hexdigest(size)
+        remote_checksum = RemoteChecksum(self.handle, self.verify).checksum(remote_file)
+
+        if remote_checksum != local_checksum:
+            autopsy_logger.error("{0} of {1} is {2}, of {3} is {4}".format(self.verify, local_file, local_checksum,
+                                                                           remote_file, remote_checksum))
+            return False
+
+        return local_checksum
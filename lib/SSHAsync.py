@@ -0,0 +1,355 @@
+#! /usr/bin/python -tt
+import collections
+import os
+import select
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from paramiko.ssh_exception import SSHException
+
+from lib.SSHBatch import BatchScript
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+class CommandFuture:
+    """ Handle to a command submitted to the CommandEngine. Result is a CommandResult """
+
+    def __init__(self, host, command):
+        self.host = host
+        self.command = command
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        :param timeout: Seconds to wait for the command to finish, None to wait forever
+        :return: CommandResult of the command. Raises the exception if the command couldn't be executed
+        """
+        if not self._event.wait(timeout):
+            raise socket.timeout("Command didn't finish in {0} seconds: {1}".format(timeout, self.command))
+
+        if self._exception:
+            raise self._exception
+
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise socket.timeout("Command didn't finish in {0} seconds: {1}".format(timeout, self.command))
+
+        return self._exception
+
+    def add_done_callback(self, func):
+        """
+        :param func: Called with this future once the command finishes, right away if it already did
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+
+        func(self)
+
+    def _set(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                autopsy_logger.exception("Error in done callback of command: " + self.command)
+
+
+class _RunningCommand:
+    def __init__(self, handle, future, script, timeout):
+        self.handle = handle
+        self.future = future
+        self.script = script
+        self.timeout = timeout
+        self.channel = None
+        self.pooled = None
+        self.stdout = []
+        self.stderr = []
+        self.last_activity = time.time()
+
+
+class CommandEngine:
+    """ Runs commands on many nodes concurrently without a thread per command or per node.
+
+    Channel set up (connect, channel open, exec) is done by a small pool of workers, after which
+    the output of all the running commands is read by a single reactor thread multiplexing all the
+    channels with poll(). Every command holds a session slot of its node while running, commands
+    beyond the node's limit wait in a queue without holding any thread, and are started as slots
+    are released (by this engine or by anything else using the node).
+
+    This is what asyncio would give on python 3, with futures instead of awaitables.
+    """
+    SETUP_WORKERS = 8
+    # Seconds
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, setup_workers=SETUP_WORKERS):
+        self.setup_pool = ThreadPool(setup_workers)
+        self.lock = threading.Lock()
+        self.pending = collections.defaultdict(collections.deque)
+        self.running = {}
+        self.exited = []
+        # Handles whose session slot releases start the queued commands
+        self.watched = set()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+        self.reactor = threading.Thread(target=self._reactor_loop, name="CommandEngineReactor")
+        self.reactor.daemon = True
+        self.reactor.start()
+
+    def submit(self, handle, command, sudo=False, timeout=None):
+        """
+        :param handle: SSHHandle of the node to execute the command on
+        :param command: Command to execute. Commands starting with 'sudo ' are executed with sudo
+        :param sudo: To execute the command with sudo
+        :param timeout: Seconds without any output after which the command is given up
+        :return: CommandFuture
+        """
+        future = CommandFuture(handle.hostname or handle.host, command)
+        script = BatchScript([command], sudo=sudo, is_root=handle.user == "root",
+                             feed_password=bool(handle.root_password))
+
+        with self.lock:
+            self.pending[handle].append(_RunningCommand(handle, future, script, timeout))
+
+            if handle not in self.watched:
+                self.watched.add(handle)
+                handle.max_session_lock.add_release_listener(lambda: self._dispatch(handle))
+
+        self._dispatch(handle)
+
+        return future
+
+    def _dispatch(self, handle):
+        """ Starts as many queued commands of the node as its free session slots allow """
+        while True:
+            with self.lock:
+                if not self.pending[handle]:
+                    return
+
+                if not handle.max_session_lock.acquire(False):
+                    return
+
+                running = self.pending[handle].popleft()
+
+            self.setup_pool.apply_async(self._setup, (running,))
+
+    def _setup(self, running):
+        handle = running.handle
+
+        try:
+            if not handle.isConnected():
+                handle.connect()
+
+            running.channel, running.pooled = handle._open_channel(running.timeout)
+            running.channel.exec_command(BatchScript.SHELL_COMMAND)
+            running.channel.sendall(running.script.get_input(handle.root_password))
+            running.channel.shutdown_write()
+            running.channel.setblocking(0)
+        except Exception as e:
+            self._complete(running, exception=e)
+            return
+
+        channel = running.channel
+        running.last_activity = time.time()
+
+        with self.lock:
+            self.running[channel] = running
+
+        os.write(self.wakeup_w, "x")
+
+    def _complete(self, running, result=None, exception=None):
+        if running.channel:
+            running.channel.close()
+
+        if running.pooled:
+            running.handle.pool.release(running.pooled)
+
+        # Starts the next queued command of the node, through the release listener
+        running.handle.max_session_lock.release()
+        running.future._set(result=result, exception=exception)
+
+    def _read(self, running):
+        channel = running.channel
+        got_data = False
+
+        while channel.recv_ready():
+            running.stdout.append(channel.recv(32768))
+            got_data = True
+
+        while channel.recv_stderr_ready():
+            running.stderr.append(channel.recv_stderr(32768))
+            got_data = True
+
+        if got_data:
+            running.last_activity = time.time()
+
+        return (channel.eof_received or channel.closed) \
+            and not channel.recv_ready() and not channel.recv_stderr_ready()
+
+    def _finish(self, running):
+        results = running.script.parse("".join(running.stdout), "".join(running.stderr))
+        if results:
+            self._complete(running, result=results[0])
+        else:
+            self._complete(running, exception=socket.error("Channel closed before the command finished"))
+
+    def _poll(self, channels, timeout):
+        """
+        :return: Set of the channels with something to read. poll() rather than select(), which can't
+                 take file descriptors beyond FD_SETSIZE (1024) that hundreds of nodes easily get to
+        """
+        poller = select.poll()
+        by_fd = {self.wakeup_r: None}
+        poller.register(self.wakeup_r, select.POLLIN)
+
+        for channel in channels:
+            fd = channel.fileno()
+            by_fd[fd] = channel
+            poller.register(fd, select.POLLIN)
+
+        readable = set()
+        for fd, _ in poller.poll(timeout * 1000):
+            if fd == self.wakeup_r:
+                os.read(self.wakeup_r, 4096)
+            else:
+                readable.add(by_fd[fd])
+
+        return readable
+
+    def _reactor_loop(self):
+        while True:
+            try:
+                self._reactor_step()
+            except Exception as e:
+                # Reactor thread dying would leave every command of every node waiting forever
+                autopsy_logger.exception("Command engine failed, failing the commands in progress")
+                self._fail_all(e)
+                time.sleep(self.POLL_INTERVAL)
+
+    def _fail_all(self, exception):
+        with self.lock:
+            running = self.running.values() + self.exited
+            self.running = {}
+            self.exited = []
+
+            pending = []
+            for queue in self.pending.values():
+                pending.extend(queue)
+                queue.clear()
+
+        for command in pending:
+            command.future._set(exception=exception)
+
+        for command in running:
+            try:
+                self._complete(command, exception=exception)
+            except Exception:
+                autopsy_logger.exception("Couldn't clean up command: " + command.future.command)
+
+    def _reactor_step(self):
+        with self.lock:
+            channels = self.running.keys()
+
+        readable = self._poll(channels, self.POLL_INTERVAL if not self.exited else 0.05)
+        now = time.time()
+
+        for channel in channels:
+            with self.lock:
+                running = self.running.get(channel)
+
+            if running is None:
+                continue
+
+            try:
+                if channel in readable and self._read(running):
+                    # Output is complete, exit status follows shortly. Not polling this
+                    #   channel anymore as it would be readable forever after EOF
+                    with self.lock:
+                        del self.running[channel]
+                        self.exited.append(running)
+                    continue
+            except (SSHException, socket.error, EOFError) as e:
+                with self.lock:
+                    del self.running[channel]
+                self._complete(running, exception=e)
+                continue
+
+            if running.timeout is not None and now - running.last_activity > running.timeout:
+                with self.lock:
+                    del self.running[channel]
+                self._complete(running, exception=socket.timeout(
+                    "No output from the command for {0} seconds: {1}".format(running.timeout,
+                                                                             running.future.command)))
+
+        for running in list(self.exited):
+            if running.channel.exit_status_ready() or running.channel.closed \
+                    or now - running.last_activity > 5:
+                with self.lock:
+                    self.exited.remove(running)
+
+                try:
+                    self._finish(running)
+                except Exception as e:
+                    self._complete(running, exception=e)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    :return: Process wide CommandEngine, created on first use
+    """
+    global _engine
+
+    with _engine_lock:
+        if _engine is None:
+            _engine = CommandEngine()
+
+        return _engine
+
+
+def gather(futures, timeout=None, return_exceptions=False):
+    """
+    Waits for all the futures to finish
+
+    :param futures: List of CommandFuture
+    :param timeout: Seconds to wait for all of them together, None to wait forever
+    :param return_exceptions: To have the exception in place of the result for the failed ones
+                              instead of raising the first one
+    :return: List of CommandResult in the same order as futures
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    results = []
+
+    for future in futures:
+        remaining = None if deadline is None else max(0, deadline - time.time())
+        try:
+            results.append(future.result(remaining))
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+
+    return results
@@ -0,0 +1,148 @@
+#! /usr/bin/python -tt
+import pipes
+import re
+import select
+import socket
+import uuid
+
+from lib.CommandResult import CommandResult
+
+__author__ = 'joshisk'
+
+
+def drain_channel(channel, timeout=None):
+    """
+    Reads stdout and stderr of a channel till the remote end closes them. Both are read
+    together, so that a chatty stderr can't stall stdout by eating up the channel window.
+
+    :param channel: Paramiko channel with a command executing on it
+    :param timeout: Seconds to wait for any data before raising socket.timeout (None to wait forever)
+    :return: Tuple of stdout, stderr
+    """
+    stdout = []
+    stderr = []
+
+    while True:
+        got_data = False
+
+        while channel.recv_ready():
+            stdout.append(channel.recv(32768))
+            got_data = True
+
+        while channel.recv_stderr_ready():
+            stderr.append(channel.recv_stderr(32768))
+            got_data = True
+
+        if channel.eof_received and not channel.recv_ready() and not channel.recv_stderr_ready():
+            break
+
+        if channel.closed:
+            break
+
+        if not got_data:
+            readable, _, _ = select.select([channel], [], [], timeout)
+            if not readable:
+                raise socket.timeout("No output from the command for {0} seconds".format(timeout))
+
+    return "".join(stdout), "".join(stderr)
+
+
+class BatchScript:
+    """ Builds a shell script running a list of commands one after the other in a single channel,
+    and splits the output of it back into one CommandResult per command.
+
+    stdout and stderr of every command are followed by a sentinel line carrying the command index,
+    exit status and the time it started and ended on the node.
+    """
+    SHELL_COMMAND = "bash -s"
+
+    def __init__(self, commands, sudo=False, is_root=False, feed_password=False, stop_on_failure=False):
+        """
+        :param commands: List of commands. Commands starting with 'sudo ' are executed with sudo
+        :param sudo: To execute all the commands with sudo
+        :param is_root: If the user is already root, 'sudo' is not used at all
+        :param feed_password: If sudo is to be fed with the root password
+        :param stop_on_failure: Stop at the first command which fails
+        """
+        self.sentinel = "__AUTOPSY_" + uuid.uuid4().hex + "__"
+        self.commands = []
+        self.needs_password = False
+
+        lines = ["__autopsy_ts() { date +%s.%N; }"]
+
+        for i, command in enumerate(commands):
+            command_sudo = sudo
+            if command.startswith("sudo "):
+                command = command.replace("sudo ", "", 1)
+                command_sudo = True
+
+            self.commands.append(command)
+            command = pipes.quote(command)
+
+            if command_sudo and not is_root:
+                if feed_password:
+                    self.needs_password = True
+                    line = "printf '%s\\n' \"$__autopsy_pw\" | sudo -k -S -p '' bash -c " + command
+                else:
+                    line = "sudo -k -S -p '' bash -c " + command + " < /dev/null"
+            else:
+                line = "( eval " + command + " ) < /dev/null"
+
+            lines.append("__autopsy_start=$(__autopsy_ts); " + line + "; __autopsy_rc=$?")
+            lines.append("printf '\\n%s %d %d %s %s\\n' {0} {1} $__autopsy_rc $__autopsy_start $(__autopsy_ts)"
+                         .format(self.sentinel, i))
+            lines.append("printf '\\n%s %d\\n' {0} {1} >&2".format(self.sentinel, i))
+
+            if stop_on_failure:
+                lines.append("[ $__autopsy_rc -eq 0 ] || exit 0")
+
+        self.script = "\n".join(lines) + "\n"
+
+    def get_input(self, password=None):
+        """
+        :param password: Root password, if the script needs one
+        :return: What is to be written to stdin of the shell. Password is read by the shell from stdin
+                 right before the script, so it never shows up in the command line of any process
+        """
+        if self.needs_password:
+            return "IFS= read -r __autopsy_pw\n" + password + "\n" + self.script
+
+        return self.script
+
+    def parse(self, stdout, stderr):
+        """
+        :param stdout: Whole stdout of the script
+        :param stderr: Whole stderr of the script
+        :return: List of CommandResult, one per command that got executed
+        """
+        results = []
+
+        errors = {}
+        last = 0
+        for match in re.finditer(r"\n?" + self.sentinel + r" (\d+)\n", stderr):
+            errors[int(match.group(1))] = stderr[last:match.start()].strip()
+            last = match.end()
+        err_rest = stderr[last:]
+
+        last = 0
+        for match in re.finditer(r"\n?" + self.sentinel + r" (\d+) (-?\d+) (\S+) (\S+)\n", stdout):
+            index = int(match.group(1))
+            try:
+                duration = float(match.group(4)) - float(match.group(3))
+            except ValueError:
+                duration = None
+
+            results.append(CommandResult(command=self.commands[index],
+                                         output=stdout[last:match.start()].strip(),
+                                         stderr=errors.get(index, ""),
+                                         exit_status=int(match.group(2)),
+                                         duration=duration, timings=None))
+            last = match.end()
+
+        # Script got cut in the middle of a command
+        rest = stdout[last:]
+        if (rest.strip() or err_rest.strip()) and len(results) < len(self.commands):
+            results.append(CommandResult(command=self.commands[len(results)], output=rest.strip(),
+                                         stderr=err_rest.strip(), exit_status=-1, duration=None, timings=None))
+
+        return results
@@ -0,0 +1,265 @@
+#! /usr/bin/python -tt
+import socket
+import threading
+import time
+
+from paramiko.ssh_exception import SSHException
+
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+class InstrumentedSemaphore:
+    """ threading.Semaphore which keeps count of the slots in use and of how long callers
+    had to wait for a slot.
+    """
+
+    def __init__(self, value):
+        self.size = value
+        self._semaphore = threading.Semaphore(value)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.acquired = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.release_listeners = []
+
+    def acquire(self, blocking=True):
+        start = time.time()
+
+        # Not blocking at all if a slot is free, so that a wait is counted only when there was one
+        got = self._semaphore.acquire(False)
+        if not got and blocking:
+            got = self._semaphore.acquire()
+
+        if got:
+            wait = time.time() - start
+
+            with self._lock:
+                self.in_use += 1
+                self.acquired += 1
+                if wait > 0.001:
+                    self.waited += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+
+        return got
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+
+        self._semaphore.release()
+
+        for func in self.release_listeners:
+            func()
+
+    def add_release_listener(self, func):
+        """
+        :param func: Called with no arguments after every release, e.g., to hand the slot to a queued caller
+                     which didn't want to block for it
+        """
+        with self._lock:
+            if func not in self.release_listeners:
+                self.release_listeners = self.release_listeners + [func]
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def stats(self):
+        with self._lock:
+            return {"slots": self.size,
+                    "slots_in_use": self.in_use,
+                    "acquired": self.acquired,
+                    "waited": self.waited,
+                    "total_wait": self.total_wait,
+                    "max_wait": self.max_wait,
+                    "avg_wait": (self.total_wait / self.waited) if self.waited else 0.0}
+
+
+class PooledTransport:
+    """ One SSH connection of the pool and the count of channels placed on it """
+
+    def __init__(self, index, client, liveness):
+        self.index = index
+        self.client = client
+        self.liveness = liveness
+        self.channels = 0
+        self.channels_opened = 0
+        self.connecting = False
+        self.connect_failures = 0
+
+    def is_active(self):
+        transport = self.client.get_transport() if self.client else None
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        if self.client:
+            self.client.close()
+
+        self.liveness.mark_dead()
+
+
+class SSHConnectionPool:
+    """ Pool of SSH connections to one host, channels are placed on the least busy of them.
+
+    First connection is the primary one of the SSHHandle, which also carries the shell sessions
+    and SFTP. Rest of them are connected only when the ones already connected have 'max_channels'
+    channels on them each, so a pool of size N costs nothing over a single connection till the
+    parallelism actually needs it.
+
+    No connection gets more than 'max_channels' channels (sshd's MaxSessions is 10 by default),
+    whatever they are for: callers wait for one to be closed when all of them are full. Channels
+    which can only be on the primary connection (SFTP, shells) take a slot with acquire_primary().
+    """
+    # Seconds between the checks for a connection gone down, while waiting for a free slot
+    WAIT_INTERVAL = 1
+
+    def __init__(self, primary_client, primary_liveness, size, max_channels, connect_func, liveness_factory):
+        """
+        :param primary_client: Connected (or to be connected by the owner) paramiko SSHClient
+        :param primary_liveness: TransportLiveness of the primary client
+        :param size: Maximum number of connections to the host
+        :param max_channels: Channels to be placed on a connection before connecting one more
+        :param connect_func: Called with the timeout, returns a new connected SSHClient
+        :param liveness_factory: Returns a new TransportLiveness
+        """
+        self.size = max(1, size)
+        self.max_channels = max_channels
+        self.connect_func = connect_func
+        self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)
+        # Called (without the lock) when all the connections are full, to close channels kept open for reuse
+        self.on_full = None
+        self.transports = [PooledTransport(0, primary_client, primary_liveness)]
+
+        for i in range(1, self.size):
+            self.transports.append(PooledTransport(i, None, liveness_factory()))
+
+    def acquire(self, timeout=None):
+        """
+        :param timeout: Timeout to connect a new connection, if one is needed
+        :return: PooledTransport the next channel is to be opened on, waits till a connection has a free
+                 slot. Give it back with release() once the channel is closed.
+        """
+        need_connect = False
+
+        while True:
+            with self.lock:
+                chosen = None
+                for pooled in sorted(self.transports, key=lambda t: (t.channels, t.index)):
+                    if pooled.is_active():
+                        chosen = pooled
+                        break
+
+                if chosen is None or chosen.channels >= self.max_channels:
+                    idle = [t for t in self.transports if t.index != 0 and not t.connecting and not t.is_active()]
+                    if idle:
+                        chosen = idle[0]
+                        chosen.connecting = True
+                        need_connect = True
+
+                if chosen is None:
+                    # Primary is connected by the owner before asking for a channel, opening the channel
+                    #   fails right away if it isn't
+                    chosen = self.transports[0]
+
+                if need_connect or chosen.channels < self.max_channels or not chosen.is_active():
+                    chosen.channels += 1
+                    chosen.channels_opened += 1
+                    break
+
+            self._wait_for_slot()
+
+        if not need_connect:
+            return chosen
+
+        try:
+            if chosen.client:
+                chosen.client.close()
+            chosen.client = self.connect_func(timeout)
+            chosen.liveness.mark_alive()
+            autopsy_logger.debug("Connected pooled transport #{0}".format(chosen.index))
+            return chosen
+        except (SSHException, socket.timeout, socket.error, EOFError) as e:
+            autopsy_logger.debug("Couldn't connect pooled transport #{0}, using primary: ".format(chosen.index) +
+                                 str(e))
+
+            with self.lock:
+                chosen.channels -= 1
+                chosen.channels_opened -= 1
+                chosen.connect_failures += 1
+
+                primary = self.transports[0]
+                primary.channels += 1
+                primary.channels_opened += 1
+
+            return primary
+        finally:
+            chosen.connecting = False
+
+    def acquire_primary(self, blocking=True, reserve=0):
+        """
+        :param blocking: To wait for a free slot, else None is returned right away when there is none
+        :param reserve: Slots to be left free for the others, for channels held open for long
+        :return: Primary PooledTransport with a slot taken for the channel, give it back with release()
+        """
+        primary = self.transports[0]
+        evicted = False
+
+        while True:
+            with self.lock:
+                if primary.channels < self.max_channels - reserve or not primary.is_active():
+                    primary.channels += 1
+                    primary.channels_opened += 1
+                    return primary
+
+            if blocking:
+                self._wait_for_slot()
+            elif evicted or not self.on_full:
+                return None
+            else:
+                self.on_full()
+                evicted = True
+
+    def _wait_for_slot(self):
+        if self.on_full:
+            self.on_full()
+
+        with self.lock:
+            self.slot_freed.wait(self.WAIT_INTERVAL)
+
+    def release(self, pooled):
+        with self.lock:
+            pooled.channels -= 1
+            self.slot_freed.notify_all()
+
+    def discard(self, pooled):
+        """ Drops a broken non-primary connection, it gets connected again when needed. A connection
+        which is still up is kept, the channel may have been refused for other reasons (e.g., MaxSessions)
+        and other threads have their channels on it
+        """
+        if pooled.index != 0 and not pooled.is_active():
+            pooled.close()
+
+    def close(self):
+        """ Closes all the connections except the primary one, which is owned by the SSHHandle """
+        for pooled in self.transports[1:]:
+            pooled.close()
+
+    def stats(self):
+        with self.lock:
+            return {"size": self.size,
+                    "transports_alive": len([t for t in self.transports if t.is_active()]),
+                    "channels_in_use": sum(t.channels for t in self.transports),
+                    "transports": [{"index": t.index,
+                                    "alive": t.is_active(),
+                                    "channels_in_use": t.channels,
+                                    "channels_opened": t.channels_opened,
+                                    "connect_failures": t.connect_failures} for t in self.transports]}
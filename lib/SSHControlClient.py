@@ -0,0 +1,424 @@
+#! /usr/bin/python -tt
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+import paramiko
+from paramiko.channel import ChannelFile, ChannelStderrFile, ChannelStdinFile
+from paramiko.ssh_exception import SSHException
+
+from lib import SSHControlMaster as proto
+from lib.SSHTuning import SSHTuning
+
+__author__ = 'joshisk'
+
+
+class ControlMasterUnavailable(SSHException):
+    """ Control socket is not there or nobody is listening on it """
+    pass
+
+
+def _request(socket_path, request, timeout=None):
+    """
+    Connects to the control master and sends the hello
+    :return: Tuple of the unix socket and the reply. Raises SSHException if the daemon refused the request
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+
+    try:
+        sock.connect(socket_path)
+    except socket.error as e:
+        sock.close()
+        raise ControlMasterUnavailable("Control master not reachable on {0}: {1}".format(socket_path, str(e)))
+
+    try:
+        proto.send_json(sock, proto.HELLO, request)
+        kind, data = proto.recv_frame(sock)
+    except socket.error:
+        sock.close()
+        raise
+
+    if kind is None:
+        sock.close()
+        raise ControlMasterUnavailable("Control master closed the connection")
+
+    reply = json.loads(data) if data else {}
+
+    if kind == proto.ERROR:
+        sock.close()
+        if reply.get("auth"):
+            raise paramiko.AuthenticationException(reply.get("error"))
+        raise SSHException(reply.get("error"))
+
+    sock.settimeout(None)
+    return sock, reply
+
+
+def control_master_stats(socket_path=proto.DEFAULT_SOCKET):
+    sock, reply = _request(socket_path, {"op": "stats"}, timeout=10)
+    sock.close()
+    return reply
+
+
+def stop_control_master(socket_path=proto.DEFAULT_SOCKET):
+    sock, reply = _request(socket_path, {"op": "stop"}, timeout=10)
+    sock.close()
+
+
+class _SockName:
+    def __init__(self, address):
+        self.address = tuple(address) if address else ("", 0)
+
+    def getsockname(self):
+        return self.address
+
+
+class ControlChannel:
+    """ Channel relayed through the control master. Behaves like a paramiko Channel as far as
+    the framework uses it: recv/recv_stderr with timeouts, select() on it, exit status..etc
+    """
+    # Reading from the control master pauses when this much is waiting to be consumed
+    MAX_BUFFERED = 4 * 1024 * 1024
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.stdout = collections.deque()
+        self.stderr = collections.deque()
+        self.stdout_len = 0
+        self.stderr_len = 0
+        self.eof_received = False
+        self.closed = False
+        self.exit_status = -1
+        self.status_event = threading.Event()
+        self.combine_stderr = False
+        self.timeout = None
+        self.condition = threading.Condition()
+        self.send_lock = threading.Lock()
+        # Readable whenever there is data or EOF, same as paramiko does for select()
+        self._pipe_r, self._pipe_w = os.pipe()
+        self._pipe_set = False
+        self._reader = None
+
+    def _call(self, kind, data=""):
+        proto.send_frame(self.sock, kind, data)
+        reply, data = proto.recv_frame(self.sock)
+
+        if reply == proto.OK:
+            return
+        if reply == proto.ERROR:
+            raise SSHException(json.loads(data).get("error"))
+
+        self._set_closed()
+        raise SSHException("Control master closed the channel")
+
+    def get_pty(self, term="vt100", width=80, height=24, width_pixels=0, height_pixels=0):
+        self._call(proto.PTY, json.dumps({"term": term, "width": width, "height": height,
+                                          "width_pixels": width_pixels, "height_pixels": height_pixels}))
+
+    def exec_command(self, command):
+        self._call(proto.EXEC, command)
+        self._start_reader()
+
+    def invoke_shell(self):
+        self._call(proto.SHELL)
+        self._start_reader()
+
+    def set_combine_stderr(self, combine):
+        self.combine_stderr = combine
+
+    def _start_reader(self):
+        self._reader = threading.Thread(target=self._read_frames, name="ControlChannelReader")
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _set_pipe(self):
+        if not self._pipe_set:
+            self._pipe_set = True
+            os.write(self._pipe_w, "*")
+
+    def _clear_pipe(self):
+        if self._pipe_set and not self.stdout_len and not self.stderr_len \
+                and not self.eof_received and not self.closed:
+            os.read(self._pipe_r, 1)
+            self._pipe_set = False
+
+    def _read_frames(self):
+        try:
+            while True:
+                with self.condition:
+                    while self.stdout_len + self.stderr_len > self.MAX_BUFFERED and not self.closed:
+                        self.condition.wait(1)
+
+                kind, data = proto.recv_frame(self.sock)
+
+                with self.condition:
+                    if kind == proto.STDOUT or (kind == proto.STDERR and self.combine_stderr):
+                        self.stdout.append(data)
+                        self.stdout_len += len(data)
+                    elif kind == proto.STDERR:
+                        self.stderr.append(data)
+                        self.stderr_len += len(data)
+                    elif kind == proto.EOF:
+                        self.eof_received = True
+                    elif kind == proto.EXIT_STATUS:
+                        self.exit_status = struct.unpack("!i", data)[0]
+                        self.status_event.set()
+                    else:
+                        break
+
+                    self._set_pipe()
+                    self.condition.notify_all()
+        except socket.error:
+            pass
+
+        with self.condition:
+            self._set_closed()
+
+    def _set_closed(self):
+        self.eof_received = True
+        self.closed = True
+        self.status_event.set()
+        self._set_pipe()
+        self.condition.notify_all()
+
+    def _recv(self, size, stderr):
+        with self.condition:
+            buffers = self.stderr if stderr else self.stdout
+            deadline = None if self.timeout is None else time.time() + self.timeout
+
+            while not buffers and not self.eof_received:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            if not buffers:
+                if self.eof_received:
+                    return ""
+                raise socket.timeout()
+
+            data = buffers[0]
+            if len(data) > size:
+                buffers[0] = data[size:]
+                data = data[:size]
+            else:
+                buffers.popleft()
+
+            if stderr:
+                self.stderr_len -= len(data)
+            else:
+                self.stdout_len -= len(data)
+
+            self._clear_pipe()
+            self.condition.notify_all()
+            return data
+
+    def recv(self, nbytes):
+        return self._recv(nbytes, False)
+
+    def recv_stderr(self, nbytes):
+        return self._recv(nbytes, True)
+
+    def recv_ready(self):
+        return self.stdout_len > 0
+
+    def recv_stderr_ready(self):
+        return self.stderr_len > 0
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        if self.closed:
+            raise socket.error("Socket is closed")
+
+        with self.send_lock:
+            proto.send_frame(self.sock, proto.STDIN, data)
+
+    def shutdown_write(self):
+        if not self.closed:
+            with self.send_lock:
+                proto.send_frame(self.sock, proto.SHUTDOWN_WRITE)
+
+    def exit_status_ready(self):
+        return self.status_event.is_set()
+
+    def recv_exit_status(self):
+        self.status_event.wait()
+        return self.exit_status
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def setblocking(self, blocking):
+        self.settimeout(None if blocking else 0.0)
+
+    def fileno(self):
+        return self._pipe_r
+
+    def makefile(self, *params):
+        return ChannelFile(*([self] + list(params)))
+
+    def makefile_stderr(self, *params):
+        return ChannelStderrFile(*([self] + list(params)))
+
+    def makefile_stdin(self, *params):
+        return ChannelStdinFile(*([self] + list(params)))
+
+    def close(self):
+        if self.sock:
+            try:
+                with self.send_lock:
+                    proto.send_frame(self.sock, proto.CLOSE)
+            except socket.error:
+                pass
+
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+
+        with self.condition:
+            self._set_closed()
+
+    def __del__(self):
+        for fd in (self._pipe_r, self._pipe_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class ControlTransport:
+    """ Stands in for the paramiko Transport of a ControlClient """
+
+    def __init__(self, client):
+        self.client = client
+        self.sock = _SockName(client.local_address)
+
+    def is_active(self):
+        return self.client.active
+
+    def open_session(self, timeout=None):
+        return self.client.open_channel(timeout)
+
+    def send_ignore(self, byte_count=None):
+        self.client.probe()
+
+    def set_keepalive(self, interval):
+        # Keepalives are sent by the control master
+        pass
+
+
+class ControlClient:
+    """ Drop in replacement of paramiko SSHClient which gets its channels from the control master
+    instead of its own transport, so that the handshake is done once for all the runs.
+
+    SFTP can't be relayed this way (its state lives in the client), so open_sftp() makes a direct
+    connection on first use and keeps it for the rest.
+    """
+
+    def __init__(self, socket_path=proto.DEFAULT_SOCKET, tuning=None):
+        """
+        :param socket_path: Unix socket of the control master
+        :param tuning: SSHTuning of the connection, used by the control master when it connects to the host
+        """
+        self.socket_path = socket_path
+        self.tuning = tuning
+        self.request = None
+        self.active = False
+        self.local_address = None
+        self.reused = False
+        self.direct = None
+        self.pkey = None
+        self.lock = threading.Lock()
+
+    def connect(self, hostname, port=22, username=None, password=None, pkey_file=None, timeout=None):
+        self.request = {"host": hostname, "port": port, "user": username, "password": password,
+                        "pkey_file": pkey_file, "timeout": timeout,
+                        "tuning": self.tuning.to_json() if self.tuning else None}
+
+        sock, reply = _request(self.socket_path, dict(self.request, op="connect"), timeout)
+        sock.close()
+
+        self.active = True
+        self.reused = reply.get("reused", False)
+        self.local_address = reply.get("local_address")
+
+    def probe(self):
+        try:
+            sock, reply = _request(self.socket_path, dict(self.request, op="probe"),
+                                   self.request.get("timeout"))
+            sock.close()
+        except (SSHException, socket.error):
+            self.active = False
+            raise
+
+    def get_transport(self):
+        return ControlTransport(self) if self.active else None
+
+    def open_channel(self, timeout=None):
+        if not self.active:
+            raise SSHException("Not connected")
+
+        try:
+            sock, reply = _request(self.socket_path, dict(self.request, op="open", timeout=timeout), timeout)
+        except ControlMasterUnavailable:
+            self.active = False
+            raise
+
+        return ControlChannel(sock)
+
+    def exec_command(self, command, bufsize=-1, timeout=None, get_pty=False, environment=None):
+        channel = self.open_channel(timeout)
+        if get_pty:
+            channel.get_pty()
+        channel.settimeout(timeout)
+        channel.exec_command(command)
+
+        return channel.makefile_stdin("wb", bufsize), channel.makefile("r", bufsize), \
+            channel.makefile_stderr("r", bufsize)
+
+    def invoke_shell(self, term="vt100", width=80, height=24, width_pixels=0, height_pixels=0):
+        channel = self.open_channel()
+        channel.get_pty(term, width, height, width_pixels, height_pixels)
+        channel.invoke_shell()
+
+        return channel
+
+    def open_sftp(self):
+        with self.lock:
+            transport = self.direct.get_transport() if self.direct else None
+
+            if not (transport and transport.is_active()):
+                self.direct = paramiko.SSHClient()
+                self.direct.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+                pkey = None
+                if self.request.get("pkey_file"):
+                    pkey = paramiko.RSAKey.from_private_key_file(self.request["pkey_file"])
+
+                (self.tuning if self.tuning else SSHTuning()).connect(
+                    self.direct, hostname=self.request["host"], port=self.request["port"],
+                    username=self.request["user"], password=self.request.get("password"),
+                    pkey=pkey, timeout=self.request.get("timeout"))
+
+        return self.direct.open_sftp()
+
+    def close(self):
+        self.active = False
+
+        with self.lock:
+            if self.direct:
+                self.direct.close()
+                self.direct = None
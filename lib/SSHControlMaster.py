@@ -0,0 +1,358 @@
+#! /usr/bin/python -tt
+import errno
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+import paramiko
+from paramiko.ssh_exception import SSHException
+
+from lib.SSHTuning import SSHTuning
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+# Every message on the control socket is a frame of one byte kind, four byte length and the data.
+#   A connection to the control socket starts with a HELLO and the reply to it. For 'open' it then
+#   carries exactly one channel: PTY/EXEC/SHELL requests (each answered with OK/ERROR) followed by
+#   the data of the channel both ways till CLOSE.
+FRAME_HEADER = struct.Struct("!cI")
+
+HELLO = "H"
+OK = "K"
+ERROR = "R"
+PTY = "P"
+EXEC = "S"
+SHELL = "V"
+STDIN = "I"
+SHUTDOWN_WRITE = "W"
+STDOUT = "O"
+STDERR = "E"
+EOF = "F"
+EXIT_STATUS = "X"
+CLOSE = "C"
+
+DEFAULT_SOCKET = os.getenv("AUTOPSY_CONTROL_SOCKET",
+                           "/tmp/autopsy-control-{0}/control.sock".format(os.getuid()))
+
+
+def send_frame(sock, kind, data=""):
+    sock.sendall(FRAME_HEADER.pack(kind, len(data)) + data)
+
+
+def send_json(sock, kind, obj):
+    send_frame(sock, kind, json.dumps(obj))
+
+
+def _recv_exact(sock, size):
+    chunks = []
+
+    while size > 0:
+        data = sock.recv(min(size, 65536))
+        if not data:
+            return None
+
+        chunks.append(data)
+        size -= len(data)
+
+    return "".join(chunks)
+
+
+def recv_frame(sock):
+    """
+    :return: Tuple of kind and data of the next frame, (None, None) if the other end closed the socket
+    """
+    header = _recv_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None, None
+
+    kind, length = FRAME_HEADER.unpack(header)
+    data = _recv_exact(sock, length) if length else ""
+    if data is None:
+        return None, None
+
+    return kind, data
+
+
+class ControlMaster:
+    """ Local daemon holding authenticated SSH transports for runner processes, same idea
+    as OpenSSH ControlMaster.
+
+    Runners ask for channels over a Unix socket and the channel data is relayed over the same
+    socket connection, so a run against hosts already known to the daemon pays neither TCP nor
+    SSH handshakes. Transports are keyed by host, port and user and are re-established when they die.
+    """
+    # Seconds
+    CONNECT_TIMEOUT = 10
+    KEEPALIVE_INTERVAL = 15
+    POLL_INTERVAL = 1.0
+    RECV_SIZE = 32768
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, idle_timeout=None):
+        """
+        :param socket_path: Unix socket to listen on, its directory is made accessible only to this user
+        :param idle_timeout: Seconds without any client after which the daemon exits, None to run forever
+        """
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.transports = {}
+        self.transport_locks = {}
+        self.lock = threading.Lock()
+        self.clients = 0
+        self.channels_opened = 0
+        self.last_activity = time.time()
+        self.running = False
+        self.server = None
+
+    def _listen(self):
+        directory = os.path.dirname(self.socket_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                probe.close()
+                raise socket.error(errno.EADDRINUSE, "Control master already running on " + self.socket_path)
+            except socket.error as e:
+                if e.errno == errno.EADDRINUSE:
+                    raise
+                # Stale socket of a daemon that is gone
+                os.remove(self.socket_path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0177)
+        try:
+            self.server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+
+        self.server.listen(128)
+
+    def serve_forever(self):
+        self._listen()
+        self.running = True
+        autopsy_logger.info("Control master listening on " + self.socket_path)
+
+        try:
+            while self.running:
+                readable, _, _ = select.select([self.server], [], [], self.POLL_INTERVAL)
+
+                if not readable:
+                    if self.idle_timeout and self.clients == 0 \
+                            and time.time() - self.last_activity > self.idle_timeout:
+                        autopsy_logger.info("Control master idle for {0}s, exiting".format(self.idle_timeout))
+                        break
+                    continue
+
+                conn, _ = self.server.accept()
+                thread = threading.Thread(target=self._handle, args=(conn,), name="ControlMasterClient")
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.running = False
+
+        if self.server:
+            self.server.close()
+            self.server = None
+
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+        with self.lock:
+            for client in self.transports.values():
+                client.close()
+            self.transports = {}
+
+    def _get_client(self, request, fresh=False):
+        """
+        :param request: Hello of the runner, with host, port, user and the credentials
+        :param fresh: Connect again even if there is a transport which looks alive
+        :return: Tuple of connected SSHClient and whether it was reused
+        """
+        key = (request["host"], int(request["port"]), request["user"])
+
+        with self.lock:
+            lock = self.transport_locks.setdefault(key, threading.Lock())
+
+        with lock:
+            client = self.transports.get(key)
+            transport = client.get_transport() if client else None
+
+            if not fresh and transport and transport.is_active():
+                return client, True
+
+            if client:
+                client.close()
+
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+            pkey = None
+            if request.get("pkey_file"):
+                pkey = paramiko.RSAKey.from_private_key_file(request["pkey_file"])
+
+            # Transport is shared by all the runs, so tuning of the run which connected it stays
+            tuning = SSHTuning.from_json(request.get("tuning")) or SSHTuning()
+            tuning.connect(client, hostname=key[0], port=key[1], username=key[2], password=request.get("password"),
+                           pkey=pkey, timeout=request.get("timeout") or self.CONNECT_TIMEOUT,
+                           allow_agent=False, look_for_keys=False)
+            client.get_transport().set_keepalive(self.KEEPALIVE_INTERVAL)
+            autopsy_logger.info("Control master connected to {0}@{1}:{2}".format(key[2], key[0], key[1]))
+
+            with self.lock:
+                self.transports[key] = client
+
+            return client, False
+
+    def stats(self):
+        with self.lock:
+            return {"clients": self.clients,
+                    "channels_opened": self.channels_opened,
+                    "transports": ["{0}@{1}:{2}".format(user, host, port)
+                                   for (host, port, user), client in self.transports.items()
+                                   if client.get_transport() and client.get_transport().is_active()]}
+
+    def _handle(self, conn):
+        with self.lock:
+            self.clients += 1
+            self.last_activity = time.time()
+
+        try:
+            kind, data = recv_frame(conn)
+            if kind != HELLO:
+                return
+
+            request = json.loads(data)
+            op = request.get("op")
+
+            if op == "stats":
+                send_json(conn, OK, self.stats())
+            elif op == "stop":
+                send_json(conn, OK, {})
+                self.running = False
+            elif op in ("connect", "open", "probe"):
+                self._handle_host(conn, request)
+            else:
+                send_json(conn, ERROR, {"error": "Unknown operation: " + str(op)})
+        except (SSHException, socket.error, EOFError, ValueError, KeyError) as e:
+            autopsy_logger.debug("Control master client error: " + str(e))
+        finally:
+            conn.close()
+
+            with self.lock:
+                self.clients -= 1
+                self.last_activity = time.time()
+
+    def _handle_host(self, conn, request):
+        op = request["op"]
+
+        try:
+            client, reused = self._get_client(request)
+            transport = client.get_transport()
+
+            if op == "probe":
+                transport.send_ignore()
+            elif op == "open":
+                try:
+                    channel = transport.open_session(timeout=request.get("timeout"))
+                except (SSHException, socket.error, EOFError):
+                    # Transport may have died just now, one more try on a fresh one
+                    client, reused = self._get_client(request, fresh=True)
+                    transport = client.get_transport()
+                    channel = transport.open_session(timeout=request.get("timeout"))
+        except paramiko.AuthenticationException as e:
+            send_json(conn, ERROR, {"error": str(e), "auth": True})
+            return
+        except (SSHException, socket.error, EOFError, IOError) as e:
+            send_json(conn, ERROR, {"error": str(e)})
+            return
+
+        send_json(conn, OK, {"reused": reused, "local_address": transport.sock.getsockname()[:2]})
+
+        if op != "open":
+            return
+
+        with self.lock:
+            self.channels_opened += 1
+
+        try:
+            if self._setup_channel(conn, channel):
+                self._relay(conn, channel)
+        finally:
+            channel.close()
+
+    @staticmethod
+    def _setup_channel(conn, channel):
+        """
+        Handles the requests of the runner till the command (or shell) gets started
+        :return: False if the runner went away before that
+        """
+        while True:
+            kind, data = recv_frame(conn)
+
+            try:
+                if kind == PTY:
+                    channel.get_pty(**json.loads(data))
+                    send_json(conn, OK, {})
+                elif kind == EXEC:
+                    channel.exec_command(data)
+                    send_json(conn, OK, {})
+                    return True
+                elif kind == SHELL:
+                    channel.invoke_shell()
+                    send_json(conn, OK, {})
+                    return True
+                else:
+                    return False
+            except (SSHException, EOFError) as e:
+                send_json(conn, ERROR, {"error": str(e)})
+
+    def _relay(self, conn, channel):
+        eof_sent = False
+        status_sent = False
+
+        while True:
+            # Channel is readable forever after EOF, so it is polled instead of selected on after that
+            readable, _, _ = select.select([conn] + ([] if eof_sent else [channel]), [], [],
+                                           0.05 if eof_sent else self.POLL_INTERVAL)
+
+            while channel.recv_ready():
+                send_frame(conn, STDOUT, channel.recv(self.RECV_SIZE))
+
+            while channel.recv_stderr_ready():
+                send_frame(conn, STDERR, channel.recv_stderr(self.RECV_SIZE))
+
+            if not eof_sent and channel.eof_received and not channel.recv_ready() \
+                    and not channel.recv_stderr_ready():
+                send_frame(conn, EOF)
+                eof_sent = True
+
+            if not status_sent and channel.exit_status_ready():
+                send_frame(conn, EXIT_STATUS, struct.pack("!i", channel.recv_exit_status()))
+                status_sent = True
+
+            if channel.closed and not channel.recv_ready() and not channel.recv_stderr_ready():
+                send_frame(conn, CLOSE)
+                return
+
+            if conn in readable:
+                kind, data = recv_frame(conn)
+
+                if kind == STDIN:
+                    channel.sendall(data)
+                elif kind == SHUTDOWN_WRITE:
+                    channel.shutdown_write()
+                else:
+                    # Runner closed the channel or went away
+                    return
@@ -0,0 +1,86 @@
+#! /usr/bin/python -tt
+import re
+import socket
+import time
+
+__author__ = 'joshisk'
+
+
+class ChannelExpect:
+    """ Minimal expect on a paramiko channel, to answer interactive prompts of a command
+    the moment they show up instead of sleeping for a fixed time before every input.
+
+    Everything read from the channel while waiting is kept in 'buffer', so that the caller can
+    prepend it to the rest of the command output.
+    """
+    # Anything on a line which is not yet terminated is most likely a prompt waiting for input
+    DEFAULT_PROMPT = r'[^\r\n]+\Z'
+    # Seconds
+    DEFAULT_TIMEOUT = 30
+    RECV_SIZE = 32768
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.buffer = ""
+        self.finished = False
+        # Prompts are searched only in the output which came after the last input sent
+        self.mark = 0
+        self.last_sent = None
+        self.waits = []
+
+    def expect(self, pattern=DEFAULT_PROMPT, timeout=DEFAULT_TIMEOUT, consume=False):
+        """
+        :param pattern: Regex of the prompt to wait for
+        :param timeout: Seconds to wait for the prompt
+        :param consume: Remove the matched prompt from the buffer, so that it doesn't show up in the output
+        :return: True if the prompt showed up, False on timeout or if the command finished without it
+        """
+        regex = re.compile(pattern)
+        start = time.time()
+        old_timeout = self.channel.gettimeout()
+
+        try:
+            while True:
+                match = regex.search(self.buffer, self.mark)
+
+                # Echo of our own last input is not a prompt
+                if match and self.last_sent and match.group(0).strip() == self.last_sent:
+                    self.mark = match.end()
+                    self.last_sent = None
+                    continue
+
+                if match:
+                    if consume:
+                        self.buffer = self.buffer[:match.start()] + self.buffer[match.end():]
+                        self.mark = match.start()
+                    else:
+                        self.mark = match.end()
+
+                    return self._record(pattern, start, True)
+
+                remaining = start + timeout - time.time()
+                if self.finished or remaining <= 0:
+                    return self._record(pattern, start, False)
+
+                self.channel.settimeout(remaining)
+                try:
+                    data = self.channel.recv(self.RECV_SIZE)
+                except socket.timeout:
+                    continue
+
+                if not data:
+                    self.finished = True
+                    continue
+
+                self.buffer += data
+        finally:
+            self.channel.settimeout(old_timeout)
+
+    def send(self, data):
+        self.channel.sendall(data)
+        self.mark = len(self.buffer)
+        self.last_sent = data.strip() or None
+
+    def _record(self, pattern, start, matched):
+        self.waits.append({"prompt": pattern, "seconds": time.time() - start, "matched": matched})
+        return matched
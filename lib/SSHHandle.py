@@ -1,5 +1,6 @@
 #! /usr/bin/python -tt
 import os
+import re
 import socket
 import threading
 import time
@@ -7,6 +8,17 @@ import time
 import paramiko
 from paramiko.ssh_exception import SSHException
 
+from lib.CommandOutput import CommandOutput, OutputRetention
+from lib.CommandResult import CommandResult
+from lib.CommandTimings import CommandTiming
+from lib.SSHBatch import BatchScript, drain_channel
+from lib.SSHConnectionPool import InstrumentedSemaphore, SSHConnectionPool
+from lib.SSHControlClient import ControlClient, ControlMasterUnavailable
+from lib.SSHExpect import ChannelExpect
+from lib.SSHShellSession import ShellSession, ShellSessionError
+from lib.SSHStream import CommandStream
+from lib.SSHTuning import SSHTuning, measure_throughput
+from lib.commons.RetryPolicy import CircuitBreaker, CircuitOpenError, RetryPolicy
 from lib.core import autopsy_globals
 from lib.core.autopsy_globals import autopsy_logger
 
@@ -17,25 +29,226 @@ class SSHError(Exception):
     pass
 
 
+class TransportLiveness:
+    """ Keeps track of whether an SSH transport is known to be alive, so that every command
+    doesn't have to pay for a health check round trip before it runs.
+
+    Keepalives are enabled on the transport at connect time, so paramiko itself notices a dead
+    peer and marks the transport inactive. Every channel that opens successfully on the transport
+    refreshes the 'known alive' state, and a real probe goes on the wire only when nothing
+    has been seen for 'ttl' seconds.
+    """
+    # Seconds
+    DEFAULT_TTL = 10
+    KEEPALIVE_INTERVAL = 15
+    PROBE_TIMEOUT = 5
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.last_seen_alive = 0
+        self.probes_done = 0
+        self.probes_skipped = 0
+        self.probes_failed = 0
+        self.lock = threading.Lock()
+
+    def mark_alive(self):
+        self.last_seen_alive = time.time()
+
+    def mark_dead(self):
+        self.last_seen_alive = 0
+
+    def is_fresh(self):
+        return (time.time() - self.last_seen_alive) < self.ttl
+
+    def check(self, transport):
+        """
+        :param transport: paramiko transport to check
+        :return: True if the transport is alive, probing it only if the cached state has expired
+        """
+        if not (transport and transport.is_active()):
+            self.mark_dead()
+            return False
+
+        with self.lock:
+            if self.is_fresh():
+                self.probes_skipped += 1
+                return True
+
+            self.probes_done += 1
+
+            try:
+                transport.send_ignore()
+                transport.open_session(timeout=self.PROBE_TIMEOUT).close()
+            except (SSHException, socket.timeout, socket.error, EOFError):
+                self.probes_failed += 1
+                self.mark_dead()
+                return False
+
+            self.mark_alive()
+            return True
+
+    def stats(self):
+        return {"probes_done": self.probes_done,
+                "probes_skipped": self.probes_skipped,
+                "probes_failed": self.probes_failed,
+                "known_alive": self.is_fresh()}
+
+
+class SFTPClientPool:
+    """ SFTP clients of an SSHHandle kept open between the operations, instead of a channel and
+    SFTP version negotiation for every stat.
+
+    A client is given out again only if its channel is still open, its transport is alive and the
+    handle hasn't connected again since it was opened. Anything else gets closed and a new one opened.
+    Idle clients hold a session (channel) on the server each, so the pool is to be kept small. They keep
+    their slot of the primary connection too, and are closed when some other channel needs the slot.
+    """
+    DEFAULT_SIZE = 2
+
+    def __init__(self, parent, size=DEFAULT_SIZE):
+        """
+        :param parent: SSHHandle
+        :param size: Maximum number of idle clients kept
+        """
+        self.parent = parent
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def _is_healthy(self, sftp_client, generation):
+        if generation != self.parent.connect_generation:
+            return False
+
+        channel = sftp_client.get_channel()
+        transport = channel.get_transport() if channel else None
+
+        return channel is not None and not channel.closed and transport is not None and transport.is_active()
+
+    def acquire(self):
+        """
+        :return: Tuple of SFTPClient, the connect generation it belongs to and the PooledTransport slot its
+                 channel holds. Give them back with release()
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    self.misses += 1
+                    break
+
+                sftp_client, generation, pooled = self.idle.pop()
+
+            if self._is_healthy(sftp_client, generation):
+                with self.lock:
+                    self.hits += 1
+                return sftp_client, generation, pooled
+
+            with self.lock:
+                self.discarded += 1
+            self._close(sftp_client, pooled)
+
+        # SFTP is only on the primary connection, its channel counts against its slots
+        pooled = self.parent.pool.acquire_primary()
+        generation = self.parent.connect_generation
+
+        try:
+            return self.parent.handle.open_sftp(), generation, pooled
+        except:
+            self.parent.pool.release(pooled)
+            raise
+
+    def release(self, sftp_client, generation, pooled, broken=False):
+        """
+        :param broken: Client hit a connection error, it is closed instead of being kept
+        """
+        if not broken and self.size > 0 and self._is_healthy(sftp_client, generation):
+            # Relative paths of the next user are not to be resolved against this user's directory
+            sftp_client.chdir(None)
+
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append((sftp_client, generation, pooled))
+                    return
+
+        self._close(sftp_client, pooled)
+
+    def _close(self, sftp_client, pooled):
+        try:
+            sftp_client.close()
+        except (SSHException, socket.error, EOFError):
+            pass
+        finally:
+            self.parent.pool.release(pooled)
+
+    def evict(self):
+        """ Closes the least recently used idle client, giving its slot to a channel waiting for one """
+        with self.lock:
+            if not self.idle:
+                return
+            sftp_client, generation, pooled = self.idle.pop(0)
+            self.discarded += 1
+
+        self._close(sftp_client, pooled)
+
+    def clear(self):
+        """ Closes all the idle clients """
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+
+        for sftp_client, generation, pooled in idle:
+            self._close(sftp_client, pooled)
+
+    def stats(self):
+        with self.lock:
+            return {"size": self.size,
+                    "idle": len(self.idle),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "discarded": self.discarded}
+
+
 class SFTPClientExtended:
-        def __init__(self, parent):
+        def __init__(self, parent, label=None):
             self.parent = parent
             self.sftp_client = None
+            self.generation = None
+            self.pooled = None
+            self.timing = CommandTiming(parent.hostname if parent.hostname else parent.host,
+                                        label if label else "sftp", kind="sftp")
+            self.start = None
 
         def __enter__(self):
-            self.parent.max_session_lock.acquire()
-
-            if not self.parent.isConnected():
-                self.parent.connect()
+            with self.timing.phase("session_wait"):
+                self.parent.max_session_lock.acquire()
 
-            self.sftp_client = self.parent.handle.open_sftp()
+            try:
+                if not self.parent.isConnected():
+                    with self.timing.phase("connect"):
+                        self.parent.connect()
+
+                with self.timing.phase("sftp_open"):
+                    self.sftp_client, self.generation, self.pooled = self.parent.sftp_pool.acquire()
+            except:
+                self.parent.max_session_lock.release()
+                self.timing.finish(-1)
+                raise
+
+            self.parent.liveness.mark_alive()
+            self.start = time.time()
             return self.sftp_client
 
         def __exit__(self, exc_type, exc_val, exc_tb):
+            self.timing.add("operation", time.time() - self.start)
+
             if self.sftp_client:
-                self.sftp_client.close()
+                broken = exc_type is not None and issubclass(exc_type, (SSHException, socket.error, EOFError))
+                self.parent.sftp_pool.release(self.sftp_client, self.generation, self.pooled, broken=broken)
 
             self.parent.max_session_lock.release()
+            self.timing.finish(0 if exc_type is None else -1)
 
 
 class SSHHandle:
@@ -46,11 +259,23 @@ class SSHHandle:
     PKEY_BASED = 1
     # Seconds
     EXEC_TIMEOUT = 5 * 60
+    PROMPT_TIMEOUT = ChannelExpect.DEFAULT_TIMEOUT
     SSH_PORT = 22
+    # Prompt asked to sudo, so that it can be recognised and taken off from the output
+    SUDO_PROMPT = "__AUTOPSY_SUDO_PROMPT__"
+    # 'attempts' of connect policy is overridden by the 'retries' of connect()
+    CONNECT_RETRY_POLICY = RetryPolicy(attempts=3, base_delay=1, max_delay=15, deadline=5 * 60)
+    EXEC_RETRY_POLICY = RetryPolicy(attempts=3, base_delay=0.1, max_delay=1)
+    # Consecutive failed connects after which the host is taken as down, and seconds till it is probed again
+    CIRCUIT_FAILURE_THRESHOLD = 2
+    CIRCUIT_RESET_TIMEOUT = 30
 
     def __init__(self, host, user, password=None,
                  pkey_file=None, root_password=None,
-                 hostname=None, port=SSH_PORT, max_sessions=7):
+                 hostname=None, port=SSH_PORT, max_sessions=7,
+                 liveness_ttl=TransportLiveness.DEFAULT_TTL, persistent_session=False,
+                 privileged_session=False, pool_size=1, control_socket=None, tuning=None,
+                 output_retention=None, sftp_pool_size=SFTPClientPool.DEFAULT_SIZE):
         """
         :param host: IP address (or DNSable hostname)
         :param user: Username to login to SSH
@@ -59,7 +284,25 @@ class SSHHandle:
         :param root_password: Root password for Sudo Commands
         :param hostname: Hostname for textual representation of this machine
         :param port: If you want to use non-default SSH Port
-        :param max_sessions: Maximum simultaneous sessions to be allowed over this handle
+        :param max_sessions: Maximum simultaneous sessions (channels of any kind) to be allowed over each
+                             connection of this handle, to stay within sshd's MaxSessions
+        :param liveness_ttl: Seconds for which the connection is trusted to be alive without probing it again
+        :param persistent_session: Run commands in one long lived shell session instead of a new
+                                   channel per command. Falls back to a channel per command when the
+                                   command needs inputs or the session breaks.
+        :param privileged_session: Run sudo commands in one root shell elevated once, instead of
+                                   authenticating with sudo for every command. Re-elevates if the root
+                                   shell dies, falls back to sudo per command if it can't.
+        :param pool_size: Number of SSH connections to the host. Connections beyond the first one are
+                          made only when 'max_sessions' channels are busy on each of the connected ones.
+        :param control_socket: Unix socket of the control master (main/control_master.py) to get the channels
+                               from, instead of connecting to the host directly. AUTOPSY_CONTROL_SOCKET by default.
+                               Falls back to a direct connection if the control master is not running.
+        :param tuning: SSHTuning of ciphers, MACs, compression, window and packet sizes of the connections.
+                       paramiko defaults if None
+        :param output_retention: OutputRetention, bytes of a command's output held in memory beyond which it
+                                 is spilled to a file. 1MB by default
+        :param sftp_pool_size: SFTP clients kept open for reuse, 0 to open one for every operation
         :return:
         """
         self.host = host
@@ -68,13 +311,32 @@ class SSHHandle:
         self.last_executed_command = ""
         self.last_executed_command_inp_values = []
         self.shell_channel = None
+        self.shell_channel_pooled = None
+        self.persistent_session = persistent_session
+        self.shell_session = None
+        self.shell_session_lock = threading.Lock()
+        self.privileged_session = privileged_session
+        self.root_shell_session = None
+        self.root_shell_session_lock = threading.Lock()
         self.connected = False
         self.stderr_last_command = ""
         self.stdout_last_command = ""
+        self.prompt_waits_last_command = []
         self.hostname = hostname
         self.port = port if port else SSHHandle.SSH_PORT
-        self.max_session_lock = threading.Semaphore(max_sessions)
+        self.pool_size = max(1, pool_size)
+        self.max_session_lock = InstrumentedSemaphore(max_sessions * self.pool_size)
         self.connect_lock = threading.RLock()
+        self.liveness = TransportLiveness(ttl=liveness_ttl)
+        # Attempts, seconds taken and error of the last connect
+        self.last_connect = None
+        # Goes up on every successful connect, things opened on an older connection are not to be reused
+        self.connect_generation = 0
+        self.connect_retry_policy = SSHHandle.CONNECT_RETRY_POLICY
+        self.exec_retry_policy = SSHHandle.EXEC_RETRY_POLICY
+        self.breaker = CircuitBreaker(hostname if hostname else host,
+                                      failure_threshold=SSHHandle.CIRCUIT_FAILURE_THRESHOLD,
+                                      reset_timeout=SSHHandle.CIRCUIT_RESET_TIMEOUT)
 
         if pkey_file is not None:
             if os.path.exists(pkey_file):
@@ -110,9 +372,83 @@ class SSHHandle:
         else:
             self.root_password = password
 
-        self.handle = paramiko.SSHClient()
+        self.tuning = tuning if tuning else SSHTuning()
+        self.output_retention = output_retention if output_retention else OutputRetention()
+        self.control_socket = control_socket if control_socket else autopsy_globals.autopsy_control_socket
+        self.handle = self._new_client(control=True)
+        self.pool = SSHConnectionPool(self.handle, self.liveness, self.pool_size, max_sessions,
+                                      connect_func=self._connect_pooled,
+                                      liveness_factory=lambda: TransportLiveness(ttl=liveness_ttl))
+        self.sftp_pool = SFTPClientPool(self, size=sftp_pool_size)
+        # Idle SFTP clients give up their slots when the channels of the primary connection run out
+        self.pool.on_full = self.sftp_pool.evict
+
+    def _new_client(self, control=False):
+        """
+        :param control: To get the channels through the control master, if there is one
+        :return: SSHClient (or ControlClient) yet to be connected
+        """
+        if control and self.control_socket:
+            return ControlClient(self.control_socket, tuning=self.tuning)
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-        self.handle.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        return client
+
+    def _connect_client(self, client, timeout):
+        if isinstance(client, ControlClient):
+            client.connect(hostname=self.host, port=self.port, username=self.user,
+                           password=self.password if self.conn_type == self.PASSWORD_BASED else None,
+                           pkey_file=self.pkey_file if self.conn_type == self.PKEY_BASED else None,
+                           timeout=timeout)
+            return
+
+        if self.conn_type == self.PASSWORD_BASED:
+            self.tuning.connect(client, hostname=self.host, username=self.user,
+                                password=self.password, timeout=timeout, port=self.port)
+        else:
+            self.tuning.connect(client, hostname=self.host, username=self.user,
+                                pkey=self.pkey, timeout=timeout, port=self.port)
+
+        client.get_transport().set_keepalive(TransportLiveness.KEEPALIVE_INTERVAL)
+
+    def _connect_pooled(self, timeout):
+        """
+        :return: New connected SSHClient for the connection pool
+        """
+        client = self._new_client()
+        try:
+            self._connect_client(client, timeout if timeout is not None else 10)
+        except:
+            client.close()
+            raise
+
+        return client
+
+    def _open_channel(self, timeout):
+        """
+        Opens a session channel on the least busy connection of the pool
+        :param timeout:
+        :return: Tuple of channel and PooledTransport it is on. PooledTransport is to be given back
+                 with pool.release() once the channel is closed.
+        """
+        for attempt in self.exec_retry_policy.attempts():
+            pooled = self.pool.acquire(timeout)
+
+            try:
+                channel = pooled.client.get_transport().open_session(timeout=timeout)
+                pooled.liveness.mark_alive()
+                return channel, pooled
+            except (SSHException, socket.timeout, socket.error, EOFError, AttributeError) as e:
+                pooled.liveness.mark_dead()
+                self.pool.release(pooled)
+                self.pool.discard(pooled)
+                autopsy_logger.debug("Exception opening channel, retrying: " + str(e))
+
+        autopsy_logger.critical("Couldn't open a channel. Probably n/w issue or timeout")
+        self.connected = False
+        raise SSHError("Error opening channel")
 
     def connect(self, retries=3, timeout=10):
         """ Connect to the SSH server
@@ -124,36 +460,76 @@ class SSHHandle:
             if self.isConnected():
                 return
 
+            # Host known to be down fails right away, till a cheap probe finds it back
+            self.breaker.check()
+            if self.breaker.state == CircuitBreaker.HALF_OPEN:
+                self._probe_port()
+
             autopsy_logger.debug("Connecting to host: " + self.host)
 
-            while retries > 0:
+            start = time.time()
+            self.last_connect = {"attempts": 0, "seconds": 0.0, "error": None}
+            error = None
+
+            for attempt in self.connect_retry_policy.copy(attempts=retries).attempts():
+                self.last_connect["attempts"] = attempt
+
                 try:
                     self.connected = False
 
-                    if self.conn_type == self.PASSWORD_BASED:
-                        self.handle.connect(hostname=self.host, username=self.user,
-                                            password=self.password, timeout=timeout, port=self.port)
-                    else:
-                        self.handle.connect(hostname=self.host, username=self.user,
-                                            pkey=self.pkey, timeout=timeout, port=self.port)
+                    try:
+                        self._connect_client(self.handle, timeout)
+                    except ControlMasterUnavailable as e:
+                        autopsy_logger.warning("Control master not available, connecting directly: " + str(e))
+                        self.control_socket = None
+                        self.handle = self._new_client()
+                        self.pool.transports[0].client = self.handle
+                        self._connect_client(self.handle, timeout)
 
+                    self.liveness.mark_alive()
                     self.connected = True
+                    self.connect_generation += 1
+                    self.last_connect["seconds"] = time.time() - start
+                    self.breaker.record_success()
 
                     return
                 except paramiko.AuthenticationException as e:
                     autopsy_logger.critical("Authentication failed:" + e.message)
                     self.connected = False
+                    self.last_connect.update(seconds=time.time() - start, error=str(e))
+                    # Host did answer, so the circuit (possibly half-open) is closed again
+                    self.breaker.record_success()
                     raise e
                 except (socket.error, SSHException) as e:
-                    if retries > 1:
-                        autopsy_logger.critical("Error connecting to {0}, retrying...: ".format(self.host) + e.message)
-                    elif retries == 1:
-                        autopsy_logger.critical("Error connecting to {0}, exiting...: ".format(self.host) + e.message)
-                        self.connected = False
-                        raise e
+                    error = e
+                    if attempt < retries:
+                        autopsy_logger.critical("Error connecting to {0}, retrying...: ".format(self.host) + str(e))
+                except Exception as e:
+                    autopsy_logger.critical("Error connecting to {0}: ".format(self.host) + str(e))
+                    self.connected = False
+                    self.last_connect.update(seconds=time.time() - start, error=str(e))
+                    self.breaker.record_failure()
+                    raise
+
+            autopsy_logger.critical("Error connecting to {0}, exiting...: ".format(self.host) + str(error))
+            self.connected = False
+            self.last_connect.update(seconds=time.time() - start, error=str(error))
+            self.breaker.record_failure()
+            raise error
+
+    def _probe_port(self):
+        """
+        Checks if the SSH port of the host accepts connections at all, before paying for a full connect.
+        Raises CircuitOpenError (and keeps the circuit open) if it doesn't.
+        """
+        if isinstance(self.handle, ControlClient):
+            return
 
-                time.sleep(2)
-                retries -= 1
+        try:
+            socket.create_connection((self.host, self.port), timeout=TransportLiveness.PROBE_TIMEOUT).close()
+        except socket.error as e:
+            self.breaker.record_failure()
+            raise CircuitOpenError("{0} is still down: {1}".format(self.host, str(e)))
 
     def close_async(self):
         """
@@ -165,6 +541,8 @@ class SSHHandle:
         if self.shell_channel:
             self.shell_channel.close()
             self.shell_channel = None
+            self.pool.release(self.shell_channel_pooled)
+            self.shell_channel_pooled = None
             self.max_session_lock.release()
 
     def execute_async(self, commands, timeout=EXEC_TIMEOUT):
@@ -199,17 +577,186 @@ class SSHHandle:
 
         if not self.shell_channel:
             self.max_session_lock.acquire()
-            self.shell_channel = self.handle.invoke_shell()
+            pooled = self.pool.acquire_primary()
+
+            try:
+                self.shell_channel = self.handle.invoke_shell()
+            except:
+                self.pool.release(pooled)
+                self.max_session_lock.release()
+                raise
+
+            self.shell_channel_pooled = pooled
 
         for command in commands:
             self.shell_channel.send(command + "& \n")
 
+    def close_session(self):
+        """
+        To close the persistent shell sessions (normal and privileged) of this handle, if any.
+        They get opened again on the next command if still enabled.
+        :return:
+        """
+        if self.shell_session:
+            self.shell_session.close()
+            self.shell_session = None
+
+        if self.root_shell_session:
+            self.root_shell_session.close()
+            self.root_shell_session = None
+
+    def _get_session(self, privileged):
+        """
+        :param privileged: To get the root shell session instead of the normal one
+        :return: Active shell session, opened (or re-opened if the earlier one died) if needed.
+                 None if it can't be opened.
+        """
+        session = self.root_shell_session if privileged else self.shell_session
+        if session and session.is_alive():
+            return session
+
+        if session:
+            session.close()
+
+        # Session holds a slot of the primary connection for as long as it is open, one is left
+        #   for the exec channels so that commands falling back to them don't wait on the session
+        pooled = self.pool.acquire_primary(blocking=False, reserve=1)
+        if pooled is None:
+            autopsy_logger.debug("No free session slot for a shell session, falling back to exec channel")
+            session = None
+        else:
+            session = ShellSession(self.handle.get_transport(), name=self.hostname,
+                                   privileged=privileged, root_password=self.root_password,
+                                   on_close=lambda: self.pool.release(pooled))
+            try:
+                session.open()
+            except (ShellSessionError, socket.timeout) as e:
+                autopsy_logger.debug("Couldn't open " + ("privileged " if privileged else "") +
+                                     "shell session, falling back to exec channel: " + str(e))
+                session.close()
+                session = None
+
+        if privileged:
+            self.root_shell_session = session
+        else:
+            self.shell_session = session
+
+        return session
+
+    def _execute_in_session(self, command, timeout, quiet, privileged=False, timing=None):
+        """
+        Runs the command in the persistent shell session, or in the root shell session if privileged
+        :param timing: CommandTiming to add the time taken in the session to
+        :return: CommandResult, or None if the session couldn't be used and the command
+                 was not run. Caller is expected to fall back to a channel per command then.
+        """
+        lock = self.root_shell_session_lock if privileged else self.shell_session_lock
+        name = self.hostname if self.hostname else self.host
+
+        # Some other thread is using the session, no point in waiting for it
+        if not lock.acquire(False):
+            return None
+
+        try:
+            # One more attempt on a fresh session, if the one we had died in the mean time
+            for attempt in range(2):
+                session = self._get_session(privileged)
+                if not session:
+                    return None
+
+                if attempt == 0:
+                    self._log_command(("(root session) " if privileged else "") + command, quiet)
+
+                start = time.time()
+                # Same retention as of the output of a channel, stderr comes combined with it in the session
+                output = self.output_retention.collector(name + "_stdout")
+                try:
+                    output, exit_status = session.run(command, timeout=timeout, output=output)
+                except ShellSessionError as e:
+                    autopsy_logger.debug("Shell session broken: " + str(e))
+                    session.close()
+                    continue
+                except socket.timeout:
+                    session.close()
+                    # Closes the spill file, if the output got that far
+                    output.getvalue()
+                    raise
+
+                self.liveness.mark_alive()
+
+                if timing:
+                    timing.add("session", time.time() - start)
+                    timing.exit_status = exit_status
+
+                return self._finish_command(command, output.getvalue(), "", exit_status, quiet)
+
+            autopsy_logger.debug("Falling back to exec channel")
+            return None
+        finally:
+            lock.release()
+
+    def _log_command(self, command, quiet):
+        if not quiet:
+            autopsy_logger.info("Exec Cmd" +
+                                ((" (" + self.hostname + "): ") if self.hostname else ": ") + command, bold=True)
+        else:
+            autopsy_logger.debug("Executing command " +
+                                 ((" (" + self.hostname + "): ") if self.hostname else ": ") + command, bold=True)
+
+    def _finish_command(self, command, output, error, exit_status, quiet):
+        """
+        Book keeping of the last command's status and logging of its output
+        :param output: String, or CommandOutput if it was collected as per the retention already
+        :return: CommandResult, output and stderr of it stripped and as CommandOutput
+        """
+        name = self.hostname if self.hostname else self.host
+        if not isinstance(output, CommandOutput):
+            output = self.output_retention.collect(name + "_stdout", output if output is not None else "")
+        if not isinstance(error, CommandOutput):
+            error = self.output_retention.collect(name + "_stderr", error if error is not None else "")
+
+        # Only for the callers from before execute_result, these get overwritten by the commands of other
+        #   threads using this handle
+        self.exit_status_last_command = exit_status
+        self.stderr_last_command = error
+        self.stdout_last_command = output
+
+        if not quiet:
+            autopsy_logger.info(output)
+        else:
+            autopsy_logger.debug(output)
+
+        if output.spilled:
+            autopsy_logger.info("Output is {0} bytes, only the first {1} are kept in memory, whole of it is in {2}"
+                                .format(output.size, len(output), output.path))
+
+        if exit_status != 0:
+            if error:
+                autopsy_logger.info(error)
+
+        return CommandResult(command=command, output=output, stderr=error, exit_status=exit_status, duration=None,
+                             timings=None)
+
     def execute(self, command, inputValues=None,
-                timeout=EXEC_TIMEOUT, quiet=False, sudo=False):
+                timeout=EXEC_TIMEOUT, quiet=False, sudo=False, prompt_timeout=PROMPT_TIMEOUT):
+        """
+        Same as execute_result, but gives out only the output. Exit status is left in exit_status_last_command,
+        which is not reliable when the handle is used from more than one thread.
+
+        :return: Returns the output of the command
+        """
+        return self.execute_result(command, inputValues=inputValues, timeout=timeout, quiet=quiet, sudo=sudo,
+                                   prompt_timeout=prompt_timeout).output
+
+    def execute_result(self, command, inputValues=None,
+                       timeout=EXEC_TIMEOUT, quiet=False, sudo=False, prompt_timeout=PROMPT_TIMEOUT):
         """
         :param sudo:
         :param inputValues: List if you need to answer some interactive questions
-                        in the command. Pass in the same order they may occur in command output
+                        in the command. Pass in the same order they may occur in command output.
+                        Each input is sent as soon as a prompt shows up. An input can be a tuple of
+                        (prompt regex, value) if the prompt can't be recognised by default
+        :param prompt_timeout: Seconds to wait for each prompt to show up before sending the input anyway
         :param quiet:
         :param timeout: Timeout if the command is taking long time to return
         :param command: Command to execute in the SSH terminal
@@ -222,135 +769,319 @@ class SSHHandle:
                         Pass 'inputValues' list if you need to answer some interactive questions
                         in the command. Pass in the same order they may occur in command output
 
-        :return: Returns the output of the command
+        :return: CommandResult of the command, with the time taken in each phase in its 'timings'.
+                 Nothing of it is shared with other commands, so a handle can be used from many threads at once
         """
+        timing = CommandTiming(self.hostname if self.hostname else self.host, command)
 
-        with self.max_session_lock:
-            if not self.isConnected():
-                # Retrying 10 times, when this host was connected some time back and
-                #    now reconnecting because of some problem.
-                # Otherwise, if it is first time being connected retry only 2 times as
-                #    it doesn't make much sense to waste time.
-                # Same is the case with timeout
+        with timing.phase("session_wait"):
+            self.max_session_lock.acquire()
+
+        try:
+            result = self._execute(timing, command, inputValues, timeout, quiet, sudo, prompt_timeout)
+        finally:
+            self.max_session_lock.release()
+            timing.finish()
+
+        return result._replace(duration=timing.total, timings=dict(timing.phases))
+
+    def _execute(self, timing, command, inputValues, timeout, quiet, sudo, prompt_timeout):
+        """
+        execute, with a session slot already held. Time of every phase is added to the timing
+        """
+        if not self.isConnected():
+            # Retrying 10 times, when this host was connected some time back and
+            #    now reconnecting because of some problem.
+            # Otherwise, if it is first time being connected retry only 2 times as
+            #    it doesn't make much sense to waste time.
+            # Same is the case with timeout
+            with timing.phase("connect"):
                 self.connect(retries=10 if self.connected else 1,
                              timeout=min(timeout, (60 if self.connected else 10)))
 
-            if not inputValues:
-                inputValues = []
+        if not inputValues:
+            inputValues = []
 
-            if type(inputValues) is not list:
-                inputValues = [inputValues]
+        if type(inputValues) is not list:
+            inputValues = [inputValues]
 
-            if command.startswith("sudo"):
-                command = command.replace("sudo ", "")
-                sudo = True
+        if command.startswith("sudo"):
+            command = command.replace("sudo ", "")
+            sudo = True
 
-            feed_password = False
-            if sudo and self.user != "root":
-                if "bash " in command:
-                    autopsy_logger.critical("Executing sudo commands with bash is not supported")
-                    return "Executing sudo commands with bash is not supported"
+        feed_password = False
+        if sudo and self.user != "root":
+            if "bash " in command:
+                autopsy_logger.critical("Executing sudo commands with bash is not supported")
+                return CommandResult(command=command, output="Executing sudo commands with bash is not supported",
+                                     stderr="", exit_status=-1, duration=None, timings=None)
 
-                # Escape double-quotes if the command is having double quotes in itself
-                command = command.replace('"', '\\"')
-                command = "sudo -k -S -p '' bash -c \"{0}\"".format(command)
-                feed_password = self.root_password is not None and len(self.root_password) > 0
+            if self.privileged_session and not inputValues:
+                self.last_executed_command = command
+                self.last_executed_command_inp_values = inputValues
 
-            self.last_executed_command = command
-            self.last_executed_command_inp_values = inputValues
+                result = self._execute_in_session(command, timeout, quiet, privileged=True, timing=timing)
+                if result is not None:
+                    return result
 
-            retries = 3
-            stdin, stdout, stderr = None, None, None
+            # Escape double-quotes if the command is having double quotes in itself
+            command = command.replace('"', '\\"')
+            feed_password = self.root_password is not None and len(self.root_password) > 0
+            command = "sudo -k -S -p '{1}' bash -c \"{0}\"".format(command,
+                                                                 self.SUDO_PROMPT if feed_password else "")
 
-            while retries > 0:
-                try:
-                    if not quiet:
-                        autopsy_logger.info("Exec Cmd" +
-                                            ((" (" + self.hostname + "): ") if self.hostname else ": ") + command, bold=True)
-                    else:
-                        autopsy_logger.debug("Executing command " +
-                                             ((" (" + self.hostname + "): ") if self.hostname else ": ") + command, bold=True)
-                    stdin, stdout, stderr = self.handle.exec_command(command=command,
-                                                                     timeout=timeout if timeout is not None
-                                                                     else self.EXEC_TIMEOUT, get_pty=True)
+        self.last_executed_command = command
+        self.last_executed_command_inp_values = inputValues
 
-                    if stdin and stdout and stderr:
-                        break
-                except (SSHException, socket.timeout, socket.error, EOFError) as e:
-                    if retries == 0:
-                        autopsy_logger.error("Error executing command even after retries")
-                        self.connected = False
-                        raise e
+        if self.persistent_session and not inputValues and not feed_password:
+            result = self._execute_in_session(command, timeout, quiet, timing=timing)
+            if result is not None:
+                return result
 
-                    autopsy_logger.debug("Exception executing command, retrying")
+        stdin, stdout, stderr = None, None, None
+        pooled = None
+        started = False
 
-                retries -= 1
-                time.sleep(0.1)
+        for attempt in self.exec_retry_policy.attempts():
+            pooled = self.pool.acquire(timeout)
+            channel = None
 
-            if retries <= 0:
-                autopsy_logger.critical("Couldn't execute the command. Probably n/w issue or timeout: " + command)
-                self.connected = False
-                raise SSHError("Error executing command")
+            try:
+                self._log_command(command, quiet)
+
+                with timing.phase("channel_open"):
+                    channel = pooled.client.get_transport().open_session(timeout=timeout if timeout is not None
+                                                                         else self.EXEC_TIMEOUT)
+                    channel.get_pty()
+
+                with timing.phase("exec"):
+                    channel.settimeout(timeout if timeout is not None else self.EXEC_TIMEOUT)
+                    channel.exec_command(command)
+
+                stdin, stdout, stderr = channel.makefile_stdin("wb"), channel.makefile("r"), \
+                    channel.makefile_stderr("r")
+
+                if stdin and stdout and stderr:
+                    pooled.liveness.mark_alive()
+                    started = True
+                    break
+            except (SSHException, socket.timeout, socket.error, EOFError, AttributeError) as e:
+                if channel:
+                    channel.close()
+                pooled.liveness.mark_dead()
+                self.pool.discard(pooled)
+                autopsy_logger.debug("Exception executing command, retrying: " + str(e))
+
+            self.pool.release(pooled)
+
+        if not started:
+            autopsy_logger.critical("Couldn't execute the command. Probably n/w issue or timeout: " + command)
+            self.connected = False
+            raise SSHError("Error executing command")
 
-            # Give a bit of time for the prompt to show up.
-            # It works even without this sleep. But if we send the password before prompt, it
-            #   gets reflected back on to stdout and password is visible
+        try:
+            # Inputs are sent only after their prompt shows up. If we send the password before the
+            #   prompt, it gets reflected back on to stdout and password is visible.
             # Same is the case with any interactive inputs too.
-            time.sleep(0.1)
+            expect = ChannelExpect(stdout.channel)
 
             try:
-                if feed_password and stdin:
-                    stdin.write(self.root_password + "\n")
+                if feed_password:
+                    if expect.expect(re.escape(self.SUDO_PROMPT), timeout=prompt_timeout, consume=True):
+                        expect.send(self.root_password + "\n")
+                    else:
+                        autopsy_logger.debug("Sudo didn't ask for the password, not sending it")
             except socket.error:
                 pass
 
             try:
-                if inputValues is not None and len(inputValues) > 0 and stdin:
-                    for inp in inputValues:
-                        # Same as above sleep for root password
-                        time.sleep(0.1)
-                        if len(inp) == 1 and ord(inp) < 32:
-                            # This IF condition means the input is a special character like, Ctrl + '['
-                            # But we need to wait a little more time otherwise this command gets executed so fast that
-                            #   even the required prompt will be taken off for the previous command to get executed.
-                            #
-                            #   e.g., dlpause 1, dlclose 1, Ctrl + '[', quit
-                            #      In the above commands, dlclose 1 may be skipped as the next command executed fast and
-                            #   left the prompt.
-
-                            time.sleep(1)
-                            stdin.write(inp)
-                        else:
-                            autopsy_logger.debug("Inputting ----> : " + inp)
-                            stdin.write(inp + "\n")
-
-                        stdin.flush()
+                for inp in inputValues:
+                    prompt = ChannelExpect.DEFAULT_PROMPT
+                    if type(inp) in (tuple, list):
+                        prompt, inp = inp
+
+                    if not expect.expect(prompt, timeout=prompt_timeout):
+                        if expect.finished:
+                            autopsy_logger.warning("Command finished before taking all the input values")
+                            break
+
+                        autopsy_logger.debug("Prompt didn't show up in time, sending the input anyway")
+
+                    if len(inp) == 1 and ord(inp) < 32:
+                        # This IF condition means the input is a special character like, Ctrl + '['
+                        expect.send(inp)
+                    else:
+                        autopsy_logger.debug("Inputting ----> : " + inp)
+                        expect.send(inp + "\n")
 
             except socket.error:
                 autopsy_logger.warning("Command finished before taking all the input values")
 
-            output = stdout.read() if stdout else ""
-            error = stderr.read() if stderr else ""
-            output = output.strip() if output is not None else ""
-            error = error.strip() if error is not None else ""
+            self.prompt_waits_last_command = expect.waits
+            timing.add("prompt_wait", sum(wait["seconds"] for wait in expect.waits))
+            for wait in expect.waits:
+                autopsy_logger.debug("Waited {0:.3f}s for prompt '{1}'{2}".format(wait["seconds"], wait["prompt"],
+                                                                                  "" if wait["matched"] else
+                                                                                  " (not seen)"))
+
+            name = self.hostname if self.hostname else self.host
+            with timing.phase("read"):
+                output = self.output_retention.collector(name + "_stdout")
+                output.write(expect.buffer)
+                expect.buffer = ""
+                while True:
+                    data = stdout.read(32768)
+                    if not data:
+                        break
+                    output.write(data)
+
+                error = self.output_retention.collector(name + "_stderr")
+                while True:
+                    data = stderr.read(32768)
+                    if not data:
+                        break
+                    error.write(data)
 
-            self.exit_status_last_command = stdout.channel.recv_exit_status()
-            self.stderr_last_command = error
-            self.stdout_last_command = output
+                timing.exit_status = stdout.channel.recv_exit_status()
 
-            if not quiet:
-                autopsy_logger.info(output)
-            else:
-                autopsy_logger.debug(output)
+            return self._finish_command(command, output.getvalue(), error.getvalue(), timing.exit_status, quiet)
+        finally:
+            self.pool.release(pooled)
+
+    def execute_batch(self, commands, stop_on_failure=False, timeout=EXEC_TIMEOUT, quiet=False, sudo=False):
+        """
+        Executes a list of commands one after the other in a single channel, instead of a channel
+        (and a round trip) per command
+
+        :param commands: List of commands. Commands starting with 'sudo ' are executed with sudo
+        :param stop_on_failure: Don't execute the rest of the commands once a command fails
+        :param timeout: Timeout if there is no output from the commands for this long
+        :param quiet:
+        :param sudo: To execute all the commands with sudo
+        :return: List of CommandResult, one for each command that got executed, in the same order
+        """
+        if not commands:
+            return []
+
+        if type(commands) is not list:
+            commands = [commands]
+
+        timing = CommandTiming(self.hostname if self.hostname else self.host,
+                               "; ".join(commands), kind="batch")
+        start = time.time()
+
+        with self.max_session_lock:
+            timing.add("session_wait", time.time() - start)
+
+            try:
+                if not self.isConnected():
+                    with timing.phase("connect"):
+                        self.connect(retries=10 if self.connected else 1,
+                                     timeout=min(timeout, (60 if self.connected else 10)))
+
+                feed_password = self.root_password is not None and len(self.root_password) > 0
+                script = BatchScript(commands, sudo=sudo, is_root=self.user == "root",
+                                     feed_password=feed_password, stop_on_failure=stop_on_failure)
 
-            if self.exit_status_last_command != 0:
-                if error:
-                    autopsy_logger.info(error)
+                for i, command in enumerate(commands):
+                    self._log_command("[{0}/{1}] ".format(i + 1, len(commands)) + command, quiet)
 
-            return output
+                with timing.phase("channel_open"):
+                    channel, pooled = self._open_channel(timeout)
 
-    def get_sftp_connection(self):
-        return SFTPClientExtended(self)
+                try:
+                    with timing.phase("exec"):
+                        channel.exec_command(BatchScript.SHELL_COMMAND)
+                        channel.sendall(script.get_input(self.root_password))
+                        channel.shutdown_write()
+
+                    with timing.phase("read"):
+                        output, error = drain_channel(channel, timeout=timeout)
+                finally:
+                    channel.close()
+                    self.pool.release(pooled)
+
+                results = script.parse(output, error)
+                if results:
+                    timing.exit_status = results[-1].exit_status
+
+                for result in results:
+                    self._finish_command(result.command, result.output, result.stderr, result.exit_status, quiet)
+
+                if len(results) < len(commands):
+                    autopsy_logger.debug("Executed {0} out of {1} commands".format(len(results), len(commands)))
+
+                return results
+            finally:
+                timing.finish()
+
+    def execute_iter(self, command, timeout=EXEC_TIMEOUT, quiet=False, sudo=False, stdin=False, combine_stderr=True):
+        """
+        Executes the command and gives out its output as it arrives, instead of reading all of it
+        in to memory. Output is not logged and not kept in stdout_last_command.
+
+        :param command: Command to execute. Command starting with 'sudo ' is executed with sudo
+        :param timeout: Timeout if there is no output from the command for this long
+        :param quiet:
+        :param sudo:
+        :param stdin: To keep the stdin of the command open, for the stream's write(). It is to be closed
+                      with close_stdin() once everything is written. With sudo, what is written reaches
+                      the command after sudo has taken the root password
+        :param combine_stderr: False to keep stderr out of the output, for commands writing binary data
+                               to stdout. It is read with the stream's read_stderr()
+        :return: CommandStream, iterate over it for lines (or its chunks() for raw chunks).
+                 Close it (or use it as a context manager) if you stop reading before the end
+        """
+        if command.startswith("sudo "):
+            command = command.replace("sudo ", "", 1)
+            sudo = True
+
+        sudo = sudo and self.user != "root"
+        feed_password = sudo and self.root_password is not None and len(self.root_password) > 0
+
+        # Slot is held till the stream gets closed
+        self.max_session_lock.acquire()
+
+        try:
+            if not self.isConnected():
+                self.connect(retries=10 if self.connected else 1,
+                             timeout=min(timeout, (60 if self.connected else 10)))
+
+            self.last_executed_command = command
+            self.last_executed_command_inp_values = []
+            self._log_command(("(sudo) " if sudo else "") + command, quiet)
+
+            channel, pooled = self._open_channel(timeout)
+        except:
+            self.max_session_lock.release()
+            raise
+
+        def release():
+            self.pool.release(pooled)
+            self.max_session_lock.release()
+
+        try:
+            channel.set_combine_stderr(combine_stderr)
+            channel.exec_command(CommandStream.wrap_command(command, sudo=sudo, feed_password=feed_password,
+                                                            stdin=stdin))
+
+            if feed_password:
+                channel.sendall(self.root_password + "\n")
+            if not stdin:
+                channel.shutdown_write()
+        except:
+            channel.close()
+            release()
+            raise
+
+        return CommandStream(channel, command, timeout=timeout, on_close=release)
+
+    def get_sftp_connection(self, label=None):
+        """
+        :param label: What is being done over the connection, e.g., 'put <file>', for the timings
+        :return: Context manager giving out an SFTP client
+        """
+        return SFTPClientExtended(self, label)
 
     def disconnect(self):
         """ Disconnect from SSH server
@@ -362,9 +1093,14 @@ class SSHHandle:
         autopsy_logger.info("Disconnecting host: " + self.host)
 
         self.close_async()
+        self.close_session()
+        self.sftp_pool.clear()
+        self.pool.close()
         if self.handle:
             self.handle.close()
 
+        self.liveness.mark_dead()
+
     def isConnected(self):
         """
         :return: True if connected to SSH else returns False
@@ -374,17 +1110,68 @@ class SSHHandle:
             return False
 
         transport = self.handle.get_transport() if self.handle else None
-        if not (transport and transport.is_active()):
-            return False
 
-        try:
-            transport.send_ignore()
-        except EOFError:
-            return False
+        return self.liveness.check(transport)
 
-        try:
-            self.handle.exec_command('', timeout=5)
-        except (SSHException, socket.timeout, socket.error, EOFError):
-            return False
+    def get_liveness_stats(self):
+        """
+        :return: Counters of liveness probes done/skipped/failed on this handle
+        """
+        return self.liveness.stats()
+
+    def measure_throughput(self, tunings=None, size=16 * 1024 * 1024, compressible=False):
+        """
+        Measures the throughput of command output, SFTP download and SFTP upload with each of the tunings,
+        on a fresh direct connection per tuning
+
+        :param tunings: List of (name, SSHTuning). By default, paramiko defaults, every setting of
+                        this handle's tuning on its own, and all of them together
+        :param size: Bytes to be moved each way
+        :param compressible: Zeros instead of random data
+        :return: List of dicts with 'name', 'tuning', 'connect' (seconds) and MB/s of 'exec', 'sftp_get'
+                 and 'sftp_put', in the order of the tunings
+        """
+        if tunings is None:
+            tunings = self.tuning.variants()
+
+        results = []
+        saved_tuning = self.tuning
+
+        for name, tuning in tunings:
+            client = self._new_client()
+            result = {"name": name, "tuning": str(tuning)}
+
+            try:
+                self.tuning = tuning
+                start = time.time()
+                self._connect_client(client, 10)
+                result["connect"] = time.time() - start
+            finally:
+                self.tuning = saved_tuning
+
+            try:
+                result.update(measure_throughput(client, size, compressible=compressible))
+            finally:
+                client.close()
+
+            autopsy_logger.debug("Throughput with {0}: {1}".format(name, result))
+            results.append(result)
+
+        return results
+
+    def get_sftp_pool_stats(self):
+        """
+        :return: Idle SFTP clients, and the counts of them reused (hits), opened (misses) and discarded
+                 for being broken or of an older connection
+        """
+        return self.sftp_pool.stats()
+
+    def get_pool_stats(self):
+        """
+        :return: Connections alive, channels in use (total and per connection) and the time spent
+                 waiting for a free session slot
+        """
+        stats = self.pool.stats()
+        stats["session_slots"] = self.max_session_lock.stats()
 
-        return True
+        return stats
@@ -0,0 +1,195 @@
+#! /usr/bin/python -tt
+import pipes
+import re
+import socket
+import threading
+import uuid
+
+from paramiko.ssh_exception import SSHException
+
+from lib.SSHExpect import ChannelExpect
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+class ShellSessionError(Exception):
+    pass
+
+
+class ShellSession:
+    """ One long lived shell channel to a node which runs commands one after the other.
+
+    Output and exit status of every command are framed with a unique sentinel, so a command costs
+    a single round trip instead of channel open + pty + exec for each command.
+    Commands run in a subshell of the session shell, so 'cd', variables ..etc don't leak from one
+    command to the next, same as with a fresh exec channel per command.
+    """
+    # Shell's own stderr is thrown away, commands get their stderr merged to stdout by the wrapper
+    #   same as the pty does it for exec channels
+    SHELL_COMMAND = 'stty -echo 2>/dev/null; exec "${SHELL:-/bin/sh}" -s 2>/dev/null'
+    # Elevates once and keeps a root shell, marker is printed only when sudo let us in
+    SUDO_PROMPT = "__AUTOPSY_SUDO_PROMPT__"
+    READY_MARKER = "__AUTOPSY_ROOT_SHELL_READY__"
+    PRIVILEGED_SHELL_COMMAND = "stty -echo 2>/dev/null; " \
+                               "exec sudo -k -S -p '{0}' bash -c 'echo {1}; exec bash -s 2>/dev/null'"\
+        .format(SUDO_PROMPT, READY_MARKER)
+    OPEN_TIMEOUT = 10
+    RECV_SIZE = 32768
+
+    def __init__(self, transport, shell_command=SHELL_COMMAND, name=None, privileged=False, root_password=None,
+                 on_close=None):
+        """
+        :param transport: Paramiko transport to open the session on
+        :param shell_command: Command which starts the shell reading commands from stdin
+        :param name: Name to be used in the logs
+        :param privileged: Session is a root shell elevated once with sudo, 'shell_command' is ignored
+        :param root_password: Password to answer the sudo prompt with
+        :param on_close: Called once when the session is closed, e.g., to give back its session slot
+        """
+        self.transport = transport
+        self.privileged = privileged
+        self.root_password = root_password
+        self.shell_command = self.PRIVILEGED_SHELL_COMMAND if privileged else shell_command
+        self.name = name
+        self.channel = None
+        self.lock = threading.Lock()
+        self.commands_run = 0
+        self._on_close = on_close
+
+    def open(self, timeout=OPEN_TIMEOUT):
+        """ Opens the channel and waits till the shell is ready to take commands
+        :param timeout:
+        :return:
+        """
+        try:
+            self.channel = self.transport.open_session(timeout=timeout)
+            self.channel.get_pty()
+            self.channel.exec_command(self.shell_command)
+        except (SSHException, socket.error, EOFError) as e:
+            self.close()
+            raise ShellSessionError("Couldn't open shell session: " + str(e))
+
+        if self.privileged:
+            self._elevate(timeout)
+
+        # Anything printed before the shell took the first command (login banners, echo of the input
+        #   before 'stty -echo' took effect..etc) ends up in the output of this one and is dropped.
+        output, status = self.run("true", timeout=timeout)
+        if status != 0:
+            self.close()
+            raise ShellSessionError("Shell session didn't come up: " + output)
+
+        if self.privileged:
+            output, status = self.run("id -u", timeout=timeout)
+            if output.strip() != "0":
+                self.close()
+                raise ShellSessionError("Elevated shell is not running as root: " + output)
+
+        autopsy_logger.debug("Opened " + ("privileged " if self.privileged else "") +
+                             "shell session" + ((" (" + self.name + ")") if self.name else ""))
+
+    def _elevate(self, timeout):
+        """
+        Answers the sudo password prompt, if sudo asks for one, and waits till the root shell comes up
+        :param timeout:
+        :return:
+        """
+        expect = ChannelExpect(self.channel)
+        ready = re.escape(self.READY_MARKER)
+
+        try:
+            if not expect.expect(re.escape(self.SUDO_PROMPT) + "|" + ready, timeout=timeout):
+                raise ShellSessionError("Neither sudo prompt nor root shell showed up")
+
+            if self.READY_MARKER not in expect.buffer:
+                if not self.root_password:
+                    raise ShellSessionError("Sudo asked for a password, but there is no root password")
+
+                expect.send(self.root_password + "\n")
+                if not expect.expect(ready, timeout=timeout):
+                    raise ShellSessionError("Couldn't elevate, probably wrong root password: " +
+                                            expect.buffer.replace(self.SUDO_PROMPT, "").strip())
+        except (SSHException, socket.error, EOFError) as e:
+            self.close()
+            raise ShellSessionError("Couldn't elevate: " + str(e))
+        except ShellSessionError:
+            self.close()
+            raise
+
+    def is_alive(self):
+        return self.channel is not None and not self.channel.closed \
+            and not self.channel.exit_status_ready() and self.transport.is_active()
+
+    def close(self):
+        if self.channel:
+            try:
+                self.channel.close()
+            except (SSHException, socket.error, EOFError):
+                pass
+            self.channel = None
+
+        if self._on_close:
+            self._on_close()
+            self._on_close = None
+
+    def run(self, command, timeout=None, output=None):
+        """
+        :param command: Command to run in the session
+        :param timeout: Timeout for the command to return (None to wait forever)
+        :param output: File like object (e.g., OutputCollector) to write the output to as it comes,
+                       instead of holding all of it in memory
+        :return: Tuple of output (stdout and stderr combined, or the 'output' object if given)
+                 and exit status of the command.
+                 Exit status is -1 if the session died while the command was running.
+                 Raises ShellSessionError if the command couldn't be sent at all, in which case
+                 it is safe to run the command by other means.
+        """
+        sentinel = "__AUTOPSY_" + uuid.uuid4().hex + "__"
+        pattern = re.compile(r"\r?\n" + sentinel + r" (-?\d+)\r?\n")
+
+        with self.lock:
+            if not self.is_alive():
+                raise ShellSessionError("Shell session is not active")
+
+            try:
+                self.channel.settimeout(timeout)
+                self.channel.sendall("( eval {0} ) 2>&1; printf '\\n%s %d\\n' {1} $?\n"
+                                     .format(pipes.quote(command), sentinel))
+            except (SSHException, socket.error, EOFError) as e:
+                self.close()
+                raise ShellSessionError("Couldn't send command to shell session: " + str(e))
+
+            self.commands_run += 1
+
+            # Output is kept in chunks and the sentinel is searched only in the tail,
+            #   to keep this linear for huge outputs
+            chunks = []
+            write = output.write if output is not None else chunks.append
+            tail = ""
+            keep = len(sentinel) + 32
+
+            try:
+                while True:
+                    data = self.channel.recv(self.RECV_SIZE)
+                    if not data:
+                        break
+
+                    tail += data
+                    match = pattern.search(tail)
+                    if match:
+                        write(tail[:match.start()])
+                        return output if output is not None else "".join(chunks), int(match.group(1))
+
+                    if len(tail) > keep:
+                        write(tail[:-keep])
+                        tail = tail[-keep:]
+            except socket.timeout:
+                # Command may be still running in the shell, so this session can't be used anymore
+                self.close()
+                raise
+
+            autopsy_logger.debug("Shell session died while running the command: " + command)
+            self.close()
+            write(tail)
+            return output if output is not None else "".join(chunks), -1
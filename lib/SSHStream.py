@@ -0,0 +1,171 @@
+#! /usr/bin/python -tt
+import pipes
+import socket
+
+from paramiko.ssh_exception import SSHException
+
+__author__ = 'joshisk'
+
+
+class CommandStream:
+    """ Output of a command read as it arrives, instead of all of it at once.
+
+    Only one chunk of the output is held in memory at a time, the channel window keeps the node
+    from sending faster than it is consumed. stderr is merged to stdout.
+
+        with node.execute_iter("cat /var/log/syslog") as stream:
+            for line in stream:
+                if "panic" in line:
+                    break
+        print stream.exit_status
+
+    exit_status is None till the command finishes, and -1 if the stream was closed before that.
+    The stream holds one session slot of the node till it is closed or fully read.
+    """
+    RECV_SIZE = 32768
+    # Lines longer than this are given out in pieces, to keep the buffering bounded
+    MAX_LINE = 1024 * 1024
+
+    def __init__(self, channel, command, timeout=None, on_close=None):
+        """
+        :param channel: Paramiko channel with the command already executing on it
+        :param command: Command, used in the logs and errors
+        :param timeout: Seconds without any output after which socket.timeout is raised
+        :param on_close: Called once when the stream gets closed
+        """
+        self.channel = channel
+        self.command = command
+        self.exit_status = None
+        self.stderr = ""
+        self.bytes_read = 0
+        self.timeout = timeout
+        self._on_close = on_close
+        self.channel.settimeout(timeout)
+
+    @staticmethod
+    def wrap_command(command, sudo=False, feed_password=False, stdin=False):
+        """
+        :param command:
+        :param sudo: To execute the command with sudo
+        :param feed_password: If sudo is to be fed with the root password. Password is read from stdin
+                              by the shell, so it never shows up in the command line of any process
+        :param stdin: If the rest of the channel's input is to be passed on to the command
+        :return: Command to exec on the channel
+        """
+        if not sudo:
+            return command
+
+        if feed_password:
+            # sudo takes the password line, the command gets what follows it
+            feed = "{ printf '%s\\n' \"$__autopsy_pw\"; exec cat; }" if stdin else "printf '%s\\n' \"$__autopsy_pw\""
+            return "IFS= read -r __autopsy_pw; " + feed + " | sudo -k -S -p '' bash -c " + pipes.quote(command)
+
+        return "sudo -k -S -p '' bash -c " + pipes.quote(command) + ("" if stdin else " < /dev/null")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self.lines()
+
+    def chunks(self):
+        """
+        :return: Generator of output chunks as they arrive
+        """
+        try:
+            while True:
+                try:
+                    data = self.channel.recv(self.RECV_SIZE)
+                except socket.timeout:
+                    self.close()
+                    raise socket.timeout("No output from the command for {0} seconds: {1}"
+                                         .format(self.timeout, self.command))
+                except (SSHException, socket.error, EOFError):
+                    self.close()
+                    raise
+
+                if not data:
+                    break
+
+                self.bytes_read += len(data)
+                yield data
+
+            self.exit_status = self.channel.recv_exit_status()
+        finally:
+            self.close()
+
+    def write(self, data):
+        """ Writes to the stdin of the command, if the stream was opened with stdin """
+        if self.channel is None:
+            raise SSHException("Command is not running any more: {0}".format(self.command))
+
+        try:
+            self.channel.sendall(data)
+        except socket.timeout:
+            self.close()
+            raise socket.timeout("Command didn't take any input for {0} seconds: {1}".format(self.timeout,
+                                                                                           self.command))
+        except (SSHException, socket.error, EOFError):
+            self.close()
+            raise
+
+    def close_stdin(self):
+        """ Sends EOF to the command, nothing can be written after this """
+        self.channel.shutdown_write()
+
+    def read_stderr(self):
+        """
+        :return: stderr received so far (kept after the stream is closed), if the stream was opened without
+                 combining it to the output
+        """
+        while self.channel is not None and self.channel.recv_stderr_ready():
+            self.stderr += self.channel.recv_stderr(self.RECV_SIZE)
+
+        return self.stderr
+
+    def lines(self):
+        """
+        :return: Generator of output lines (without the line end) as they arrive
+        """
+        partial = ""
+
+        for data in self.chunks():
+            lines = (partial + data).split("\n")
+            partial = lines.pop()
+
+            for line in lines:
+                yield line.rstrip("\r")
+
+            while len(partial) > self.MAX_LINE:
+                yield partial[:self.MAX_LINE]
+                partial = partial[self.MAX_LINE:]
+
+        if partial:
+            yield partial.rstrip("\r")
+
+    def close(self):
+        """ Closes the channel, stopping the command if it is still running """
+        if self.channel is None:
+            return
+
+        self.read_stderr()
+
+        if self.exit_status is None:
+            if self.channel.exit_status_ready():
+                self.exit_status = self.channel.recv_exit_status()
+            else:
+                self.exit_status = -1
+
+        try:
+            self.channel.close()
+        except (SSHException, socket.error, EOFError):
+            pass
+
+        self.channel = None
+
+        if self._on_close:
+            self._on_close()
+            self._on_close = None
@@ -0,0 +1,223 @@
+#! /usr/bin/python -tt
+import os
+import socket
+import time
+
+import paramiko
+from paramiko.ssh_exception import SSHException
+
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+class SSHTuning:
+    """ Transport settings of the SSH connections to a host, instead of paramiko defaults.
+
+    Given per host in the testbed JSON,
+
+        "ssh_tuning": {"ciphers": ["aes128-ctr"], "macs": ["hmac-sha2-256"], "compress": false,
+                       "window_size": 4194304, "max_packet_size": 32768}
+
+    Ciphers and MACs are in the order of preference, only these are offered to the server.
+    Window and packet sizes apply to every channel opened on the connection, SFTP included.
+    Anything not given stays at paramiko's default.
+    """
+    KEYS = ("ciphers", "macs", "compress", "window_size", "max_packet_size")
+
+    def __init__(self, ciphers=None, macs=None, compress=False, window_size=None, max_packet_size=None):
+        """
+        :param ciphers: List of ciphers in the order of preference
+        :param macs: List of MACs in the order of preference
+        :param compress: To turn on the transport compression (zlib)
+        :param window_size: Bytes the server can send on a channel before waiting for us to read
+        :param max_packet_size: Maximum bytes in one packet of a channel
+        """
+        if type(ciphers) is not list and ciphers is not None:
+            ciphers = [ciphers]
+
+        if type(macs) is not list and macs is not None:
+            macs = [macs]
+
+        unknown = [c for c in (ciphers or []) if c not in paramiko.Transport._cipher_info] + \
+                  [m for m in (macs or []) if m not in paramiko.Transport._mac_info]
+        if unknown:
+            raise ValueError("Not supported by paramiko: {0}. Ciphers: {1}, MACs: {2}"
+                             .format(", ".join(unknown), ", ".join(sorted(paramiko.Transport._cipher_info)),
+                                     ", ".join(sorted(paramiko.Transport._mac_info))))
+
+        self.ciphers = ciphers
+        self.macs = macs
+        self.compress = bool(compress)
+        self.window_size = int(window_size) if window_size else None
+        self.max_packet_size = int(max_packet_size) if max_packet_size else None
+
+    @staticmethod
+    def from_json(l_tuning):
+        """
+        :param l_tuning: 'ssh_tuning' of a host in the testbed JSON
+        :return: SSHTuning, None if there is nothing to tune
+        """
+        if not l_tuning:
+            return None
+
+        unknown = [key for key in l_tuning if key not in SSHTuning.KEYS]
+        if unknown:
+            raise ValueError("Unknown ssh_tuning settings: " + ", ".join(unknown))
+
+        return SSHTuning(**dict((str(key), value) for key, value in l_tuning.items()))
+
+    def to_json(self):
+        return dict((key, getattr(self, key)) for key in SSHTuning.KEYS if getattr(self, key))
+
+    def is_default(self):
+        return not (self.ciphers or self.macs or self.compress or self.window_size or self.max_packet_size)
+
+    def variants(self):
+        """
+        :return: List of (name, SSHTuning) to measure the effect of each setting. Paramiko defaults,
+                 then every setting of this one on its own, then all of them together
+        """
+        variants = [("defaults", SSHTuning())]
+        settings = [(key, getattr(self, key)) for key in SSHTuning.KEYS if getattr(self, key)]
+
+        for key, value in settings:
+            variants.append((key, SSHTuning(**{key: value})))
+
+        if len(settings) > 1:
+            variants.append(("all", self))
+
+        return variants
+
+    def connect(self, client, **kwargs):
+        """
+        Connects the paramiko SSHClient with these settings
+        :param client: SSHClient to connect
+        :param kwargs: Arguments of SSHClient.connect
+        """
+        disabled = {}
+        if self.ciphers:
+            disabled["ciphers"] = [c for c in paramiko.Transport._preferred_ciphers if c not in self.ciphers]
+        if self.macs:
+            disabled["macs"] = [m for m in paramiko.Transport._preferred_macs if m not in self.macs]
+
+        kwargs["compress"] = self.compress
+
+        if disabled:
+            try:
+                client.connect(disabled_algorithms=disabled, **kwargs)
+            except TypeError:
+                # paramiko older than 2.6, preference is set right after the handshake instead
+                client.connect(**kwargs)
+        else:
+            client.connect(**kwargs)
+
+        self.apply(client.get_transport())
+
+    def apply(self, transport):
+        """
+        Applies the settings to a connected transport. Renegotiates the keys if the handshake didn't
+        end up with the most preferred cipher/MAC (paramiko offers what is left in its own order)
+        """
+        if self.window_size:
+            transport.default_window_size = self.window_size
+        if self.max_packet_size:
+            transport.default_max_packet_size = self.max_packet_size
+
+        if not (self.ciphers or self.macs):
+            return
+
+        options = transport.get_security_options()
+        if self.ciphers:
+            options.ciphers = self.ciphers
+        if self.macs:
+            options.digests = self.macs
+
+        if (self.ciphers and transport.local_cipher != self.ciphers[0]) or \
+                (self.macs and transport.local_mac != self.macs[0]):
+            try:
+                transport.renegotiate_keys()
+            except SSHException as e:
+                autopsy_logger.debug("Couldn't renegotiate with the preferred cipher/MAC: " + str(e))
+
+        autopsy_logger.debug("Negotiated cipher: {0}, MAC: {1}".format(transport.local_cipher,
+                                                                      transport.local_mac))
+
+    def __str__(self):
+        if self.is_default():
+            return "paramiko defaults"
+
+        return ", ".join("{0}={1}".format(key, ",".join(value) if type(value) is list else value)
+                         for key, value in [(key, getattr(self, key)) for key in SSHTuning.KEYS] if value)
+
+
+def _mbps(size, seconds):
+    return (size / (1024.0 * 1024)) / seconds if seconds > 0 else 0.0
+
+
+def measure_throughput(client, size, compressible=False, timeout=300):
+    """
+    Measures how fast a connected client moves data: command output, SFTP download and SFTP upload
+    of 'size' bytes each.
+
+    :param client: Connected paramiko SSHClient
+    :param size: Bytes to be moved each way
+    :param compressible: Zeros instead of random data, to see what compression does for text like outputs
+    :param timeout: Seconds to wait for any data before giving up
+    :return: Dict of MB/s of 'exec', 'sftp_get' and 'sftp_put'
+    """
+    source = "/dev/zero" if compressible else "/dev/urandom"
+    remote_file = "/tmp/autopsy_throughput_{0}_{1}".format(socket.gethostname(), int(time.time() * 1000))
+    result = {}
+
+    start = time.time()
+    _, stdout, _ = client.exec_command("head -c {0} {1}".format(size, source), timeout=timeout)
+    received = 0
+    while True:
+        data = stdout.read(65536)
+        if not data:
+            break
+        received += len(data)
+    result["exec"] = _mbps(received, time.time() - start)
+
+    _, stdout, _ = client.exec_command("head -c {0} {1} > {2}".format(size, source, remote_file), timeout=timeout)
+    stdout.channel.recv_exit_status()
+
+    sftp = client.open_sftp()
+    try:
+        sftp.get_channel().settimeout(timeout)
+
+        start = time.time()
+        remote = sftp.file(remote_file, "rb")
+        try:
+            remote.prefetch()
+            received = 0
+            while True:
+                data = remote.read(1024 * 1024)
+                if not data:
+                    break
+                received += len(data)
+        finally:
+            remote.close()
+        result["sftp_get"] = _mbps(received, time.time() - start)
+
+        # Random data repeats after a MB, which is still far beyond what zlib can find a match in
+        chunk = "\0" * 1024 * 1024 if compressible else os.urandom(1024 * 1024)
+        start = time.time()
+        remote = sftp.file(remote_file, "wb")
+        try:
+            remote.set_pipelined(True)
+            sent = 0
+            while sent < size:
+                data = chunk[:size - sent]
+                remote.write(data)
+                sent += len(data)
+        finally:
+            remote.close()
+        result["sftp_put"] = _mbps(sent, time.time() - start)
+
+        sftp.remove(remote_file)
+    finally:
+        sftp.close()
+
+    return result
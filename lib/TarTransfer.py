@@ -0,0 +1,255 @@
+#! /usr/bin/python -tt
+import os
+import pipes
+import posixpath
+import socket
+import tarfile
+import time
+
+from paramiko.ssh_exception import SSHException
+
+from lib.SFTPTransfer import DirTransferResult, SFTPTransfer
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+class _StreamWriter:
+    """ File object tarfile writes the archive to, sent to the stdin of the command """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+
+    def write(self, data):
+        try:
+            self.stream.write(data)
+        except (SSHException, socket.error, EOFError) as e:
+            # socket.error is an IOError, which would pass for a local file that couldn't be read
+            raise SSHException(str(e))
+
+        self.bytes += len(data)
+
+
+class _StreamReader:
+    """ File object tarfile reads the archive from, the output of the command """
+
+    def __init__(self, stream):
+        self.chunks = stream.chunks()
+        self.buffer = ""
+        self.bytes = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                data = next(self.chunks)
+            except StopIteration:
+                break
+
+            self.buffer += data
+            self.bytes += len(data)
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def drain(self):
+        """ Reads what is left after the end of the archive, till the command exits """
+        for data in self.chunks:
+            self.bytes += len(data)
+
+
+class TarTransfer(SFTPTransfer):
+    """ Moves directory trees as a tar archive streamed over a single exec channel, python's tarfile on
+    this side piped to (or from) tar on the node, without an archive written on either side.
+
+    With thousands of small files, SFTP spends most of the time in round trips for every file
+    (open, write, close, setstat) which this doesn't have at all. For a few big files, SFTPTransfer
+    is faster as it keeps many requests in flight and can use many channels.
+
+    Only directories and regular files are moved, files are taken in place of the symbolic links to them
+    while uploading, links are left out while downloading. Owners are not kept.
+    """
+    # Auto selection, tar is taken when there are at least these many files, of at most this size on average
+    MIN_FILES = 100
+    MAX_AVERAGE_SIZE = 256 * 1024
+    TIMEOUT = 5 * 60
+
+    def __init__(self, handle, compress=False, timeout=TIMEOUT, **kwargs):
+        """
+        :param handle: SSHHandle of the node
+        :param compress: To gzip the archive, worth it for text on slow links
+        :param timeout: Seconds after which the transfer is given up if nothing moves
+        :param kwargs: Arguments of SFTPTransfer
+        """
+        SFTPTransfer.__init__(self, handle, **kwargs)
+        self.compress = compress
+        self.timeout = timeout
+
+    @staticmethod
+    def is_better_for(files, size):
+        """
+        :param files: Number of files to be transferred
+        :param size: Bytes of all of them
+        :return: True if a tar stream is the faster way to move them
+        """
+        return files >= TarTransfer.MIN_FILES and size <= files * TarTransfer.MAX_AVERAGE_SIZE
+
+    def upload_dir(self, local_dir, remote_dir, include=None, exclude=None, workers=None, preserve=True):
+        """
+        Uploads the directory tree. Directory on the node (and its parents) is created if it is not there.
+
+        :param include: Glob patterns, only the files matching one of them are uploaded. All of them if None
+        :param exclude: Glob patterns of the files and directories to be left out
+        :param workers: Not used, it's one stream
+        :param preserve: Keep the permissions and modification times of the files and directories
+        :return: DirTransferResult
+        """
+        start = time.time()
+        directories, files = self._walk_local(local_dir, include, exclude)
+
+        remote = pipes.quote(remote_dir)
+        command = "mkdir -p {0} && tar -x{1}f - --no-same-owner {2} -C {0}"\
+            .format(remote, "z" if self.compress else "", "-p" if preserve else "-m")
+
+        stream = self.handle.execute_iter(command, timeout=self.timeout, quiet=True, stdin=True,
+                                          combine_stderr=False)
+        writer = _StreamWriter(stream)
+        failed = {}
+        size = 0
+
+        try:
+            archive = tarfile.open(fileobj=writer, mode="w|gz" if self.compress else "w|", dereference=True)
+
+            for relative, _ in directories:
+                archive.add(os.path.join(local_dir, *relative.split("/")) if relative else local_dir,
+                            arcname=relative if relative else ".", recursive=False)
+
+            for relative, attributes in files:
+                try:
+                    archive.add(os.path.join(local_dir, *relative.split("/")), arcname=relative, recursive=False)
+                    size += attributes.st_size
+                except (IOError, OSError) as e:
+                    autopsy_logger.error("Couldn't transfer {0}: {1}".format(relative, str(e)))
+                    failed[relative] = e
+
+            archive.close()
+            stream.close_stdin()
+
+            # Nothing is written by tar unless it fails, this waits for it to finish
+            for _ in stream.chunks():
+                pass
+        except (SSHException, socket.error, EOFError) as e:
+            # tar on the node exiting early closes the channel under the writes
+            stream.close()
+            raise IOError("Couldn't stream to tar on the node: {0} {1}".format(str(e), stream.stderr.strip()))
+        finally:
+            stream.close()
+
+        if stream.exit_status != 0:
+            raise IOError("tar on the node failed (exit status {0}): {1}".format(stream.exit_status,
+                                                                                stream.stderr.strip()))
+
+        return self._tar_result(local_dir, remote_dir, len(directories), len(files) - len(failed), size,
+                                writer.bytes, failed, start)
+
+    def download_dir(self, remote_dir, local_dir, include=None, exclude=None, workers=None, preserve=True):
+        """
+        Downloads the directory tree. Local directory (and its parents) is created if it is not there.
+
+        :param include: Glob patterns, only the files matching one of them are downloaded. All of them if None
+        :param exclude: Glob patterns of the files and directories to be left out
+        :param workers: Not used, it's one stream
+        :param preserve: Keep the modification times of the files and directories
+        :return: DirTransferResult
+        """
+        include, exclude = self._patterns(include), self._patterns(exclude)
+        start = time.time()
+
+        command = "tar -c{0}f - -C {1} {2} .".format("z" if self.compress else "", pipes.quote(remote_dir),
+                                                    " ".join("--exclude=" + pipes.quote(pattern)
+                                                             for pattern in exclude))
+
+        stream = self.handle.execute_iter(command, timeout=self.timeout, quiet=True, combine_stderr=False)
+        reader = _StreamReader(stream)
+        directories = []
+        files = 0
+        size = 0
+
+        try:
+            archive = tarfile.open(fileobj=reader, mode="r|gz" if self.compress else "r|")
+
+            for member in archive:
+                relative = posixpath.normpath(member.name)
+                relative = "" if relative == "." else relative
+
+                if relative.startswith("/") or relative == ".." or relative.startswith("../"):
+                    autopsy_logger.warning("Leaving out {0}, it is outside the directory".format(member.name))
+                    continue
+
+                target = os.path.join(local_dir, *relative.split("/")) if relative else local_dir
+
+                if member.isdir():
+                    if relative and self._is_excluded(relative, exclude):
+                        continue
+
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                    directories.append((target, member))
+                elif member.isfile() and self._is_selected(relative, include, exclude):
+                    parent = os.path.dirname(target)
+                    if not os.path.isdir(parent):
+                        os.makedirs(parent)
+
+                    source = archive.extractfile(member)
+                    with open(target, "wb") as fh:
+                        while True:
+                            data = source.read(1024 * 1024)
+                            if not data:
+                                break
+                            fh.write(data)
+
+                    os.chmod(target, member.mode & 0o7777)
+                    if preserve:
+                        os.utime(target, (member.mtime, member.mtime))
+
+                    files += 1
+                    size += member.size
+
+            archive.close()
+            reader.drain()
+        except tarfile.TarError as e:
+            # Nothing (or not an archive) comes out when tar on the node fails
+            stream.close()
+            raise IOError("tar on the node failed (exit status {0}): {1} {2}".format(stream.exit_status, str(e),
+                                                                                    stream.stderr.strip()))
+        except (SSHException, socket.error, EOFError) as e:
+            stream.close()
+            raise IOError("Couldn't stream from tar on the node: {0} {1}".format(str(e), stream.stderr.strip()))
+        finally:
+            stream.close()
+
+        if stream.exit_status != 0:
+            raise IOError("tar on the node failed (exit status {0}): {1}".format(stream.exit_status,
+                                                                                stream.stderr.strip()))
+
+        # Directories at the end, their times change with every file written in to them
+        for target, member in reversed(directories):
+            os.chmod(target, member.mode & 0o7777)
+            if preserve:
+                os.utime(target, (member.mtime, member.mtime))
+
+        return self._tar_result(remote_dir, local_dir, len(directories), files, size, reader.bytes, {}, start)
+
+    @staticmethod
+    def _is_excluded(path, exclude):
+        return not SFTPTransfer._is_selected(path, None, exclude)
+
+    def _tar_result(self, source, destination, directories, files, size, streamed, failed, start):
+        result = DirTransferResult(source, destination, files, directories, size, time.time() - start, failed)
+        (autopsy_logger.error if failed else autopsy_logger.info)(
+            str(result) + (", {0:.2f} MB compressed".format(streamed / (1024.0 * 1024)) if self.compress else ""))
+
+        return result
@@ -1,8 +1,13 @@
 import json
 import os
 import threading
+import time
+from multiprocessing.pool import ThreadPool
 
+from lib.CommandOutput import OutputRetention
 from lib.RemoteNode import RemoteNode
+from lib.SSHHandle import SSHHandle, SFTPClientPool
+from lib.SSHTuning import SSHTuning
 from lib.commons.Utilities import progressBar
 from lib.core import autopsy_globals
 from lib.core.autopsy_globals import autopsy_logger
@@ -18,7 +23,51 @@ class TestbedNotFoundException(Exception):
         return self.value
 
 
+class FanOutResult:
+    """ Outcome of Testbed.run_on_all, per host (keyed by RemoteNode) """
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.results = {}
+        self.errors = {}
+        self.durations = {}
+
+    def succeeded(self):
+        return len(self.errors) == 0
+
+    @property
+    def slowest(self):
+        """
+        :return: Tuple of the slowest node and the seconds it took, (None, 0) if there are no nodes
+        """
+        if not self.durations:
+            return None, 0
+
+        node = max(self.durations, key=self.durations.get)
+        return node, self.durations[node]
+
+    def raise_on_error(self):
+        """ Raises the exception of the first failed host (in the order of the testbed), if any """
+        for node in self.hosts:
+            if node in self.errors:
+                raise self.errors[node]
+
+    def __str__(self):
+        lines = []
+        for node in self.hosts:
+            status = ("FAILED: " + str(self.errors[node])) if node in self.errors else "OK"
+            lines.append("{0:<20} {1:>8.2f}s  {2}".format(node.alias, self.durations[node], status))
+
+        return "\n".join(lines)
+
+
 class Testbed:
+    # Hosts handled at a time by run_on_all
+    MAX_PARALLEL = 16
+    # Hosts connected at a time by openConnections, unless the testbed says otherwise
+    CONNECT_PARALLEL = 16
+    CONNECT_REPORT_FILE = "connections.json"
+
     def __init__(self, tbContent):
         self.tbname = None
         self.tbFileName = None
@@ -28,6 +77,8 @@ class Testbed:
         self.host = None
 
         self.no_download_logs = False
+        self.connect_parallel = Testbed.CONNECT_PARALLEL
+        self.warmup_thread = None
         self.__im1_lock = threading.RLock()
 
         autopsy_logger.info("Building testbed")
@@ -58,17 +109,175 @@ class Testbed:
             else:
                 autopsy_globals.autopsy_logger.critical("Error creating directory: " + e.message)
 
-    def openConnections(self):
-        if not autopsy_globals.autopsy_quick_run:
-            if self.host:
-                map(lambda node: node.connect() if node else "", self.host)
+    def start_warmup(self, max_parallel=None):
+        """
+        Starts connecting to all the hosts in background, so that the handshakes overlap with whatever
+        the run does before it needs the nodes (suite import, test collection..etc).
+        Anyone touching a node while its connection is in progress just waits for it to finish,
+        nodes not yet picked up by the warm-up are connected by the caller as usual.
+
+        Hosts are tried only once here, openConnections tries the failed ones again with retries.
+
+        :param max_parallel: Hosts connected at a time, 'connect_parallel' of the testbed by default
+        :return: Warm-up thread, None if there is nothing to warm up
+        """
+        if autopsy_globals.autopsy_quick_run or not self.host or self.warmup_thread:
+            return self.warmup_thread
+
+        def warmup():
+            start = time.time()
+            result = self.run_on_all(lambda node: node.connect(retries=1),
+                                     max_parallel=max_parallel or self.connect_parallel)
+            autopsy_logger.debug("Warm-up connected {0}/{1} hosts in {2:.2f}s"
+                                 .format(len(result.hosts) - len(result.errors), len(result.hosts),
+                                         time.time() - start))
+
+        self.warmup_thread = threading.Thread(target=warmup, name="TestbedWarmUp")
+        self.warmup_thread.daemon = True
+        self.warmup_thread.start()
+
+        return self.warmup_thread
+
+    def wait_for_warmup(self, timeout=None):
+        """
+        :param timeout: Seconds to wait, None to wait till the warm-up finishes
+        :return: True if there is no warm-up in progress anymore
+        """
+        if self.warmup_thread:
+            self.warmup_thread.join(timeout)
+            return not self.warmup_thread.is_alive()
+
+        return True
+
+    def openConnections(self, max_parallel=None):
+        """
+        Connects to all the hosts, 'max_parallel' (or 'connect_parallel' of the testbed) of them at a time.
+        Connect time and attempts of every host are recorded in the run archive.
+        Hosts already connected by the warm-up (see start_warmup) cost nothing here.
+
+        :param max_parallel:
+        :return: False if any of the hosts couldn't be connected, after trying all of them
+        """
+        if autopsy_globals.autopsy_quick_run or not self.host:
+            return True
+
+        self.wait_for_warmup()
+
+        result = self.run_on_all(RemoteNode.connect, max_parallel=max_parallel or self.connect_parallel)
+
+        report = []
+        for node in result.hosts:
+            last_connect = node.ssh_client.last_connect if hasattr(node, "ssh_client") else None
+            report.append({"host": node.alias,
+                           "ip": node.ipAddress,
+                           "connected": node not in result.errors,
+                           "seconds": round(last_connect["seconds"] if last_connect else result.durations[node], 3),
+                           "attempts": last_connect["attempts"] if last_connect else 0,
+                           "error": str(result.errors[node]) if node in result.errors else None})
+
+        node, seconds = result.slowest
+        autopsy_logger.info("Connected to {0}/{1} hosts, slowest is {2} with {3:.2f}s"
+                            .format(len(result.hosts) - len(result.errors), len(result.hosts), node.alias, seconds))
+
+        if autopsy_globals.autopsy_logfile:
+            try:
+                with open(os.path.join(autopsy_globals.autopsy_logfile, self.CONNECT_REPORT_FILE), "w") as fh:
+                    json.dump(report, fh, indent=4)
+            except IOError as e:
+                autopsy_logger.error("Couldn't write connection report: " + str(e))
+
+        if result.errors:
+            autopsy_logger.critical("Couldn't connect to {0} host(s):".format(len(result.errors)))
+            autopsy_logger.critical("{0:<20} {1:<16} {2:>8} {3:>9}  {4}".format("Host", "IP", "Attempts",
+                                                                               "Time", "Error"))
+            for row in report:
+                if not row["connected"]:
+                    autopsy_logger.critical("{0:<20} {1:<16} {2:>8} {3:>8.2f}s  {4}"
+                                            .format(row["host"], row["ip"], row["attempts"], row["seconds"],
+                                                    row["error"]))
+            return False
 
         return True
 
+    def run(self, command, hosts=None, sudo=False, timeout=SSHHandle.EXEC_TIMEOUT):
+        """
+        Executes the command on all the hosts at once
+
+        :param command:
+        :param hosts: List of nodes to execute on, all hosts of the testbed by default
+        :param sudo:
+        :param timeout: Seconds without any output after which the command is given up
+        :return: List of CommandFuture in the order of hosts, use gather() to wait for all of them
+        """
+        if hosts is None:
+            hosts = [node for node in self.host if node] if self.host else []
+
+        return [node.run(command, sudo=sudo, timeout=timeout) for node in hosts]
+
+    def run_on_all(self, action, *args, **kwargs):
+        """
+        Runs a command or a function on all the hosts at once, each on a thread of a bounded pool
+
+            result = testbed.run_on_all("uptime", quiet=True)
+            result = testbed.run_on_all(RemoteNode.reboot)
+            result = testbed.run_on_all(lambda node: node.isFileExists("/tmp/x"))
+            result = testbed.run_on_all(RemoteNode.uploadFile, "local.tar", "/tmp/", hosts=nodes, max_parallel=4)
+
+        :param action: Command to execute (string) or function to be called with the node as first argument
+        :param hosts: (keyword only) List of nodes, all hosts of the testbed by default
+        :param max_parallel: (keyword only) Maximum number of hosts handled at a time, 1 to not start
+                             any threads
+        :param args: Passed on to the function (or to execute() for a command)
+        :param kwargs: Rest of them passed on to the function (or to execute() for a command)
+        :return: FanOutResult with the result, the exception and the time taken per host
+        """
+        hosts = kwargs.pop("hosts", None)
+        max_parallel = kwargs.pop("max_parallel", Testbed.MAX_PARALLEL)
+
+        if hosts is None:
+            hosts = self.host if self.host else []
+
+        hosts = [node for node in hosts if node]
+        result = FanOutResult(hosts)
+
+        if not hosts:
+            return result
+
+        if isinstance(action, basestring):
+            command = action
+            action = lambda node, *a, **kw: node.execute(command, *a, **kw)
+
+        def run(node):
+            start = time.time()
+            try:
+                result.results[node] = action(node, *args, **kwargs)
+            except Exception as e:
+                autopsy_logger.debug("Error on host {0}: {1}".format(node.alias, str(e)))
+                result.errors[node] = e
+            finally:
+                result.durations[node] = time.time() - start
+
+        if len(hosts) == 1 or max_parallel <= 1:
+            map(run, hosts)
+        else:
+            pool = ThreadPool(min(len(hosts), max_parallel))
+            try:
+                pool.map(run, hosts)
+            finally:
+                pool.close()
+
+        node, seconds = result.slowest
+        autopsy_logger.debug("Ran on {0} hosts ({1} failed), slowest is {2} with {3:.2f}s"
+                             .format(len(hosts), len(result.errors), node.alias, seconds))
+
+        return result
+
     def parse_json(self, json_dict):
         hosts = json_dict['host'] if 'host' in json_dict else []
 
         self.tbname = json_dict['tbname'] if 'tbname' in json_dict else "My_Testbed"
+        self.connect_parallel = int(json_dict['connect_parallel']
+                                    if 'connect_parallel' in json_dict else Testbed.CONNECT_PARALLEL)
         self.host = []
 
         for l_host in hosts:
@@ -78,23 +287,50 @@ class Testbed:
                                         username=l_host['username'] if 'username' in l_host else 'ubuntu',
                                         password=l_host['password'] if 'password' in l_host else None,
                                         alias=l_host['alias'],
-                                        ssh_port=int(l_host['ssh_port'] if 'ssh_port' in l_host else 22)))
+                                        ssh_port=int(l_host['ssh_port'] if 'ssh_port' in l_host else 22),
+                                        persistent_session=l_host['persistent_session']
+                                        if 'persistent_session' in l_host else False,
+                                        privileged_session=l_host['privileged_session']
+                                        if 'privileged_session' in l_host else False,
+                                        pool_size=int(l_host['pool_size'] if 'pool_size' in l_host else 1),
+                                        ssh_tuning=SSHTuning.from_json(l_host['ssh_tuning']
+                                                                       if 'ssh_tuning' in l_host else None),
+                                        output_max_bytes=int(l_host['output_max_bytes']
+                                                             if 'output_max_bytes' in l_host
+                                                             else OutputRetention.DEFAULT_MAX_BYTES),
+                                        sftp_pool_size=int(l_host['sftp_pool_size']
+                                                           if 'sftp_pool_size' in l_host
+                                                           else SFTPClientPool.DEFAULT_SIZE),
+                                        stat_cache_size=int(l_host['stat_cache_size']
+                                                            if 'stat_cache_size' in l_host
+                                                            else RemoteNode.STAT_CACHE_SIZE),
+                                        stat_cache_ttl=float(l_host['stat_cache_ttl']
+                                                             if 'stat_cache_ttl' in l_host
+                                                             else RemoteNode.STAT_CACHE_TTL)))
 
     def __del__(self):
         if autopsy_globals is None:
             return
-        self.close_connections(quick=autopsy_globals.autopsy_quick_run)
+        # No threads are to be started from a finalizer, it may be running in the interpreter's teardown
+        self.close_connections(quick=autopsy_globals.autopsy_quick_run, parallel=False)
 
-    def close_connections(self, quick=False):
+    def close_connections(self, quick=False, parallel=True):
+        """
+        :param quick: Don't download the logs of the hosts
+        :param parallel: Handle the hosts in parallel (see run_on_all), else one after the other
+        """
         autopsy_logger.debug("Closing all connections of testbed")
+        max_parallel = Testbed.MAX_PARALLEL if parallel else 1
 
         if not (quick or self.no_download_logs):
             autopsy_logger.info("Downloading all logs, please wait....")
 
             progressBar(0, 1)
-            if self.host:
-                map(lambda node: node.download_all_logs(autopsy_globals.autopsy_logfile), self.host)
+            result = self.run_on_all(lambda node: node.download_all_logs(autopsy_globals.autopsy_logfile),
+                                     max_parallel=max_parallel)
             progressBar(1, 1)
 
-        if self.host:
-            map(lambda node: node.disconnect() if node else "", self.host)
+            for node, e in result.errors.items():
+                autopsy_logger.error("Couldn't download logs of {0}: {1}".format(node.alias, str(e)))
+
+        self.run_on_all(RemoteNode.disconnect, max_parallel=max_parallel)
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'joshisk'
+
+
+class ExpiringLRUCache:
+    """ Cache of at most 'max_len' entries, each given out for at most 'max_age_seconds' after it was set.
+    The least recently used entry is evicted to make room for a new one.
+
+        cache = ExpiringLRUCache(max_len=1024, max_age_seconds=60)
+        cache.set(path, attributes)
+        attributes = cache.get(path)
+
+    Safe to be used from many threads at once.
+    """
+
+    def __init__(self, max_len, max_age_seconds):
+        """
+        :param max_len: Maximum number of entries, 0 to not cache anything
+        :param max_age_seconds: Seconds after which an entry is not given out any more
+        """
+        self.max_len = max_len
+        self.max_age_seconds = max_age_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if time.time() >= expires_at:
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            # Most recently used ones are at the end
+            self.entries[key] = entry
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        if self.max_len <= 0:
+            return
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.max_age_seconds)
+
+            while len(self.entries) > self.max_len:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def remove_if(self, predicate):
+        """
+        :param predicate: Function of the key, True for the entries to be removed
+        :return: Number of entries removed
+        """
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+
+            for key in keys:
+                del self.entries[key]
+            self.invalidations += len(keys)
+
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries),
+                    "max_len": self.max_len,
+                    "max_age_seconds": self.max_age_seconds,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations,
+                    "invalidations": self.invalidations}
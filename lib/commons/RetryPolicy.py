@@ -0,0 +1,171 @@
+import random
+import socket
+import threading
+import time
+
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+class RetryPolicy:
+    """ How many times and how far apart an operation is retried.
+
+    Delay after the n-th failed attempt is base_delay * multiplier^(n-1), capped at max_delay and
+    randomised by +/- jitter (a fraction of the delay), so that many threads/hosts failing together
+    don't retry in lock step. No attempt is started once the deadline (seconds from the first attempt)
+    would be crossed by the delay before it.
+
+        for attempt in RetryPolicy(attempts=5, base_delay=1).attempts():
+            try:
+                return do_something()
+            except socket.error:
+                pass
+    """
+
+    def __init__(self, attempts=3, base_delay=1.0, max_delay=30.0, multiplier=2.0, jitter=0.2, deadline=None):
+        """
+        :param attempts: Maximum number of attempts (including the first one), None for no limit
+        :param base_delay: Seconds to wait after the first failure
+        :param max_delay: Maximum seconds to wait between two attempts
+        :param multiplier: Factor by which the delay grows after every failure
+        :param jitter: Fraction of the delay by which it is randomised
+        :param deadline: Seconds after which no more attempts are made, None for no limit
+        """
+        if attempts is None and deadline is None:
+            raise ValueError("Either attempts or deadline is needed, else it would retry forever")
+
+        self.attempts_max = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def copy(self, **overrides):
+        """
+        :param overrides: Parameters to be changed, e.g., policy.copy(attempts=10)
+        :return: New RetryPolicy
+        """
+        params = {"attempts": self.attempts_max, "base_delay": self.base_delay, "max_delay": self.max_delay,
+                  "multiplier": self.multiplier, "jitter": self.jitter, "deadline": self.deadline}
+        params.update(overrides)
+
+        return RetryPolicy(**params)
+
+    def get_delay(self, attempt):
+        """
+        :param attempt: Number of the attempt which failed, starting with 1
+        :return: Seconds to wait before the next attempt
+        """
+        delay = min(self.max_delay, self.base_delay * (self.multiplier ** (attempt - 1)))
+
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+
+        return max(0, delay)
+
+    def attempts(self):
+        """
+        :return: Generator of attempt numbers (starting with 1), sleeping between them as per the policy
+        """
+        start = time.time()
+        attempt = 1
+
+        while True:
+            yield attempt
+
+            if self.attempts_max is not None and attempt >= self.attempts_max:
+                return
+
+            delay = self.get_delay(attempt)
+            if self.deadline is not None and time.time() + delay - start > self.deadline:
+                return
+
+            time.sleep(delay)
+            attempt += 1
+
+
+class CircuitOpenError(socket.error):
+    """ Raised instead of trying at all, while the host is known to be down """
+    pass
+
+
+class CircuitBreaker:
+    """ Stops hammering a host which is down.
+
+    After 'failure_threshold' consecutive failures the circuit opens and every call fails right away
+    with CircuitOpenError. Once 'reset_timeout' seconds have passed, one caller gets to probe the host
+    (half-open); the circuit closes when the probe succeeds and opens again for another
+    'reset_timeout' when it fails.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, failure_threshold=2, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.times_opened = 0
+        self.calls_rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: True if the call can go ahead. When it is the probe of a half-open circuit,
+                 caller must report the outcome with record_success/record_failure.
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+
+            if self.state == CircuitBreaker.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+                autopsy_logger.debug("Circuit of {0} is half-open, probing".format(self.name))
+                return True
+
+            self.calls_rejected += 1
+            return False
+
+    def check(self):
+        """ Raises CircuitOpenError if the call is not to go ahead """
+        if not self.allow():
+            raise CircuitOpenError("{0} is down (failed {1} times in a row), not trying again for {2:.0f}s"
+                                   .format(self.name, self.failures,
+                                           max(0, self.reset_timeout - (time.time() - self.opened_at))))
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CircuitBreaker.CLOSED:
+                autopsy_logger.info("{0} is reachable again".format(self.name))
+
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.state == CircuitBreaker.HALF_OPEN or \
+                    (self.state == CircuitBreaker.CLOSED and self.failures >= self.failure_threshold):
+                if self.state == CircuitBreaker.CLOSED:
+                    autopsy_logger.warning("{0} failed {1} times in a row, failing calls to it for {2}s"
+                                           .format(self.name, self.failures, self.reset_timeout))
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.time()
+                self.times_opened += 1
+
+    def reset(self):
+        with self.lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def stats(self):
+        return {"state": self.state,
+                "failures": self.failures,
+                "times_opened": self.times_opened,
+                "calls_rejected": self.calls_rejected}
@@ -19,6 +19,8 @@ autopsy_logloc = None
 autopsy_logfile = None
 autopsy_loc_file_loc = os.getenv('AUTOPSY_AUTO_LOCK_DIR', "/tmp/autolocks/")
 autopsy_keys_location = os.getenv("AUTOPSY_KEY_LOCATION", "/home/ubuntu/keys")
+# Unix socket of the control master holding SSH connections across runs (None to connect directly)
+autopsy_control_socket = os.getenv("AUTOPSY_CONTROL_SOCKET")
 
 # ######
 #   INTERNAL USE: Fossa Zone. eNtEr At YoUr OwN rIsK !!!
@@ -27,6 +27,7 @@ from lib.core.autopsy_globals import autopsy_logger, TestCase, add_GA, allJobsRu
 from lib.core.autopsy_plugin import AutopsyPlugin
 from lib.core.AutopsyCollectOnlyPlugin import AutopsyCollectOnlyPlugin
 from lib.Testbed import Testbed
+from lib.CommandTimings import get_recorder
 from lib.core.TestCore import unpause_on_fail, unpause_test_run
 from lib.core.TestCore import archive_file_dir
 from lib.commons.Utilities import visual_sleep
@@ -147,6 +148,7 @@ def exit(status, archive=False):
     if archive:
         if autopsy_globals.autopsy_testbed:
             autopsy_globals.autopsy_testbed.close_connections(quick=args.quick)
+        get_recorder().write_report(archive_location)
         archive_file_dir(archive_location)
 
     if autopsy_globals.autopsy_testbed:
@@ -199,6 +201,9 @@ if __name__ == '__main__':
                            required=False, action='store_true')
     opt_group.add_argument('--reboot', '-r', help='Reboot all DP nodes before test', dest='reboot',
                            required=False, action='store_true')
+    opt_group.add_argument('--control-socket', help='Get SSH connections from the control master listening '
+                                                    'on this socket (see control_master.py)',
+                           dest='control_socket', required=False, type=str)
 
     # Users can pass in script specific parameters using this argument. This let's the scripts not to hardcode
     #   certain values with some assumption; instead let the users input them with this argument.
@@ -234,6 +239,9 @@ if __name__ == '__main__':
 
         autopsy_globals.autopsy_quick_run = args.quick
 
+        if args.control_socket:
+            autopsy_globals.autopsy_control_socket = args.control_socket
+
         HOME_DIR = os.getenv('TEST_AUTO_HOME', script_loc + "/../../")
         LOG_DIR = os.getenv('TEST_AUTO_LOG_DIR', HOME_DIR) + "/autologs/"
 
@@ -276,6 +284,11 @@ if __name__ == '__main__':
             autopsy_globals.autopsy_logger.critical("Couldn't lock testbed, exiting...")
             sys.exit(1)
 
+        # Connections are made in background while the suites get imported and collected,
+        #   TestbedInit waits for whatever is still in progress
+        if not args.quick:
+            autopsy_globals.autopsy_testbed.start_warmup()
+
         # TODO: For AUTO UI to show log. But this logic should be replaced
         # if not args.verbose:
         #     autopsy_globals.autopsy_logger.addFileHandler("/tmp/QA-Testbed.log", loggingLevel=logging.INFO)
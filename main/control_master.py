@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+""" Control master holding authenticated SSH connections to the testbed hosts across runs
+
+    usage: control_master.py [-h] [--socket SOCKET] [--idle-timeout IDLE_TIMEOUT] [--stats] [--stop]
+
+    Start it once, then point the runs to it with AUTOPSY_CONTROL_SOCKET (or --control-socket of autopsy.py)
+
+        ./control_master.py --socket /tmp/autopsy.sock &
+        AUTOPSY_CONTROL_SOCKET=/tmp/autopsy.sock ./autopsy.py --testbed ../testbeds/testbed.json ...
+"""
+
+import os
+import signal
+import sys
+
+# Make sure these two lines are always present before using any framework library
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, '..')
+
+from argparse import ArgumentParser
+
+from lib.SSHControlClient import control_master_stats, stop_control_master, ControlMasterUnavailable
+from lib.SSHControlMaster import ControlMaster, DEFAULT_SOCKET
+from lib.core.autopsy_globals import autopsy_logger
+
+__author__ = 'joshisk'
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Hold SSH connections to the testbed hosts for Autopsy runs")
+
+    parser.add_argument('--socket', help='Unix socket to listen on (default: %(default)s)', type=str,
+                        dest='socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--idle-timeout', help='Exit after these many seconds without any run using it',
+                        type=int, dest='idle_timeout', default=None)
+    parser.add_argument('--stats', help='Show the connections held by the running control master',
+                        dest='stats', action='store_true')
+    parser.add_argument('--stop', help='Stop the running control master', dest='stop', action='store_true')
+
+    args = parser.parse_args()
+
+    try:
+        if args.stats:
+            stats = control_master_stats(args.socket)
+            print("Clients         : {0}".format(stats["clients"]))
+            print("Channels opened : {0}".format(stats["channels_opened"]))
+            print("Connections     : {0}".format(", ".join(stats["transports"]) or "None"))
+            sys.exit(0)
+
+        if args.stop:
+            stop_control_master(args.socket)
+            sys.exit(0)
+    except ControlMasterUnavailable as e:
+        autopsy_logger.critical(str(e))
+        sys.exit(1)
+
+    master = ControlMaster(args.socket, idle_timeout=args.idle_timeout)
+
+    def stop(signum, frame):
+        master.running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    master.serve_forever()
@@ -0,0 +1,181 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.SSHControlClient import ControlClient, control_master_stats
+from lib.SSHControlMaster import ControlMaster
+from lib.SSHHandle import SSHHandle
+
+__author__ = 'joshisk'
+
+USER = "autopsy"
+PASSWORD = "secret"
+
+
+class _ExecServer(paramiko.ServerInterface):
+    """ Accepts the one user and runs exec requests with bash, nothing else """
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        if username == USER and password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._run, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    @staticmethod
+    def _run(channel, command):
+        proc = subprocess.Popen(["bash", "-c", command], stdin=open(os.devnull),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        channel.sendall(stdout)
+        channel.sendall_stderr(stderr)
+        channel.send_exit_status(proc.returncode)
+        channel.close()
+
+
+class SSHServer:
+    """ In-process SSH server on a free port of localhost """
+
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.connections = 0
+        self.transports = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except socket.error:
+                return
+
+            self.connections += 1
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_ExecServer())
+            self.transports.append(transport)
+
+    def close(self):
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class TestControlMaster(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = SSHServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, "control.sock")
+        self.master = ControlMaster(self.socket_path)
+
+        thread = threading.Thread(target=self.master.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        deadline = time.time() + 10
+        while not os.path.exists(self.socket_path):
+            self.assertLess(time.time(), deadline, "Control master didn't start listening")
+            time.sleep(0.05)
+
+        self.handles = []
+
+    def tearDown(self):
+        for handle in self.handles:
+            handle.disconnect()
+
+        self.master.running = False
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _handle(self, control_socket):
+        handle = SSHHandle("127.0.0.1", USER, PASSWORD, port=self.server.port, control_socket=control_socket)
+        self.handles.append(handle)
+        return handle
+
+    def test_exec_and_exit_status(self):
+        client = ControlClient(self.socket_path)
+        client.connect("127.0.0.1", port=self.server.port, username=USER, password=PASSWORD, timeout=10)
+
+        try:
+            channel = client.open_channel(timeout=10)
+            channel.exec_command("echo out; echo err >&2; exit 3")
+
+            self.assertEqual(channel.recv_exit_status(), 3)
+            self.assertEqual(channel.makefile("r").read().strip(), "out")
+            self.assertEqual(channel.makefile_stderr("r").read().strip(), "err")
+            channel.close()
+        finally:
+            client.close()
+
+    def test_handles_share_the_master_transport(self):
+        first = self._handle(self.socket_path)
+        result = first.execute_result("echo first")
+
+        self.assertEqual(result.exit_status, 0)
+        self.assertEqual(result.output.strip(), "first")
+        self.assertIsInstance(first.handle, ControlClient)
+
+        connections = self.server.connections
+        second = self._handle(self.socket_path)
+        result = second.execute_result("echo second; exit 5")
+
+        self.assertEqual(result.exit_status, 5)
+        self.assertEqual(result.output.strip(), "second")
+        self.assertTrue(second.handle.reused)
+        self.assertEqual(self.server.connections, connections)
+        self.assertGreaterEqual(control_master_stats(self.socket_path)["channels_opened"], 2)
+
+    def test_falls_back_to_direct_connection(self):
+        connections = self.server.connections
+        handle = self._handle(os.path.join(self.tmpdir, "missing.sock"))
+        result = handle.execute_result("echo direct")
+
+        self.assertEqual(result.exit_status, 0)
+        self.assertEqual(result.output.strip(), "direct")
+        self.assertIsNone(handle.control_socket)
+        self.assertNotIsInstance(handle.handle, ControlClient)
+        self.assertEqual(self.server.connections, connections + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()